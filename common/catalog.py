@@ -0,0 +1,177 @@
+"""
+Catalog versioning for conditional and pre-serialized listing responses.
+
+Every write that changes the catalog bumps a single-row version counter in
+the same transaction. Listing endpoints read only that row to answer
+``If-None-Match`` with ``304 Not Modified``, and keep the serialized body of
+each listing for the current version so unconditional polls skip the
+inventory table too.
+
+:class:`InStockCatalog` keeps the in-stock items themselves in memory: the
+service's own stock changes are applied to it incrementally, and any other
+change of the version reloads it.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from flask import Response, json
+from sqlalchemy import DDL, event, text
+
+
+def versioned_table(model):
+    """
+    Seeds the single row of a catalog version ``model`` when its table is created.
+
+    The model needs an integer ``id`` primary key and an integer ``version``.
+    """
+    event.listen(model.__table__, 'after_create', DDL(
+        f'INSERT INTO {model.__tablename__} (id, version) VALUES (1, 0)'))
+    return model
+
+
+def bump_version(session, model):
+    """Increments the catalog version inside the caller's transaction; returns the new version."""
+    return session.execute(text(
+        f'UPDATE {model.__tablename__} SET version = version + 1 WHERE id = 1 RETURNING version'
+    )).scalar()
+
+
+def current_version(session, model):
+    """Returns the committed catalog version (0 if the row is missing)."""
+    return session.execute(text(f'SELECT version FROM {model.__tablename__} WHERE id = 1')).scalar() or 0
+
+
+class VersionedResponses:
+    """
+    Serialized listing responses of the current catalog version.
+
+    Entries are keyed by a variant (typically the query string); when the
+    version changes every entry is dropped. At most ``maxsize`` variants
+    are kept, least recently used first out.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._version = None
+        self._entries = OrderedDict()  # variant -> (body, headers)
+        self._lock = threading.Lock()
+
+    def get(self, version, variant):
+        """Returns ``(body, headers)`` cached for ``variant`` at ``version``, or ``None``."""
+        with self._lock:
+            if version != self._version:
+                return None
+            entry = self._entries.get(variant)
+            if entry is not None:
+                self._entries.move_to_end(variant)
+            return entry
+
+    def put(self, version, variant, body, headers):
+        """Stores the serialized ``body`` and extra ``headers`` of ``variant``."""
+        with self._lock:
+            if self._version is not None and version < self._version:
+                return
+            if version != self._version:
+                self._version = version
+                self._entries.clear()
+            self._entries[variant] = (body, headers)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drops every cached response."""
+        with self._lock:
+            self._version = None
+            self._entries.clear()
+
+    def respond(self, request, version, variant, build):
+        """
+        Answers a listing request at catalog ``version``.
+
+        Returns ``304 Not Modified`` when the client's ``If-None-Match``
+        holds the current strong ETag, the cached body when there is one, and
+        otherwise calls ``build()`` (returning ``(data, headers)``) and caches
+        its JSON serialization.
+        """
+        etag = f'v{version}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        entry = self.get(version, variant)
+        if entry is None:
+            data, headers = build()
+            entry = (json.dumps(data), headers)
+            self.put(version, variant, *entry)
+        body, headers = entry
+        response = Response(body, mimetype='application/json', headers=headers)
+        response.set_etag(etag)
+        return response
+
+
+class InStockCatalog:
+    """
+    The in-stock items of a catalog version, in id order, in memory.
+
+    Args:
+        loader: Callable returning every in-stock item as a dict with at
+            least ``id`` and ``count``, in id order.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.version = None
+        self._ids = []
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def sync(self, version):
+        """Reloads the items unless they already are those of ``version`` (or newer)."""
+        with self._lock:
+            if self.version is not None and self.version >= version:
+                return
+        items = self.loader()
+        with self._lock:
+            if self.version is None or self.version < version:
+                self._ids = [item['id'] for item in items]
+                self._items = {item['id']: item for item in items}
+                self.version = version
+
+    def apply(self, version, counts):
+        """
+        Applies the stock ``counts`` (``{item_id: count}``) written by the change that made ``version``.
+
+        Only applies when the catalog is at the version just before; otherwise
+        the next :meth:`sync` reloads it. Returns whether it applied.
+        """
+        with self._lock:
+            if self.version is None or self.version != version - 1:
+                return False
+            if any(count > 0 and item_id not in self._items for item_id, count in counts.items()):
+                self.version = None  # Restocked: the whole row is needed, reload instead
+                return False
+            for item_id, count in counts.items():
+                if item_id not in self._items:
+                    continue
+                if count > 0:
+                    self._items[item_id] = {**self._items[item_id], 'count': count}
+                else:
+                    del self._items[item_id]
+                    del self._ids[bisect_left(self._ids, item_id)]
+            self.version = version
+            return True
+
+    def clear(self):
+        """Forgets every item; the next :meth:`sync` reloads."""
+        with self._lock:
+            self.version = None
+            self._ids, self._items = [], {}
+
+    def page(self, cursor, limit):
+        """Returns up to ``limit`` items with an id above ``cursor``, and whether more follow."""
+        with self._lock:
+            start = bisect_right(self._ids, cursor)
+            return [self._items[item_id] for item_id in self._ids[start:start + limit]], \
+                start + limit < len(self._ids)
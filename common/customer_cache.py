@@ -0,0 +1,52 @@
+"""
+Write-through cache of customer profiles keyed by username.
+
+The customers service writes fresh profiles through on registration. Data
+other services change (such as the wallet balance sales debit) is not
+cached, so the cache stays correct without a shared backend.
+"""
+import threading
+
+
+class CustomerCache:
+    """
+    Stores customer profile dictionaries in a Flask-Caching ``Cache``.
+
+    Keeps hit/miss counters for the current process.
+    """
+    KEY_PREFIX = 'customer:'
+
+    def __init__(self, cache, timeout=None):
+        self.cache = cache
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _key(self, username):
+        return f'{self.KEY_PREFIX}{username}'
+
+    def get(self, username):
+        """Returns the cached profile of ``username`` or ``None``."""
+        profile = self.cache.get(self._key(username))
+        with self._lock:
+            if profile is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return profile
+
+    def set(self, username, profile):
+        """Stores (or replaces) the profile of ``username``."""
+        self.cache.set(self._key(username), profile, timeout=self.timeout)
+
+    def invalidate(self, username):
+        """Drops the cached profile of ``username``."""
+        self.cache.delete(self._key(username))
+
+    def stats(self):
+        """Returns the hit/miss counters and hit ratio."""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "hit_ratio": hits / total if total else 0.0}
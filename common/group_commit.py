@@ -0,0 +1,164 @@
+"""
+Group commit: many small write transactions share one database commit.
+
+With SQLite every commit is an fsync under the single writer lock, which
+caps how many sales per second a service can record. In group-commit mode
+request threads hand their write job to one writer thread, which runs up
+to ``max_batch`` jobs (or whatever arrives within ``max_delay`` seconds)
+in one transaction and commits once.
+
+The batch runs in one outer transaction (an explicit ``BEGIN IMMEDIATE`` on
+SQLite) and each job in its own SAVEPOINT inside it, so a job that fails is
+undone on its own and the rest of the batch still commits. A request gets its job's
+result only after the batch has committed.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class Rollback(Exception):
+    """Raised by a job to undo its own writes and still return ``result``."""
+
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+class GroupCommitter:
+    """
+    Runs write jobs either inline or batched on a writer thread.
+
+    Args:
+        app: The Flask app; the writer thread runs in its app context.
+        session: The app's scoped session (e.g. ``db.session``).
+        enabled_key: Config key turning group commit on.
+        max_batch: Most jobs committed together.
+        max_delay: Seconds the writer waits for more jobs after the first one.
+    """
+
+    def __init__(self, app, session, enabled_key, max_batch=64, max_delay=0.005):
+        self.app = app
+        self.session = session
+        self.enabled_key = enabled_key
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def execute(self, fn, *args):
+        """
+        Runs ``fn(*args)`` in a transaction and returns its result once committed.
+
+        ``fn`` writes through the session and must not commit; it raises
+        :class:`Rollback` to discard its writes. Any other exception is
+        re-raised to the caller after the job's writes were discarded.
+        """
+        if not self.app.config.get(self.enabled_key):
+            try:
+                result = fn(*args)
+            except Rollback as e:
+                self.session.rollback()
+                return e.result
+            except Exception:
+                self.session.rollback()
+                raise
+            self.session.commit()
+            return result
+        # End the caller's read transaction: with SQLite it would block the writer's commit.
+        self.session.rollback()
+        return self.submit(fn, *args).result()
+
+    def submit(self, fn, *args):
+        """Queues ``fn(*args)`` for the writer thread; returns a ``Future`` of its result."""
+        self._start()
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def shutdown(self):
+        """Stops the writer thread after the queued jobs ran."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                job = self._queue.get()
+                if job is None:
+                    return
+                batch, stop = [job], False
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_batch:
+                    try:
+                        job = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if job is None:
+                        stop = True
+                        break
+                    batch.append(job)
+                self._run_batch(batch)
+                if stop:
+                    return
+
+    def _begin(self):
+        # pysqlite sends no BEGIN before a SAVEPOINT, so each job's RELEASE
+        # would commit on its own: open the batch's transaction first.
+        connection = self.session.connection()
+        if connection.dialect.name == 'sqlite' and not connection.connection.in_transaction:
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    def _run_batch(self, batch):
+        try:
+            self._begin()
+        except Exception as e:
+            self.session.rollback()
+            self.session.remove()
+            for future, _, _ in batch:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+
+        outcomes = []
+        for future, fn, args in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            savepoint = self.session.begin_nested()
+            try:
+                outcomes.append((future, fn(*args), None))
+            except Rollback as e:
+                savepoint.rollback()
+                outcomes.append((future, e.result, None))
+            except Exception as e:
+                savepoint.rollback()
+                outcomes.append((future, None, e))
+            else:
+                savepoint.commit()
+
+        try:
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            for future, _, _ in outcomes:
+                future.set_exception(e)
+            return
+        finally:
+            self.session.remove()
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
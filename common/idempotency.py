@@ -0,0 +1,169 @@
+"""
+``Idempotency-Key`` support for retried POST requests.
+
+The first request carrying a key claims it and runs; its response is stored
+under the key, and retries with the same key get that response back without
+running the transaction again. Keys are scoped to the caller's JWT identity
+and the request path, stored as 16-byte digests and expire after a TTL.
+
+A retry arriving while the first request still runs gets ``409``. A claim
+whose request died before writing anything is taken over once its lock
+timeout passes.
+
+The commit of the request's own writes also marks its key ``APPLIED`` (and
+keeps it for the TTL), in the same transaction. From then on the request is
+never run again for that key, even if it fails or the process dies before
+its response is stored: retries get ``409`` instead of a second sale or
+charge.
+"""
+import functools
+import hashlib
+from datetime import datetime, timedelta
+
+from flask import Response, current_app, g, has_app_context, jsonify, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import delete, event, select
+from sqlalchemy.dialects.sqlite import insert
+
+HEADER = 'Idempotency-Key'
+# Status of a key whose request committed its writes but has no stored response yet
+APPLIED = 0
+
+
+class Idempotency:
+    """
+    Stores responses of idempotent requests in a service's key model.
+
+    The model needs a 16-byte ``key`` primary key, an 8-byte
+    ``request_hash``, a nullable ``status`` (``None`` while in progress), a
+    ``body`` and an indexed ``expires_at``.
+
+    Writes committed through ``session`` while an idempotent view runs mark
+    its key applied. Writes committed elsewhere (such as a group-commit
+    writer thread) call :meth:`mark_applied` with :meth:`pending_key`.
+
+    Args:
+        session: The service's scoped session.
+        model: The key model.
+        ttl: Seconds a stored response is replayed.
+        lock_timeout: Seconds after which an unfinished claim is abandoned.
+    """
+
+    def __init__(self, session, model, ttl=86400, lock_timeout=60):
+        self.session = session
+        self.model = model
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        event.listen(session, 'before_commit', self._before_commit)
+
+    def pending_key(self):
+        """Returns the key of the idempotent view running in this app context, if any."""
+        return g.get('_idempotency_key') if has_app_context() else None
+
+    def mark_applied(self, key, session=None):
+        """Marks ``key`` applied in ``session``'s transaction, to commit with the request's writes."""
+        (session or self.session).query(self.model).filter(self.model.key == key).update({
+            'status': APPLIED,
+            'expires_at': datetime.utcnow() + timedelta(seconds=self.ttl),
+        }, synchronize_session=False)
+
+    def _before_commit(self, session):
+        key = self.pending_key()
+        if key is not None:
+            g._idempotency_key = None
+            self.mark_applied(key, session)
+
+    def _claim(self, key, request_hash, now):
+        table = self.model.__table__
+        values = {'request_hash': request_hash, 'status': None, 'body': None,
+                  'expires_at': now + timedelta(seconds=self.lock_timeout)}
+        statement = insert(table).values(key=key, **values).on_conflict_do_update(
+            index_elements=[table.c.key], set_=values, where=table.c.expires_at <= now)
+        claimed = self.session.execute(statement).rowcount == 1
+        self.session.commit()
+        return claimed
+
+    def _stored(self, key):
+        return self.session.execute(
+            select(self.model.request_hash, self.model.status, self.model.body).where(self.model.key == key)
+        ).first()
+
+    def _release(self, key):
+        """Deletes the claim of a request that committed nothing, so it can be retried."""
+        self.session.execute(delete(self.model.__table__).where(self.model.key == key, self.model.status.is_(None)))
+
+    def _finish(self, key, response, now):
+        self.session.rollback()  # Drop whatever the view left uncommitted
+        if response.status_code >= 500:
+            # Server errors are stored only once the request's writes committed
+            self._release(key)
+            self.session.query(self.model).filter(self.model.key == key).update({
+                'status': response.status_code,
+                'body': response.get_data(as_text=True),
+            }, synchronize_session=False)
+        else:
+            self.session.query(self.model).filter(self.model.key == key).update({
+                'status': response.status_code,
+                'body': response.get_data(as_text=True),
+                'expires_at': now + timedelta(seconds=self.ttl),
+            }, synchronize_session=False)
+        self.session.commit()
+
+    def purge(self, batch_size=1000):
+        """Deletes up to ``batch_size`` expired keys; returns how many."""
+        expired = select(self.model.key).where(self.model.expires_at <= datetime.utcnow()).limit(batch_size)
+        deleted = self.session.execute(
+            delete(self.model.__table__).where(self.model.key.in_(expired))).rowcount
+        self.session.commit()
+        return deleted
+
+    def idempotent(self, view):
+        """
+        Makes a JSON view replay its response for a repeated ``Idempotency-Key``.
+
+        Must be applied below ``jwt_required``. Requests without the header
+        run as usual; reusing a key for a different request body is a ``422``.
+        Server errors and exceptions of requests that committed nothing are
+        not stored, so they can be retried.
+        """
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            raw_key = request.headers.get(HEADER)
+            if not raw_key:
+                return view(*args, **kwargs)
+
+            scope = f'{get_jwt_identity()}\0{request.path}\0{raw_key}'.encode('utf-8')
+            key = hashlib.sha256(scope).digest()[:16]
+            request_hash = hashlib.sha256(request.get_data()).digest()[:8]
+            now = datetime.utcnow()
+
+            if not self._claim(key, request_hash, now):
+                stored = self._stored(key)
+                self.session.rollback()
+                if stored is None:  # Expired and purged in between: run as new
+                    return wrapper(*args, **kwargs)
+                if stored.request_hash != request_hash:
+                    return jsonify({"message": f"{HEADER} was already used for a different request"}), 422
+                if stored.status is None:
+                    return jsonify({"message": "A request with this Idempotency-Key is in progress"}), 409
+                if stored.status == APPLIED:
+                    return jsonify({"message": "A request with this Idempotency-Key was already applied; "
+                                               "its response is not available yet"}), 409
+                return Response(stored.body, status=stored.status, mimetype='application/json',
+                                headers={'Idempotent-Replayed': 'true'})
+
+            g._idempotency_key = key
+            try:
+                response = view(*args, **kwargs)
+            except Exception:
+                g._idempotency_key = None
+                self.session.rollback()
+                self._release(key)  # Once applied, the claim stays so retries cannot repeat the writes
+                self.session.commit()
+                raise
+            g._idempotency_key = None
+            response = current_app.make_response(response)
+            self._finish(key, response, now)
+            return response
+
+        return wrapper
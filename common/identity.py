@@ -0,0 +1,89 @@
+"""
+TTL-bounded cache resolving JWT identities (usernames) to ids and roles.
+
+Every authenticated request used to turn the username carried by the token
+back into a row with a ``filter_by(username=...)`` query. The identity of a
+user practically never changes, so services keep a small in-process map and
+only hit the database when an entry is missing or expired.
+
+Admin endpoints are guarded by :func:`admin_required`, which only lets the
+JWT subjects listed in ``ADMIN_USERNAMES`` through.
+"""
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, jsonify
+from flask_jwt_extended import get_jwt_identity, jwt_required
+
+Identity = namedtuple('Identity', ['id', 'username', 'roles'])
+
+
+class IdentityCache:
+    """
+    Least-recently-used map of username -> :class:`Identity` with a TTL.
+
+    Args:
+        loader: Callable returning the :class:`Identity` of a username, or
+            ``None`` if it does not exist. Missing users are not cached.
+        ttl: Seconds an entry is trusted before being reloaded.
+        maxsize: Maximum number of cached identities.
+    """
+
+    def __init__(self, loader, ttl=300, maxsize=10000):
+        self.loader = loader
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # username -> (expires_at, identity)
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        """Returns the identity of ``username``, loading it on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(username)
+                return entry[1]
+
+        identity = self.loader(username)
+        if identity is not None:
+            with self._lock:
+                self._entries[username] = (now + self.ttl, identity)
+                self._entries.move_to_end(username)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return identity
+
+    def invalidate(self, username):
+        """Forgets ``username``, e.g. after it was deleted or its roles changed."""
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        """Forgets every identity."""
+        with self._lock:
+            self._entries.clear()
+
+
+def admin_usernames():
+    """Reads the comma-separated ``ADMIN_USERNAMES`` environment variable."""
+    return [name.strip() for name in os.environ.get('ADMIN_USERNAMES', '').split(',') if name.strip()]
+
+
+def admin_required(view):
+    """
+    Restricts ``view`` to JWT subjects listed in the app's ``ADMIN_USERNAMES``.
+
+    Requests without a valid token get ``401``, other users ``403``.
+    """
+    @functools.wraps(view)
+    @jwt_required()
+    def wrapper(*args, **kwargs):
+        if get_jwt_identity() not in current_app.config.get('ADMIN_USERNAMES', ()):
+            return jsonify({"message": "Admin access required"}), 403
+        return view(*args, **kwargs)
+
+    return wrapper
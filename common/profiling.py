@@ -0,0 +1,184 @@
+"""
+Opt-in sampling profiler shared by all services.
+
+Instead of running cProfile around every request, a single background thread
+periodically samples the stacks of the request threads that were selected for
+profiling and aggregates them in memory as collapsed stacks
+(``frame;frame;frame count``), the input format of flamegraph.pl and speedscope.
+
+Profiling is off by default. When ``PROFILING_ENABLED`` is set, a request is
+profiled if its endpoint is listed in ``PROFILING_ROUTES`` (or was decorated
+with :meth:`SamplingProfiler.profile_route`), or otherwise with probability
+``PROFILING_SAMPLE_RATE``. Settings not given in ``app.config`` are read
+from environment variables of the same name, so profiling can be turned on
+for a deployed service without a code change.
+
+The admin endpoints serving and clearing the profile are restricted to
+``ADMIN_USERNAMES`` (see :func:`common.identity.admin_required`).
+"""
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, jsonify, request
+
+from common.identity import admin_required
+
+TRUNCATED_STACK = '[truncated]'
+
+
+class SamplingProfiler:
+    """
+    Aggregating stack sampler for a Flask app.
+
+    Configuration (read from ``app.config``, else from the environment):
+        PROFILING_ENABLED: Master switch, ``False`` by default.
+        PROFILING_SAMPLE_RATE: Fraction of requests profiled (0.0 - 1.0).
+        PROFILING_ROUTES: Endpoint names that are always profiled when enabled.
+        PROFILING_INTERVAL: Seconds between two stack samples.
+        PROFILING_MAX_STACKS: Maximum number of distinct stacks kept in memory.
+    """
+
+    def __init__(self, app=None, url_prefix=''):
+        self.app = None
+        self._routes = set()
+        self._active = {}  # thread id -> endpoint being profiled
+        self._stacks = Counter()
+        self._samples = 0
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._wake = threading.Event()  # Set when a request starts being profiled
+        if app is not None:
+            self.init_app(app, url_prefix)
+
+    def init_app(self, app, url_prefix=''):
+        """
+        Registers the request hooks and the admin endpoints on ``app``.
+
+        The collapsed stacks are served by ``GET <url_prefix>/admin/profile``
+        and cleared by ``DELETE <url_prefix>/admin/profile``.
+        """
+        app.config.setdefault('PROFILING_ENABLED', _env('PROFILING_ENABLED', False, _flag))
+        app.config.setdefault('PROFILING_SAMPLE_RATE', _env('PROFILING_SAMPLE_RATE', 0.0, float))
+        app.config.setdefault('PROFILING_ROUTES', _env('PROFILING_ROUTES', [], _names))
+        app.config.setdefault('PROFILING_INTERVAL', _env('PROFILING_INTERVAL', 0.005, float))
+        app.config.setdefault('PROFILING_MAX_STACKS', _env('PROFILING_MAX_STACKS', 10000, int))
+        self.app = app
+
+        app.before_request(self._start_request)
+        app.teardown_request(self._end_request)
+        app.add_url_rule(f'{url_prefix}/admin/profile', 'profile_dump',
+                         admin_required(self.dump), methods=['GET'])
+        app.add_url_rule(f'{url_prefix}/admin/profile', 'profile_reset',
+                         admin_required(self.reset), methods=['DELETE'])
+
+    def profile_route(self, view):
+        """
+        Decorator that marks a view as always profiled while profiling is enabled.
+        """
+        self._routes.add(view.__name__)
+        return view
+
+    def _should_profile(self):
+        config = self.app.config
+        if not config['PROFILING_ENABLED']:
+            return False
+        endpoint = request.endpoint
+        if endpoint in self._routes or endpoint in config['PROFILING_ROUTES']:
+            return True
+        return random.random() < config['PROFILING_SAMPLE_RATE']
+
+    def _start_request(self):
+        """Marks the current request thread for sampling if it was selected."""
+        if not self._should_profile():
+            return
+        self._active[threading.get_ident()] = request.endpoint or request.path
+        self._ensure_sampler()
+        self._wake.set()
+
+    def _end_request(self, exc=None):
+        """Stops sampling the current request thread."""
+        self._active.pop(threading.get_ident(), None)
+
+    def _ensure_sampler(self):
+        if self._sampler is not None and self._sampler.is_alive():
+            return
+        with self._lock:
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(
+                    target=self._run, name='sampling-profiler', daemon=True)
+                self._sampler.start()
+
+    def _run(self):
+        # Sleeps on the event while no request is profiled, instead of polling
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            while self._active:
+                time.sleep(self.app.config['PROFILING_INTERVAL'])
+                self.sample()
+
+    def sample(self):
+        """Takes one stack sample of every thread currently being profiled."""
+        frames = sys._current_frames()
+        for thread_id, endpoint in list(self._active.items()):
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            self._record(endpoint, collapse_stack(frame))
+
+    def _record(self, endpoint, stack):
+        key = f'{endpoint};{stack}' if stack else endpoint
+        with self._lock:
+            self._samples += 1
+            if key not in self._stacks and len(self._stacks) >= self.app.config['PROFILING_MAX_STACKS']:
+                key = f'{endpoint};{TRUNCATED_STACK}'
+            self._stacks[key] += 1
+
+    def collapsed(self):
+        """Returns the aggregated stacks in collapsed format, hottest first."""
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def dump(self):
+        """
+        Serves the aggregated stacks as ``text/plain`` collapsed stacks.
+        """
+        return Response(self.collapsed(), mimetype='text/plain',
+                        headers={'X-Profile-Samples': str(self._samples)})
+
+    def reset(self):
+        """
+        Clears the aggregated stacks.
+        """
+        with self._lock:
+            self._stacks.clear()
+            self._samples = 0
+        return jsonify({"message": "Profile data cleared"}), 200
+
+
+def _env(name, default, parse):
+    value = os.environ.get(name)
+    return default if value is None else parse(value)
+
+
+def _flag(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _names(value):
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+def collapse_stack(frame):
+    """Formats ``frame`` and its callers as a root-first ``;``-separated stack."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
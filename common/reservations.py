@@ -0,0 +1,107 @@
+"""
+Time-limited stock reservations (holds) for checkout.
+
+Reserving moves units out of ``count`` with the same conditional UPDATE as
+:func:`common.stock.deduct` and records a hold with an expiry time, so
+``count`` always is the available stock and never needs to subtract the
+open holds. Confirming a hold consumes it (the units are already gone),
+releasing or expiring it puts the units back.
+
+Holds are consumed with ``DELETE ... RETURNING`` so a hold is confirmed,
+released or expired exactly once, and expired holds are swept in batches
+through the index on their expiry time.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import DateTime, bindparam, text
+
+from common import stock
+
+
+def _now(now):
+    return now or datetime.utcnow()
+
+
+def reserve(session, inventory_model, reservation_model, item_id, count, holder, ttl, now=None):
+    """
+    Holds ``count`` units of ``item_id`` for ``holder`` during ``ttl`` seconds.
+
+    Returns the new reservation, or ``None`` if the item does not exist or
+    has fewer than ``count`` available units.
+    """
+    if stock.deduct(session, inventory_model, item_id, count) is None:
+        return None
+    reservation = reservation_model(
+        inventory_id=item_id,
+        quantity=count,
+        holder=holder,
+        expires_at=_now(now) + timedelta(seconds=ttl),
+    )
+    session.add(reservation)
+    session.flush()
+    return reservation
+
+
+def _take(session, reservation_model, reservation_id, holder, unexpired_at=None):
+    sql = f'DELETE FROM {reservation_model.__tablename__} WHERE id = :id'
+    params = {'id': reservation_id}
+    if holder is not None:
+        sql += ' AND holder = :holder'
+        params['holder'] = holder
+    if unexpired_at is not None:
+        sql += ' AND expires_at > :now'
+        params['now'] = unexpired_at
+    statement = text(sql + ' RETURNING inventory_id, quantity')
+    if unexpired_at is not None:
+        statement = statement.bindparams(bindparam('now', type_=DateTime))
+    row = session.execute(statement, params).first()
+    return (row[0], row[1]) if row else None
+
+
+def _restock(session, inventory_model, quantities):
+    for item_id, quantity in sorted(quantities.items()):
+        session.execute(text(
+            f'UPDATE {inventory_model.__tablename__} SET count = count + :quantity WHERE id = :id'
+        ), {'id': item_id, 'quantity': quantity})
+
+
+def confirm(session, reservation_model, reservation_id, holder=None, now=None):
+    """
+    Consumes an unexpired hold, optionally only if it belongs to ``holder``.
+
+    Returns ``(item_id, quantity)``, or ``None`` if the hold does not exist,
+    belongs to someone else or has expired.
+    """
+    return _take(session, reservation_model, reservation_id, holder, unexpired_at=_now(now))
+
+
+def release(session, inventory_model, reservation_model, reservation_id, holder=None):
+    """
+    Cancels a hold and puts its units back in stock.
+
+    Returns ``(item_id, quantity)``, or ``None`` if there was no such hold.
+    """
+    taken = _take(session, reservation_model, reservation_id, holder)
+    if taken is not None:
+        _restock(session, inventory_model, {taken[0]: taken[1]})
+    return taken
+
+
+def expire(session, inventory_model, reservation_model, now=None, batch_size=1000):
+    """
+    Puts the units of up to ``batch_size`` expired holds back in stock.
+
+    Returns the number of expired holds. The caller owns the transaction.
+    """
+    table = reservation_model.__tablename__
+    rows = session.execute(text(
+        f'DELETE FROM {table} WHERE id IN ('
+        f'SELECT id FROM {table} WHERE expires_at <= :now ORDER BY expires_at LIMIT :limit'
+        f') RETURNING inventory_id, quantity'
+    ).bindparams(bindparam('now', type_=DateTime)), {'now': _now(now), 'limit': batch_size}).all()
+
+    quantities = {}
+    for item_id, quantity in rows:
+        quantities[item_id] = quantities.get(item_id, 0) + quantity
+    _restock(session, inventory_model, quantities)
+    return len(rows)
@@ -0,0 +1,66 @@
+"""
+Race-free stock deduction.
+
+Stock is deducted with a single conditional
+``UPDATE ... SET count = count - :n WHERE id = :id AND count >= :n RETURNING count``
+so two concurrent deductions can never oversell an item, and the check and
+the write cost one statement instead of a read plus a write.
+"""
+from sqlalchemy import text
+
+
+class StockError(Exception):
+    """
+    Raised by :func:`deduct_many` when a line cannot be fulfilled.
+
+    Attributes:
+        item_id: The item that failed.
+        reason: ``'not_found'`` or ``'insufficient'``.
+    """
+
+    def __init__(self, item_id, reason):
+        super().__init__(f'Item {item_id}: {reason}')
+        self.item_id = item_id
+        self.reason = reason
+
+
+def deduct(session, model, item_id, count):
+    """
+    Deducts ``count`` units of ``item_id`` if enough are in stock.
+
+    Returns the remaining count, or ``None`` if the item does not exist or
+    has fewer than ``count`` units.
+    """
+    row = session.execute(text(
+        f'UPDATE {model.__tablename__} SET count = count - :count '
+        f'WHERE id = :id AND count >= :count RETURNING count'
+    ), {'id': item_id, 'count': count}).first()
+    return row[0] if row else None
+
+
+def failure_reason(session, model, item_id):
+    """Tells why a deduction of ``item_id`` failed: ``'not_found'`` or ``'insufficient'``."""
+    exists = session.query(model.id).filter(model.id == item_id).first()
+    return 'insufficient' if exists else 'not_found'
+
+
+def deduct_many(session, model, lines):
+    """
+    Deducts every ``(item_id, count)`` line, or none of them.
+
+    Lines for the same item are merged. The caller owns the transaction and
+    must roll it back when :class:`StockError` is raised.
+
+    Returns ``{item_id: remaining_count}``.
+    """
+    totals = {}
+    for item_id, count in lines:
+        totals[item_id] = totals.get(item_id, 0) + count
+
+    remaining = {}
+    for item_id in sorted(totals):
+        left = deduct(session, model, item_id, totals[item_id])
+        if left is None:
+            raise StockError(item_id, failure_reason(session, model, item_id))
+        remaining[item_id] = left
+    return remaining
@@ -0,0 +1,64 @@
+from common.identity import Identity, IdentityCache
+
+def make_cache(**kwargs):
+    """
+    Builds an identity cache over a fixed user table, recording loader calls.
+    """
+    users = {"alice": 1, "bob": 2, "carol": 3}
+    calls = []
+
+    def loader(username):
+        calls.append(username)
+        return Identity(users[username], username, ('customer',)) if username in users else None
+
+    return IdentityCache(loader, **kwargs), calls
+
+def test_identity_cache_hit():
+    """
+    Test that a cached identity is served without calling the loader.
+    """
+    cache, calls = make_cache()
+    assert cache.get("alice") == Identity(1, "alice", ('customer',))
+    assert cache.get("alice").id == 1
+    assert calls == ["alice"]
+
+def test_identity_cache_missing_not_cached():
+    """
+    Test that unknown usernames are looked up again.
+    """
+    cache, calls = make_cache()
+    assert cache.get("mallory") is None
+    assert cache.get("mallory") is None
+    assert calls == ["mallory", "mallory"]
+
+def test_identity_cache_ttl():
+    """
+    Test that expired identities are reloaded.
+    """
+    cache, calls = make_cache(ttl=0)
+    cache.get("alice")
+    cache.get("alice")
+    assert calls == ["alice", "alice"]
+
+def test_identity_cache_lru_eviction():
+    """
+    Test that the least recently used identity is evicted when full.
+    """
+    cache, calls = make_cache(maxsize=2)
+    cache.get("alice")
+    cache.get("bob")
+    cache.get("alice")
+    cache.get("carol")
+    cache.get("alice")
+    cache.get("bob")
+    assert calls == ["alice", "bob", "carol", "bob"]
+
+def test_identity_cache_invalidate():
+    """
+    Test forgetting a single identity.
+    """
+    cache, calls = make_cache()
+    cache.get("alice")
+    cache.invalidate("alice")
+    cache.get("alice")
+    assert calls == ["alice", "alice"]
@@ -0,0 +1,153 @@
+import pytest
+from flask import Flask, jsonify
+from flask_jwt_extended import JWTManager, create_access_token
+from common.profiling import SamplingProfiler
+
+@pytest.fixture
+def app():
+    """
+    Builds a small Flask app with the sampling profiler attached.
+    """
+    app = Flask(__name__)
+    app.config['JWT_SECRET_KEY'] = 'TestSecretKey'
+    app.config['TESTING'] = True
+    app.config['PROFILING_INTERVAL'] = 60  # Keep the background sampler out of the way
+    app.config['ADMIN_USERNAMES'] = ['admin']
+    JWTManager(app)
+    profiler = SamplingProfiler(app, url_prefix='/test')
+    app.extensions['test_profiler'] = profiler
+
+    @app.route('/work')
+    def work():
+        # Take a sample from inside the request so the test is deterministic
+        profiler.sample()
+        return jsonify({"message": "done"})
+
+    @app.route('/hot')
+    @profiler.profile_route
+    def hot():
+        profiler.sample()
+        return jsonify({"message": "done"})
+
+    return app
+
+@pytest.fixture
+def auth_header(app):
+    """
+    Generates an authorization header with a valid JWT token.
+    """
+    with app.app_context():
+        token = create_access_token(identity="admin")
+    return {"Authorization": f"Bearer {token}"}
+
+def test_profiling_disabled_by_default(app, auth_header):
+    """
+    Test that nothing is sampled unless profiling is enabled.
+    """
+    client = app.test_client()
+    client.get('/work')
+    client.get('/hot')
+    response = client.get('/test/admin/profile', headers=auth_header)
+    assert response.status_code == 200
+    assert response.data == b""
+
+def test_profiling_per_route(app, auth_header):
+    """
+    Test that routes opted in by config or decorator are sampled and aggregated.
+    """
+    app.config['PROFILING_ENABLED'] = True
+    app.config['PROFILING_ROUTES'] = ['work']
+    client = app.test_client()
+    client.get('/work')
+    client.get('/work')
+    client.get('/hot')
+
+    response = client.get('/test/admin/profile', headers=auth_header)
+    lines = response.get_data(as_text=True).splitlines()
+    assert response.headers['X-Profile-Samples'] == "3"
+    work_line = next(line for line in lines if line.startswith('work;'))
+    assert work_line.endswith(' 2')
+    assert 'work (test_profiling.py:' in work_line
+    assert any(line.startswith('hot;') for line in lines)
+
+def test_profiling_sample_rate(app, auth_header):
+    """
+    Test that unlisted routes follow the sample rate.
+    """
+    app.config['PROFILING_ENABLED'] = True
+    client = app.test_client()
+    client.get('/work')
+    assert client.get('/test/admin/profile', headers=auth_header).data == b""
+
+    app.config['PROFILING_SAMPLE_RATE'] = 1.0
+    client.get('/work')
+    assert b"work;" in client.get('/test/admin/profile', headers=auth_header).data
+
+def test_profiling_max_stacks(app, auth_header):
+    """
+    Test that distinct stacks beyond the cap are folded into a truncated bucket.
+    """
+    app.config['PROFILING_MAX_STACKS'] = 1
+    profiler = app.extensions['test_profiler']
+    profiler._record('work', 'a;b')
+    profiler._record('work', 'a;c')
+    assert profiler.collapsed() == "work;a;b 1\nwork;[truncated] 1\n"
+
+def test_profiling_reset(app, auth_header):
+    """
+    Test clearing the aggregated stacks from the admin endpoint.
+    """
+    app.config['PROFILING_ENABLED'] = True
+    app.config['PROFILING_SAMPLE_RATE'] = 1.0
+    client = app.test_client()
+    client.get('/work')
+    response = client.delete('/test/admin/profile', headers=auth_header)
+    assert response.status_code == 200
+    assert client.get('/test/admin/profile', headers=auth_header).data == b""
+
+def test_profiling_admin_protected(app):
+    """
+    Test that the profile dump requires a token.
+    """
+    response = app.test_client().get('/test/admin/profile')
+    assert response.status_code == 401
+
+def test_profiling_admin_only(app):
+    """
+    Test that users outside ADMIN_USERNAMES can neither read nor clear the profile.
+    """
+    with app.app_context():
+        headers = {"Authorization": f"Bearer {create_access_token(identity='customer')}"}
+    client = app.test_client()
+    assert client.get('/test/admin/profile', headers=headers).status_code == 403
+    assert client.delete('/test/admin/profile', headers=headers).status_code == 403
+
+def test_profiling_configured_from_environment(monkeypatch):
+    """
+    Test that settings missing from app.config are read from the environment.
+    """
+    monkeypatch.setenv('PROFILING_ENABLED', 'true')
+    monkeypatch.setenv('PROFILING_SAMPLE_RATE', '0.25')
+    monkeypatch.setenv('PROFILING_ROUTES', 'work, hot')
+    app = Flask(__name__)
+    SamplingProfiler(app)
+    assert app.config['PROFILING_ENABLED'] is True
+    assert app.config['PROFILING_SAMPLE_RATE'] == 0.25
+    assert app.config['PROFILING_ROUTES'] == ['work', 'hot']
+
+def test_profiling_sampler_idles_without_profiled_requests(app, monkeypatch):
+    """
+    Test that the sampler thread blocks instead of polling once no request is profiled.
+    """
+    profiler = app.extensions['test_profiler']
+    app.config['PROFILING_ENABLED'] = True
+    app.config['PROFILING_SAMPLE_RATE'] = 1.0
+    app.config['PROFILING_INTERVAL'] = 0.001
+    sleeps = []
+    monkeypatch.setattr('common.profiling.time.sleep', lambda seconds: sleeps.append(seconds))
+    app.test_client().get('/work')
+    profiler._sampler.join(timeout=0.05)  # Let it notice the request ended
+    idle = len(sleeps)
+    profiler._sampler.join(timeout=0.2)
+    assert profiler._sampler.is_alive()
+    assert len(sleeps) == idle
@@ -0,0 +1,175 @@
+"""
+Append-only wallet ledger with periodic balance snapshots.
+
+Wallet changes are never written to the customer row. Charges and debits are
+appended to a ledger table; a snapshot table periodically records the
+balance up to a ledger entry, so a balance is the latest snapshot (or the
+customer's opening balance) plus the sum of the few ledger entries after it.
+
+Money is stored as integer cents. Debits are a single conditional
+``INSERT ... SELECT ... WHERE balance >= :cents``, so concurrent requests can
+neither lose updates nor overdraw a wallet.
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+from sqlalchemy import func, insert, literal, select, text
+
+CENT = Decimal('0.01')
+
+
+def to_cents(amount):
+    """Converts a decimal amount (e.g. ``12.34``) to integer cents."""
+    return int(Decimal(str(amount)).quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+
+
+def from_cents(cents):
+    """Converts integer cents to a decimal amount for JSON responses, keeping None as None."""
+    return None if cents is None else cents / 100
+
+
+class Wallet:
+    """
+    Ledger operations over a service's own customer, ledger and snapshot models.
+
+    The customer model needs ``id`` and ``opening_balance_cents``; the ledger
+    model ``id``, ``customer_id``, ``amount_cents``, ``kind`` and
+    ``created_at``; the snapshot model ``customer_id``, ``ledger_id``,
+    ``balance_cents`` and ``created_at``.
+    """
+
+    def __init__(self, customer_model, entry_model, snapshot_model, snapshot_interval=100):
+        self.customer_model = customer_model
+        self.entry_model = entry_model
+        self.snapshot_model = snapshot_model
+        self.snapshot_interval = snapshot_interval
+
+    def _latest_snapshot(self, column):
+        snapshot = self.snapshot_model
+        return (select(column)
+                .where(snapshot.customer_id == self.customer_model.id)
+                .order_by(snapshot.ledger_id.desc())
+                .limit(1)
+                .correlate_except(snapshot)
+                .scalar_subquery())
+
+    def _tail(self, aggregate):
+        entry = self.entry_model
+        return (select(aggregate)
+                .where(entry.customer_id == self.customer_model.id,
+                       entry.id > func.coalesce(self._latest_snapshot(self.snapshot_model.ledger_id), 0))
+                .correlate_except(entry)
+                .scalar_subquery())
+
+    def balance_expression(self):
+        """SQL expression of the balance in cents, correlated to the customer model."""
+        base = func.coalesce(self._latest_snapshot(self.snapshot_model.balance_cents),
+                             self.customer_model.opening_balance_cents)
+        return base + self._tail(func.coalesce(func.sum(self.entry_model.amount_cents), 0))
+
+    def tail_length_expression(self):
+        """SQL expression counting the ledger entries after the latest snapshot."""
+        return self._tail(func.count(self.entry_model.id))
+
+    def balance(self, session, customer_id):
+        """Returns the balance in cents of ``customer_id``, or ``None`` if it does not exist."""
+        return session.execute(
+            select(self.balance_expression()).where(self.customer_model.id == customer_id)
+        ).scalar()
+
+    def _append(self, session, customer_id, cents, kind, condition=None):
+        customer = self.customer_model
+        source = select(customer.id, literal(cents), literal(kind), func.current_timestamp()) \
+            .where(customer.id == customer_id)
+        if condition is not None:
+            source = source.where(condition)
+        result = session.execute(insert(self.entry_model.__table__).from_select(
+            ['customer_id', 'amount_cents', 'kind', 'created_at'], source))
+        if result.rowcount == 0:
+            return None
+        return self._after_append(session, customer_id)
+
+    def _after_append(self, session, customer_id):
+        balance, tail = session.execute(
+            select(self.balance_expression(), self.tail_length_expression())
+            .where(self.customer_model.id == customer_id)
+        ).one()
+        if tail >= self.snapshot_interval:
+            self.snapshot(session, customer_id)
+        return balance
+
+    def credit(self, session, customer_id, cents, kind='charge'):
+        """
+        Appends a credit of ``cents`` to the ledger of ``customer_id``.
+
+        Returns the new balance in cents, or ``None`` if the customer does not exist.
+        """
+        return self._append(session, customer_id, cents, kind)
+
+    def debit(self, session, customer_id, cents, kind='debit'):
+        """
+        Appends a debit of ``cents`` if the balance of ``customer_id`` covers it.
+
+        Returns the new balance in cents, or ``None`` if the customer does not
+        exist or the funds were insufficient.
+        """
+        return self._append(session, customer_id, -cents, kind,
+                            condition=self.balance_expression() >= cents)
+
+    def snapshot(self, session, customer_id):
+        """
+        Records the current balance of ``customer_id`` up to its last ledger entry.
+
+        Must run in the same transaction as (or after) the writes it covers.
+        """
+        entry = self.entry_model
+        last_id = session.execute(
+            select(func.max(entry.id)).where(entry.customer_id == customer_id)
+        ).scalar()
+        if last_id is None:
+            return
+        session.add(self.snapshot_model(
+            customer_id=customer_id,
+            ledger_id=last_id,
+            balance_cents=self.balance(session, customer_id),
+        ))
+        session.flush()
+
+    def snapshot_due(self, session):
+        """Snapshots every customer whose ledger tail reached the snapshot interval."""
+        customer = self.customer_model
+        due = session.execute(
+            select(customer.id).where(self.tail_length_expression() >= self.snapshot_interval)
+        ).scalars().all()
+        for customer_id in due:
+            self.snapshot(session, customer_id)
+        return len(due)
+
+    def migrate(self, session):
+        """
+        Upgrades a database whose customers still carry their balance on the customer row.
+
+        Adds ``opening_balance_cents``, filled from ``wallet_balance_cents``
+        or else ``ROUND(wallet_balance * 100)``, and creates the ledger and
+        snapshot tables. Safe to run again. Returns how many customers got
+        their opening balance filled.
+        """
+        table = self.customer_model.__table__
+        columns = {row[1] for row in session.execute(text(f"PRAGMA table_info({table.name})"))}
+        filled = 0
+        if not columns:
+            table.create(session.connection())
+        elif 'opening_balance_cents' not in columns:
+            session.execute(text(
+                f"ALTER TABLE {table.name} ADD COLUMN opening_balance_cents INTEGER NOT NULL DEFAULT 0"))
+            if 'wallet_balance_cents' in columns:
+                source = 'wallet_balance_cents'
+            elif 'wallet_balance' in columns:
+                source = 'CAST(ROUND(wallet_balance * 100) AS INTEGER)'
+            else:
+                source = None
+            if source:
+                filled = session.execute(text(
+                    f"UPDATE {table.name} SET opening_balance_cents = COALESCE({source}, 0)")).rowcount
+        for model in (self.entry_model, self.snapshot_model):
+            model.__table__.create(session.connection(), checkfirst=True)
+        return filled
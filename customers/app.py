@@ -1,27 +1,53 @@
-import cProfile
-import pstats
-from io import StringIO
 from memory_profiler import profile
-from flask import Flask, request, jsonify
+import click
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import object_session
+from sqlalchemy import exc
+from flask_jwt_extended import (JWTManager, create_access_token, create_refresh_token, decode_token,
+                                get_jwt, get_jwt_identity, jwt_required)
+import math
+import os
 import re
+from datetime import datetime
+import csv
+import json
 import logging
 from flask_caching import Cache
+from common.customer_cache import CustomerCache
+from common.idempotency import Idempotency
+from common.identity import admin_required, admin_usernames
+from common.profiling import SamplingProfiler
+from common.wallet import Wallet, from_cents, to_cents
+from customers.hashing import HashingBusy, HashingService
 
 # Initialize the app and database
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///C:\\Users\\nsucc\\Desktop\\python env\\ecommerce_AbiRizk_Succar\\database\\database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = 'NadimandJoseph'
+app.config['ADMIN_USERNAMES'] = admin_usernames()  # JWT subjects allowed on /admin endpoints
 app.config['CACHE_TYPE'] = 'simple'  # You can change this to 'redis' for better performance
+app.config['WALLET_SNAPSHOT_INTERVAL'] = 100  # Ledger entries between two balance snapshots
 app.config['CACHE_DEFAULT_TIMEOUT'] = 300  # Cache timeout in seconds
+app.config['CUSTOMER_CACHE_TIMEOUT'] = 300  # Profiles (without balance) are written through, so this only bounds memory
+app.config['HASH_POOL_WORKERS'] = os.cpu_count() or 1  # Processes hashing passwords off the request threads
+app.config['HASH_POOL_QUEUE_LIMIT'] = 4 * app.config['HASH_POOL_WORKERS']  # Hashes allowed to wait before answering 429
+app.config['CUSTOMERS_PAGE_SIZE'] = 100  # Default page size of GET /customers
+app.config['CUSTOMERS_MAX_PAGE_SIZE'] = 1000
+app.config['CUSTOMERS_STREAM_BATCH'] = 500  # Rows fetched per round trip when streaming
+app.config['CUSTOMERS_BULK_CHUNK'] = 1000  # Customers inserted per transaction by bulk imports
+app.config['IDEMPOTENCY_TTL'] = 86400  # Seconds a response is replayed for a repeated Idempotency-Key
+app.config['IDEMPOTENCY_LOCK_TIMEOUT'] = 60  # Seconds before an unfinished request's key can be reused
 
 # Initialize extensions
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
 cache = Cache(app)
+profiler = SamplingProfiler(app, url_prefix='/customers')  # Off unless PROFILING_ENABLED is set
+customer_cache = CustomerCache(cache, timeout=app.config['CUSTOMER_CACHE_TIMEOUT'])
+hashing = HashingService(app)
 
 # Set up logging configuration
 logging.basicConfig(
@@ -45,33 +71,211 @@ class Customer(db.Model):
     address = db.Column(db.String(200))
     gender = db.Column(db.String(10))
     marital_status = db.Column(db.String(20))
-    wallet_balance = db.Column(db.Float, default=0.0)
+    opening_balance_cents = db.Column(db.Integer, nullable=False, default=0)  # Live balance is kept in the wallet ledger
+
+    @hybrid_property
+    def wallet_balance(self):
+        """Live wallet balance as a decimal amount."""
+        return from_cents(wallet.balance(object_session(self), self.id))
+
+    @wallet_balance.setter
+    def wallet_balance(self, amount):
+        """Sets the opening balance; only meaningful before the first ledger entry."""
+        self.opening_balance_cents = to_cents(amount)
+
+    @wallet_balance.expression
+    def wallet_balance(cls):
+        return wallet.balance_expression() / 100.0
+
+# Wallet ledger: charges and debits are appended, never applied to the customer row
+class WalletEntry(db.Model):
+    __tablename__ = 'wallet_ledger'
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    amount_cents = db.Column(db.Integer, nullable=False)  # Positive for charges, negative for debits
+    kind = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    __table_args__ = (db.Index('ix_wallet_ledger_customer_id_id', 'customer_id', 'id'),)
+
+# Wallet snapshot: balance of a customer up to and including ledger entry ledger_id
+class WalletSnapshot(db.Model):
+    __tablename__ = 'wallet_snapshot'
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    ledger_id = db.Column(db.Integer, nullable=False)
+    balance_cents = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    __table_args__ = (db.Index('ix_wallet_snapshot_customer_id_ledger_id', 'customer_id', 'ledger_id'),)
+
+# Refresh token registry: one row per issued refresh token, revoked once rotated
+class RefreshToken(db.Model):
+    jti = db.Column(db.String(36), primary_key=True)
+    username = db.Column(db.String(50), nullable=False, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    revoked = db.Column(db.Boolean, nullable=False, default=False)
+
+# Responses of requests sent with an Idempotency-Key, replayed to retries
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_key'
+    key = db.Column(db.LargeBinary(16), primary_key=True)  # Digest of the identity, path and client key
+    request_hash = db.Column(db.LargeBinary(8), nullable=False)
+    status = db.Column(db.Integer)  # None while the first request runs, 0 once its writes committed
+    body = db.Column(db.Text)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    __table_args__ = {'sqlite_with_rowid': False}
+
+idempotency = Idempotency(db.session, IdempotencyKey, ttl=app.config['IDEMPOTENCY_TTL'],
+                          lock_timeout=app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+
+wallet = Wallet(Customer, WalletEntry, WalletSnapshot, snapshot_interval=app.config['WALLET_SNAPSHOT_INTERVAL'])
 
 def validate_email(username):
     """Validates email format for username."""
     pattern = r'^[\w\.-]+@[\w\.-]+\.\w+$'
     return re.match(pattern, username)
 
-# Performance profiling: Start profiling before each request
-@app.before_request
-def start_profiling():
-    """Start profiling the request"""
-    with app.app_context():
-        request.profiler = cProfile.Profile()
-        request.profiler.enable()
-
-# Performance profiling: Stop profiling and log results after each request
-@app.after_request
-def stop_profiling(response):
-    """Stop profiling the request and log the stats"""
-    if hasattr(request, 'profiler'):
-        with app.app_context():
-            request.profiler.disable()
-            s = StringIO()
-            ps = pstats.Stats(request.profiler, stream=s).sort_stats('cumulative')
-            ps.print_stats(10)  # Log top 10 slowest functions
-            app.logger.info(s.getvalue())
-    return response
+# Fields that may be selected from GET /customers (never the password hash)
+CUSTOMER_LIST_FIELDS = ('id', 'username', 'full_name', 'age', 'address', 'gender', 'marital_status', 'wallet_balance')
+DEFAULT_CUSTOMER_LIST_FIELDS = ('id', 'username', 'full_name')
+
+def parse_customer_list_args(args):
+    """
+    Validates the pagination query parameters of GET /customers.
+
+    Returns ``((limit, cursor, fields), None)`` or ``(None, error_message)``.
+    """
+    try:
+        limit = int(args.get('limit', app.config['CUSTOMERS_PAGE_SIZE']))
+        cursor = int(args.get('cursor', 0))
+    except ValueError:
+        return None, "limit and cursor must be integers"
+    if limit <= 0:
+        return None, "limit must be greater than 0"
+    limit = min(limit, app.config['CUSTOMERS_MAX_PAGE_SIZE'])
+
+    fields = DEFAULT_CUSTOMER_LIST_FIELDS
+    if args.get('fields'):
+        fields = tuple(field.strip() for field in args['fields'].split(','))
+        unknown = [field for field in fields if field not in CUSTOMER_LIST_FIELDS]
+        if unknown:
+            return None, f"Unknown fields: {', '.join(unknown)}"
+    return (limit, cursor, fields), None
+
+def customer_profile(customer):
+    """
+    Serializes the cached part of a customer's profile.
+
+    The wallet balance is left out: sales debit it from another service, so
+    GET /customers/<username> reads it live.
+    """
+    return {
+        "id": customer.id,
+        "username": customer.username,
+        "full_name": customer.full_name,
+        "age": customer.age,
+        "address": customer.address,
+        "gender": customer.gender,
+        "marital_status": customer.marital_status,
+    }
+
+
+# Optional profile fields, stored as text
+PROFILE_TEXT_FIELDS = ('full_name', 'address', 'gender', 'marital_status')
+
+# SQLite allows at most 999 bound parameters per statement
+IN_CLAUSE_CHUNK = 500
+
+def import_customers(records):
+    """
+    Validates and inserts many customers at once.
+
+    Usernames are checked for uniqueness with set-based ``IN`` queries,
+    passwords are hashed in parallel by the hashing pool, and rows are inserted
+    in transactions of ``CUSTOMERS_BULK_CHUNK`` rows.
+
+    Returns one result per record, in input order: ``{"row", "username",
+    "status"}`` where status is ``created`` or ``error`` (with a ``message``).
+    """
+    results = []
+    valid = {}  # username -> row index
+    for row, data in enumerate(records):
+        username = data.get('username') if isinstance(data, dict) else None
+        results.append({"row": row, "username": username, "status": "error"})
+        if not username or not data.get('password'):
+            results[row]["message"] = "Username and password are required"
+        elif not isinstance(username, str) or not isinstance(data['password'], str):
+            results[row]["message"] = "Username and password must be strings"
+        elif data.get('age') is not None and (not isinstance(data['age'], int) or isinstance(data['age'], bool)):
+            results[row]["message"] = "Age must be an integer"
+        elif any(data.get(field) is not None and not isinstance(data[field], str) for field in PROFILE_TEXT_FIELDS):
+            results[row]["message"] = f"{', '.join(PROFILE_TEXT_FIELDS)} must be strings"
+        elif not validate_email(username):
+            results[row]["message"] = "Invalid username format. Use an email address."
+        elif username in valid:
+            results[row]["message"] = "Duplicate username in batch"
+        else:
+            valid[username] = row
+
+    usernames = list(valid)
+    for i in range(0, len(usernames), IN_CLAUSE_CHUNK):
+        taken = db.session.query(Customer.username).filter(Customer.username.in_(usernames[i:i + IN_CLAUSE_CHUNK]))
+        for (username,) in taken:
+            results[valid.pop(username)]["message"] = "Username already taken"
+
+    rows = list(valid.values())
+    hashes = hashing.hash_many([records[row]['password'] for row in rows])
+    chunk_size = app.config['CUSTOMERS_BULK_CHUNK']
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        mappings = [{
+            "full_name": records[row].get('full_name'),
+            "username": records[row]['username'],
+            "password": pwhash,
+            "age": records[row].get('age'),
+            "address": records[row].get('address'),
+            "gender": records[row].get('gender'),
+            "marital_status": records[row].get('marital_status'),
+            "opening_balance_cents": 0,
+        } for row, pwhash in zip(chunk, hashes[i:i + chunk_size])]
+        try:
+            db.session.bulk_insert_mappings(Customer, mappings)
+            db.session.commit()
+        except exc.SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error(f"Bulk import chunk failed: {e}")
+            for row in chunk:
+                results[row]["message"] = "Insert failed"
+            continue
+        for row in chunk:
+            results[row]["status"] = "created"
+            results[row].pop("message", None)
+
+    logger.info(f"Bulk import: {len(rows)} of {len(results)} customers processed")
+    return results
+
+def issue_tokens(username):
+    """
+    Creates an access token and a registered refresh token for ``username``.
+
+    Clients renew expired access tokens at /customers/token/refresh instead of
+    logging in again, which skips the expensive password check.
+    """
+    refresh_token = create_refresh_token(identity=username)
+    claims = decode_token(refresh_token)
+    db.session.add(RefreshToken(
+        jti=claims['jti'],
+        username=username,
+        expires_at=datetime.utcfromtimestamp(claims['exp']),
+    ))
+    db.session.commit()
+    return {"token": create_access_token(identity=username), "refresh_token": refresh_token}
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    """Answers 429 when the password hashing pool is saturated."""
+    response = jsonify({"message": "Too many concurrent authentication requests, retry later"})
+    response.headers['Retry-After'] = '1'
+    return response, 429
 
 # Routes
 
@@ -99,7 +303,7 @@ def register_customer():
             return jsonify({"message": "Username already taken"}), 400
 
     # Hash the password
-    hashed_password = generate_password_hash(data['password'])
+    hashed_password = hashing.hash(data['password'])
 
     # Create and add new customer
     new_customer = Customer(
@@ -114,10 +318,36 @@ def register_customer():
     with app.app_context():
         db.session.add(new_customer)
         db.session.commit()
+        customer_cache.set(new_customer.username, customer_profile(new_customer))
 
     logger.info(f"New customer registered: {data['username']}")
     return jsonify({"message": "Customer registered successfully"}), 201
 
+# Register many customers at once
+@app.route('/customers/bulk', methods=['POST'])
+@jwt_required()
+def bulk_register_customers():
+    """
+    Registers many customers in one call.
+
+    Accepts a JSON array of registration payloads, or NDJSON when sent with
+    ``Content-Type: application/x-ndjson``. Invalid rows are reported
+    individually and do not abort the rest of the batch.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            records = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            return jsonify({"message": "Invalid NDJSON body"}), 400
+    else:
+        records = request.get_json()
+    if not isinstance(records, list):
+        return jsonify({"message": "Expected a list of customers"}), 400
+
+    results = import_customers(records)
+    created = sum(1 for result in results if result["status"] == "created")
+    return jsonify({"created": created, "failed": len(results) - created, "results": results}), 200
+
 # Login a customer
 @app.route('/customers/login', methods=['POST'])
 def login():
@@ -130,68 +360,208 @@ def login():
 
     with app.app_context():
         customer = Customer.query.filter_by(username=username).first()
-        if not customer or not check_password_hash(customer.password, password):
+        if not customer or not hashing.check(customer.password, password):
             return jsonify({"message": "Invalid username or password"}), 401
 
-    token = create_access_token(identity=username)
+    tokens = issue_tokens(username)
     logger.info(f"User logged in: {username}")
-    return jsonify({"token": token}), 200
+    return jsonify(tokens), 200
+
+# Rotate a refresh token
+@app.route('/customers/token/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def refresh_tokens():
+    """
+    Exchanges a refresh token for a new access token and refresh token.
+
+    Each refresh token can be used once. Presenting an already rotated token
+    revokes every refresh token of the user, since it means the token leaked.
+    """
+    username = get_jwt_identity()
+    rotated = RefreshToken.query.filter_by(jti=get_jwt()['jti'], revoked=False).update({"revoked": True})
+    if not rotated:
+        RefreshToken.query.filter_by(username=username).update({"revoked": True})
+        db.session.commit()
+        logger.warning(f"Refresh token reuse detected for {username}")
+        return jsonify({"message": "Refresh token has been revoked"}), 401
+
+    tokens = issue_tokens(username)
+    logger.info(f"Tokens refreshed: {username}")
+    return jsonify(tokens), 200
 
 # Charge customer's wallet
 @app.route('/customers/<username>/charge', methods=['POST'])
 @jwt_required()
+@idempotency.idempotent
 def charge_customer(username):
     """
     Charges a customer's wallet with a specified amount.
+
+    Retries sent with the same ``Idempotency-Key`` header get the first
+    response back instead of charging again.
     """
     data = request.get_json()
     amount = data.get('amount', 0)
 
-    with app.app_context():
-        customer = Customer.query.filter_by(username=username).first()
-        if not customer:
-            return jsonify({"message": "Customer not found"}), 404
+    if (not isinstance(amount, (int, float)) or isinstance(amount, bool)
+            or not math.isfinite(amount) or amount <= 0):
+        return jsonify({"message": "Amount must be greater than 0"}), 400
 
-        if amount <= 0:
-            return jsonify({"message": "Amount must be greater than 0"}), 400
+    customer_id = db.session.query(Customer.id).filter_by(username=username).scalar()
+    if customer_id is None:
+        return jsonify({"message": "Customer not found"}), 404
 
-        customer.wallet_balance += amount
-        db.session.commit()
-        logger.info(f"${amount} charged to {username}'s wallet")
-        return jsonify({"message": f"${amount} charged to {username}'s wallet"}), 200
+    # Appended to the wallet ledger; the customer row itself is never updated.
+    balance = wallet.credit(db.session, customer_id, to_cents(amount), kind='charge')
+    db.session.commit()
+
+    logger.info(f"${amount} charged to {username}'s wallet")
+    return jsonify({"message": f"${amount} charged to {username}'s wallet", "wallet_balance": from_cents(balance)}), 200
 
 # Get customer data
 @app.route('/customers/<username>', methods=['GET'])
-@cache.cached(timeout=60)  # Cache for 60 seconds
 def get_customer(username):
     """
     Fetches customer by username.
+
+    The profile is served from the customer cache, which registration writes
+    through; the wallet balance is read live from the wallet ledger.
     """
-    with app.app_context():
+    profile = customer_cache.get(username)
+    if profile is None:
         customer = Customer.query.filter_by(username=username).first()
-        if customer:
-            return jsonify({
-                "id": customer.id,
-                "username": customer.username,
-                "full_name": customer.full_name,
-                "age": customer.age,
-                "address": customer.address,
-                "gender": customer.gender,
-                "marital_status": customer.marital_status,
-                "wallet_balance": customer.wallet_balance
-            }), 200
-    return jsonify({"message": "Customer not found"}), 404
+        if not customer:
+            return jsonify({"message": "Customer not found"}), 404
+        profile = customer_profile(customer)
+        customer_cache.set(username, profile)
+
+    balance = wallet.balance(db.session, profile["id"])
+    if balance is None:
+        customer_cache.invalidate(username)
+        return jsonify({"message": "Customer not found"}), 404
+    return jsonify(dict(profile, wallet_balance=from_cents(balance))), 200
+
+# Customer cache statistics
+@app.route('/customers/admin/cache', methods=['GET'])
+@admin_required
+def customer_cache_stats():
+    """
+    Returns the hit/miss counters of the customer cache.
+    """
+    return jsonify(customer_cache.stats()), 200
 
 # Get all customers
 @app.route('/customers', methods=['GET'])
 def get_all_customers():
     """
-    Fetches all customers.
+    Fetches customers ordered by id, one page at a time.
+
+    Query parameters:
+        limit: Page size (defaults to ``CUSTOMERS_PAGE_SIZE``, capped at ``CUSTOMERS_MAX_PAGE_SIZE``).
+        cursor: Id of the last customer of the previous page.
+        fields: Comma-separated subset of the customer fields to return.
+        format: ``ndjson`` streams every customer after ``cursor``, one JSON object per line.
+
+    The id to pass as ``cursor`` for the next page is returned in the
+    ``X-Next-Cursor`` header; it is absent on the last page.
     """
-    with app.app_context():
-        customers = Customer.query.all()
-        customer_list = [{"id": customer.id, "username": customer.username, "full_name": customer.full_name} for customer in customers]
-    return jsonify(customer_list)
+    args, error = parse_customer_list_args(request.args)
+    if error:
+        return jsonify({"message": error}), 400
+    limit, cursor, fields = args
+
+    # The id is always selected (first column) so the next cursor can be built.
+    columns = [Customer.id] + [getattr(Customer, field) for field in fields]
+    query = Customer.query.with_entities(*columns).order_by(Customer.id)
+
+    if request.args.get('format') == 'ndjson':
+        # One short keyset query per batch: memory stays flat and no read
+        # statement stays open (holding SQLite's lock) while the client reads.
+        batch_size = app.config['CUSTOMERS_STREAM_BATCH']
+
+        def generate(after):
+            while True:
+                rows = query.filter(Customer.id > after).limit(batch_size).all()
+                for row in rows:
+                    yield json.dumps(dict(zip(fields, row[1:]))) + '\n'
+                if len(rows) < batch_size:
+                    return
+                after = rows[-1][0]
+
+        return Response(stream_with_context(generate(cursor)), mimetype='application/x-ndjson')
+
+    query = query.filter(Customer.id > cursor)
+    rows = query.limit(limit + 1).all()
+    response = jsonify([dict(zip(fields, row[1:])) for row in rows[:limit]])
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = str(rows[limit - 1][0])
+    return response
+
+def read_customer_file(path):
+    """Yields customer records from an NDJSON or CSV file."""
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            for record in csv.DictReader(f):
+                record = {key: value or None for key, value in record.items()}
+                if record.get('age'):
+                    try:
+                        record['age'] = int(record['age'])
+                    except ValueError:
+                        pass  # Reported as a row error by import_customers
+                yield record
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+@app.cli.command('import-customers')
+@click.argument('path')
+@click.option('--batch-size', default=10000, help='Records read and imported per batch.')
+def import_customers_command(path, batch_size):
+    """Bulk imports customers from an NDJSON or CSV file."""
+    created = failed = 0
+    records = read_customer_file(path)
+    while True:
+        batch = [record for _, record in zip(range(batch_size), records)]
+        if not batch:
+            break
+        for result in import_customers(batch):
+            if result["status"] == "created":
+                created += 1
+            else:
+                failed += 1
+                click.echo(f"{result['username']}: {result['message']}", err=True)
+    click.echo(f"Imported {created} customers, {failed} failed")
+
+@app.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    """Deletes expired idempotency keys, one batch per transaction."""
+    total = 0
+    while True:
+        deleted = idempotency.purge()
+        total += deleted
+        if deleted < 1000:
+            break
+    click.echo(f"Purged {total} idempotency keys")
+
+@app.cli.command('migrate-wallets')
+def migrate_wallets_command():
+    """
+    Upgrades an existing database to the wallet ledger without losing balances.
+
+    Adds opening_balance_cents to the customer table, fills it from the old
+    wallet_balance column and creates the ledger and snapshot tables.
+    """
+    filled = wallet.migrate(db.session)
+    db.session.commit()
+    click.echo(f"Migrated {filled} wallets")
+
+@app.cli.command('snapshot-wallets')
+def snapshot_wallets_command():
+    """Snapshots the balance of every wallet with a long ledger tail."""
+    count = wallet.snapshot_due(db.session)
+    db.session.commit()
+    click.echo(f"Snapshotted {count} wallets")
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001)
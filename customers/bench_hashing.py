@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+from customers.hashing import HashingService
+
+def run_logins(check, pwhash, logins, threads):
+    """
+    Runs ``logins`` password checks from ``threads`` request threads and returns logins/sec.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(lambda _: check(pwhash, "securepassword123"), range(logins)))
+    elapsed = time.perf_counter() - start
+    assert all(results)
+    return logins / elapsed
+
+def run_hashing_benchmark(logins=200, threads=16):
+    """
+    Compares inline password checks against the hashing process pool.
+    """
+    pwhash = generate_password_hash("securepassword123")
+    cores = os.cpu_count() or 1
+    print(f"Benchmarking {logins} logins from {threads} threads on {cores} cores...")
+
+    service = HashingService()
+    service.configure(workers=0, queue_limit=0)
+    inline = run_logins(service.check, pwhash, logins, threads)
+    print(f"inline:            {inline:8.1f} logins/sec  ({inline:8.1f} per core used)")
+
+    for workers in sorted({1, max(cores // 2, 1), cores}):
+        service.configure(workers=workers, queue_limit=threads)
+        rate = run_logins(service.check, pwhash, logins, threads)
+        print(f"pool ({workers:2d} workers): {rate:8.1f} logins/sec  ({rate / workers:8.1f} per core used)")
+    service.shutdown()
+
+if __name__ == "__main__":
+    run_hashing_benchmark(*(int(arg) for arg in sys.argv[1:3]))
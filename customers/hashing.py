@@ -0,0 +1,121 @@
+"""
+Bounded process pool for password hashing.
+
+Password hashing is deliberately CPU-expensive; running it on the request
+thread holds the GIL and starves every other endpoint of the service. The
+:class:`HashingService` runs hashes in worker processes and admits at most
+``workers + queue_limit`` in-flight jobs, raising :class:`HashingBusy` when
+saturated so the caller can answer 429 instead of queueing without bound.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool has no free slot."""
+
+
+class HashingService:
+    """
+    Process-pool backed password hashing with a bounded queue.
+
+    Configuration (read from ``app.config``):
+        HASH_POOL_WORKERS: Worker processes (defaults to the CPU count, 0 hashes inline).
+        HASH_POOL_QUEUE_LIMIT: Jobs allowed to wait for a worker before rejecting.
+        HASH_POOL_TIMEOUT: Seconds a request waits for its hash result.
+    """
+
+    def __init__(self, app=None):
+        self.workers = 0
+        self.timeout = None
+        self._slots = None
+        self._executor = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Reads the pool configuration from ``app``."""
+        app.config.setdefault('HASH_POOL_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('HASH_POOL_QUEUE_LIMIT', 4 * app.config['HASH_POOL_WORKERS'])
+        app.config.setdefault('HASH_POOL_TIMEOUT', 30)
+        self.configure(app.config['HASH_POOL_WORKERS'],
+                       app.config['HASH_POOL_QUEUE_LIMIT'],
+                       app.config['HASH_POOL_TIMEOUT'])
+
+    def configure(self, workers, queue_limit, timeout=None):
+        """(Re)sizes the pool; a running pool is shut down first."""
+        self.shutdown()
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + queue_limit) if workers else None
+
+    def _pool(self):
+        # Created lazily so worker processes are not forked at import time.
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def submit(self, fn, *args, block=False):
+        """
+        Schedules ``fn(*args)`` on the pool and returns its future.
+
+        With ``block`` the call waits up to ``timeout`` seconds for a free slot.
+
+        Raises:
+            HashingBusy: If every worker and queue slot is taken.
+        """
+        if not self._slots.acquire(blocking=block, timeout=self.timeout if block else None):
+            raise HashingBusy()
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def hash(self, password):
+        """Returns the salted hash of ``password``."""
+        if not self.workers:
+            return generate_password_hash(password)
+        return self.submit(generate_password_hash, password).result(self.timeout)
+
+    def check(self, pwhash, password):
+        """Returns whether ``password`` matches ``pwhash``."""
+        if not self.workers:
+            return check_password_hash(pwhash, password)
+        return self.submit(check_password_hash, pwhash, password).result(self.timeout)
+
+    def hash_many(self, passwords, chunk_size=64):
+        """
+        Hashes ``passwords`` in parallel and returns the hashes in order.
+
+        Passwords are shipped to the workers in chunks, each chunk holding a
+        single queue slot, and the call waits for free slots rather than
+        failing, which suits batch imports.
+        """
+        if not self.workers:
+            return hash_passwords(passwords)
+        # Small batches are still spread over every worker.
+        chunk_size = max(1, min(chunk_size, -(-len(passwords) // self.workers)))
+        futures = [self.submit(hash_passwords, passwords[i:i + chunk_size], block=True)
+                   for i in range(0, len(passwords), chunk_size)]
+        return [pwhash for future in futures for pwhash in future.result(self.timeout)]
+
+    def shutdown(self):
+        """Stops the worker processes, if any were started."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+def hash_passwords(passwords):
+    """Hashes a list of passwords (module-level so it can run in a worker)."""
+    return [generate_password_hash(password) for password in passwords]
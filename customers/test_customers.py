@@ -1,5 +1,10 @@
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pytest
-from customers.app import app, db, Customer
+from customers.app import (app, db, cache, customer_cache, hashing, issue_tokens, wallet,
+                           Customer, IdempotencyKey, RefreshToken, WalletEntry, WalletSnapshot)
 from flask_jwt_extended import create_access_token
 
 @pytest.fixture
@@ -14,6 +19,7 @@ def client():
     # Create tables before each test
     with app.app_context():
         db.create_all()
+        cache.clear()
 
     yield client
 
@@ -150,3 +156,399 @@ def test_charge_customer_not_found(client, auth_header):
     }, headers=auth_header)
     assert response.status_code == 404
     assert b"Customer not found" in response.data
+
+def test_charge_customer_rejects_non_finite_and_bool_amounts(client, auth_header):
+    """
+    Test that NaN, Infinity and booleans are not charged.
+    """
+    add_customers(1)
+    for body in ('{"amount": NaN}', '{"amount": Infinity}', '{"amount": true}'):
+        response = client.post('/customers/user0@example.com/charge', headers=auth_header,
+                               data=body, content_type='application/json')
+        assert response.status_code == 400
+    with app.app_context():
+        assert WalletEntry.query.count() == 0
+
+def test_charge_customer_idempotency_key(client, auth_header):
+    """
+    Test that a retried charge with the same Idempotency-Key is replayed, not charged twice.
+    """
+    client.post('/customers/register', json={
+        "full_name": "Test User",
+        "username": "testuser@example.com",
+        "password": "securepassword123"
+    })
+    headers = {**auth_header, "Idempotency-Key": "charge-1"}
+    first = client.post('/customers/testuser@example.com/charge', json={"amount": 50.0}, headers=headers)
+    retry = client.post('/customers/testuser@example.com/charge', json={"amount": 50.0}, headers=headers)
+    assert retry.status_code == 200
+    assert retry.data == first.data
+    assert retry.headers["Idempotent-Replayed"] == "true"
+
+    response = client.post('/customers/testuser@example.com/charge', json={"amount": 20.0}, headers=headers)
+    assert response.status_code == 422
+    response = client.post('/customers/testuser@example.com/charge', json={"amount": 50.0},
+                           headers={**auth_header, "Idempotency-Key": "charge-2"})
+    assert response.get_json()["wallet_balance"] == 100.0
+    with app.app_context():
+        assert WalletEntry.query.count() == 2
+        assert IdempotencyKey.query.count() == 2
+
+def test_charge_failing_after_commit_is_not_retried(client, auth_header, monkeypatch):
+    """
+    Test that a charge failing before its commit can be retried, but one failing after it cannot.
+    """
+    client.post('/customers/register', json={
+        "full_name": "Test User",
+        "username": "testuser@example.com",
+        "password": "securepassword123"
+    })
+    headers = {**auth_header, "Idempotency-Key": "charge-1"}
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(wallet, 'credit', fail)  # Before the commit: nothing written
+        with pytest.raises(RuntimeError):
+            client.post('/customers/testuser@example.com/charge', json={"amount": 50.0}, headers=headers)
+    with monkeypatch.context() as patch:
+        patch.setattr('customers.app.from_cents', fail)  # After the commit
+        with pytest.raises(RuntimeError):
+            client.post('/customers/testuser@example.com/charge', json={"amount": 50.0}, headers=headers)
+
+    retry = client.post('/customers/testuser@example.com/charge', json={"amount": 50.0}, headers=headers)
+    assert retry.status_code == 409
+    with app.app_context():
+        assert WalletEntry.query.count() == 1
+
+def add_customers(count):
+    """
+    Inserts ``count`` customers directly, bypassing password hashing.
+    """
+    with app.app_context():
+        for i in range(count):
+            db.session.add(Customer(full_name=f"User {i}", username=f"user{i}@example.com", password="x", age=20 + i))
+        db.session.commit()
+
+def test_get_all_customers_paginated(client):
+    """
+    Test walking the customer list with the keyset cursor.
+    """
+    add_customers(5)
+    response = client.get('/customers?limit=2')
+    assert response.status_code == 200
+    assert [c["username"] for c in response.get_json()] == ["user0@example.com", "user1@example.com"]
+    cursor = response.headers['X-Next-Cursor']
+
+    response = client.get(f'/customers?limit=2&cursor={cursor}')
+    assert [c["username"] for c in response.get_json()] == ["user2@example.com", "user3@example.com"]
+    cursor = response.headers['X-Next-Cursor']
+
+    response = client.get(f'/customers?limit=2&cursor={cursor}')
+    assert [c["username"] for c in response.get_json()] == ["user4@example.com"]
+    assert 'X-Next-Cursor' not in response.headers
+
+def test_get_all_customers_fields(client):
+    """
+    Test selecting a subset of the customer fields.
+    """
+    add_customers(1)
+    response = client.get('/customers?fields=username,age')
+    assert response.get_json() == [{"username": "user0@example.com", "age": 20}]
+
+    response = client.get('/customers?fields=username,password')
+    assert response.status_code == 400
+    assert b"Unknown fields: password" in response.data
+
+def test_get_all_customers_invalid_limit(client):
+    """
+    Test rejecting malformed pagination parameters.
+    """
+    assert client.get('/customers?limit=abc').status_code == 400
+    assert client.get('/customers?limit=0').status_code == 400
+
+def test_get_all_customers_ndjson(client):
+    """
+    Test streaming every customer after the cursor as NDJSON.
+    """
+    add_customers(3)
+    response = client.get('/customers?format=ndjson&cursor=1&fields=id,username')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = response.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"id": 2, "username": "user1@example.com"},
+        {"id": 3, "username": "user2@example.com"},
+    ]
+
+def test_ndjson_stream_does_not_block_writers(client, monkeypatch):
+    """
+    Test that other connections can write while an NDJSON stream is half read.
+    """
+    add_customers(5)
+    monkeypatch.setitem(app.config, 'CUSTOMERS_STREAM_BATCH', 2)
+    response = client.get('/customers?format=ndjson&fields=id', buffered=False)
+    chunks = response.iter_encoded()
+    first = next(chunks)
+    with app.app_context():
+        writer = sqlite3.connect(db.engine.url.database, timeout=0)
+    writer.execute("UPDATE customer SET age = 99 WHERE id = 5")
+    writer.commit()
+    writer.close()
+    body = first + b"".join(chunks)
+    response.close()
+    assert [json.loads(line)["id"] for line in body.splitlines()] == [1, 2, 3, 4, 5]
+
+def test_get_customer_cached_after_charge(client, auth_header):
+    """
+    Test that a cached profile reflects wallet charges immediately.
+    """
+    client.post('/customers/register', json={
+        "full_name": "Test User",
+        "username": "testuser@example.com",
+        "password": "securepassword123"
+    })
+    assert client.get('/customers/testuser@example.com').get_json()["wallet_balance"] == 0.0
+
+    client.post('/customers/testuser@example.com/charge', json={"amount": 25.0}, headers=auth_header)
+    response = client.get('/customers/testuser@example.com')
+    assert response.get_json()["wallet_balance"] == 25.0
+    hits = customer_cache.hits
+    response = client.get('/customers/testuser@example.com')
+    assert response.get_json()["wallet_balance"] == 25.0
+    assert customer_cache.hits == hits + 1
+
+def test_get_customer_reads_balance_live(client):
+    """
+    Test that a cached profile shows wallet debits made by another service without invalidation.
+    """
+    add_customers(1)
+    client.get('/customers/user0@example.com')
+    with app.app_context():
+        customer = Customer.query.filter_by(username="user0@example.com").first()
+        opening = customer.wallet_balance
+        wallet.credit(db.session, customer.id, 5000, kind='charge')
+        wallet.debit(db.session, customer.id, 1500, kind='sale')  # As the sales service does
+        db.session.commit()
+    response = client.get('/customers/user0@example.com')
+    assert response.get_json()["wallet_balance"] == opening + 35.0
+
+def test_customer_cache_stats(client, auth_header, monkeypatch):
+    """
+    Test the customer cache hit/miss counters endpoint, which only admins may read.
+    """
+    assert client.get('/customers/admin/cache', headers=auth_header).status_code == 403
+    monkeypatch.setitem(app.config, 'ADMIN_USERNAMES', ["testuser@example.com"])
+    add_customers(1)
+    client.get('/customers/user0@example.com')
+    client.get('/customers/user0@example.com')
+    response = client.get('/customers/admin/cache', headers=auth_header)
+    assert response.status_code == 200
+    stats = response.get_json()
+    assert stats["hits"] >= 1 and stats["misses"] >= 1
+
+def test_login_hashing_pool_saturated(client):
+    """
+    Test that logins are rejected with 429 while the hashing pool is full.
+    """
+    add_customers(1)
+    hashing.configure(workers=1, queue_limit=0, timeout=30)
+    try:
+        busy = hashing.submit(time.sleep, 1)
+        response = client.post('/customers/login', json={
+            "username": "user0@example.com",
+            "password": "x"
+        })
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '1'
+        busy.result()
+    finally:
+        hashing.init_app(app)
+
+def test_bulk_register_customers(client, auth_header):
+    """
+    Test bulk registration with per-row results.
+    """
+    add_customers(1)
+    response = client.post('/customers/bulk', headers=auth_header, json=[
+        {"username": "new1@example.com", "password": "pw1", "full_name": "New One"},
+        {"username": "user0@example.com", "password": "pw"},
+        {"username": "invalid-email", "password": "pw"},
+        {"username": "new1@example.com", "password": "pw"},
+        {"username": "new2@example.com"},
+        {"username": "new2@example.com", "password": "pw2", "age": 40},
+    ])
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["created"] == 2 and data["failed"] == 4
+    assert [r["status"] for r in data["results"]] == ["created", "error", "error", "error", "error", "created"]
+    assert data["results"][1]["message"] == "Username already taken"
+    assert data["results"][3]["message"] == "Duplicate username in batch"
+
+    response = client.post('/customers/login', json={"username": "new2@example.com", "password": "pw2"})
+    assert response.status_code == 200
+
+def test_bulk_register_customers_rejects_non_string_fields(client, auth_header):
+    """
+    Test that a non-string password or username fails only its own row.
+    """
+    response = client.post('/customers/bulk', headers=auth_header, json=[
+        {"username": "new1@example.com", "password": 1234},
+        {"username": 42, "password": "pw"},
+        {"username": "new2@example.com", "password": "pw", "age": "forty"},
+        {"username": "new3@example.com", "password": "pw"},
+        {"username": "new4@example.com", "password": "pw", "full_name": {"a": 1}},
+        {"username": "new5@example.com", "password": "pw", "address": ["x"]},
+    ])
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["created"] == 1 and data["failed"] == 5
+    assert [r["message"] for r in data["results"][:3]] == [
+        "Username and password must be strings", "Username and password must be strings", "Age must be an integer"]
+    assert data["results"][4]["message"] == data["results"][5]["message"] == \
+        "full_name, address, gender, marital_status must be strings"
+
+def test_bulk_register_customers_ndjson(client, auth_header):
+    """
+    Test bulk registration from an NDJSON body.
+    """
+    body = '{"username": "a@example.com", "password": "pw"}\n{"username": "b@example.com", "password": "pw"}\n'
+    response = client.post('/customers/bulk', headers=auth_header, data=body, content_type='application/x-ndjson')
+    assert response.get_json()["created"] == 2
+
+def test_import_customers_command(client, tmp_path):
+    """
+    Test the CSV bulk import CLI command.
+    """
+    path = tmp_path / "customers.csv"
+    path.write_text("username,password,full_name,age\nc1@example.com,pw,C One,31\nbad,pw,,\n"
+                    "c2@example.com,pw,C Two,thirty\n")
+    result = app.test_cli_runner().invoke(args=['import-customers', str(path)])
+    assert "Imported 1 customers, 2 failed" in result.output
+    assert "c2@example.com: Age must be an integer" in result.output
+    with app.app_context():
+        assert Customer.query.filter_by(username="c1@example.com").first().age == 31
+
+def test_charge_customer_concurrent(client, auth_header):
+    """
+    Test that concurrent charges to one wallet never lose an update.
+    """
+    add_customers(1)
+    threads, charges = 8, 25
+
+    def charge_many():
+        thread_client = app.test_client()
+        for _ in range(charges):
+            response = thread_client.post('/customers/user0@example.com/charge', json={"amount": 0.1}, headers=auth_header)
+            assert response.status_code == 200
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for future in [pool.submit(charge_many) for _ in range(threads)]:
+            future.result()
+
+    with app.app_context():
+        customer = Customer.query.filter_by(username="user0@example.com").first()
+        assert customer.wallet_balance == threads * charges * 0.1
+
+def test_wallet_ledger_snapshots(client, auth_header):
+    """
+    Test that charges are appended to the ledger and periodically snapshotted.
+    """
+    add_customers(1)
+    wallet.snapshot_interval = 3
+    try:
+        for amount in [1, 2, 3, 4, 5, 6, 7]:
+            response = client.post('/customers/user0@example.com/charge', json={"amount": amount}, headers=auth_header)
+        assert response.get_json()["wallet_balance"] == 28.0
+    finally:
+        wallet.snapshot_interval = app.config['WALLET_SNAPSHOT_INTERVAL']
+
+    with app.app_context():
+        assert WalletEntry.query.count() == 7
+        snapshots = WalletSnapshot.query.order_by(WalletSnapshot.ledger_id).all()
+        assert [(s.ledger_id, s.balance_cents) for s in snapshots] == [(3, 600), (6, 2100)]
+        assert Customer.query.first().opening_balance_cents == 0
+    assert client.get('/customers/user0@example.com').get_json()["wallet_balance"] == 28.0
+    response = client.get('/customers?fields=username,wallet_balance')
+    assert response.get_json() == [{"username": "user0@example.com", "wallet_balance": 28.0}]
+
+def test_snapshot_wallets_command(client, auth_header):
+    """
+    Test the periodic wallet snapshot CLI command.
+    """
+    add_customers(2)
+    client.post('/customers/user0@example.com/charge', json={"amount": 5}, headers=auth_header)
+    wallet.snapshot_interval = 1
+    try:
+        result = app.test_cli_runner().invoke(args=['snapshot-wallets'])
+    finally:
+        wallet.snapshot_interval = app.config['WALLET_SNAPSHOT_INTERVAL']
+    assert "Snapshotted 1 wallets" in result.output
+    with app.app_context():
+        assert WalletSnapshot.query.one().balance_cents == 500
+
+def test_migrate_wallets_command(client, auth_header):
+    """
+    Test upgrading a customer table that still stores wallet_balance as an amount.
+    """
+    with app.app_context():
+        db.drop_all()
+        db.session.execute(db.text(
+            "CREATE TABLE customer (id INTEGER PRIMARY KEY, full_name VARCHAR(100), "
+            "username VARCHAR(50) NOT NULL UNIQUE, password VARCHAR(255) NOT NULL, age INTEGER, "
+            "address VARCHAR(200), gender VARCHAR(10), marital_status VARCHAR(20), wallet_balance FLOAT)"))
+        db.session.execute(db.text(
+            "INSERT INTO customer (username, password, wallet_balance) VALUES ('old@example.com', 'x', 12.34)"))
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    assert "Migrated 1 wallets" in runner.invoke(args=['migrate-wallets']).output
+    assert "Migrated 0 wallets" in runner.invoke(args=['migrate-wallets']).output
+    assert client.get('/customers/old@example.com').get_json()["wallet_balance"] == 12.34
+    response = client.post('/customers/old@example.com/charge', json={"amount": 1}, headers=auth_header)
+    assert response.get_json()["wallet_balance"] == 13.34
+
+def test_refresh_token_rotation(client):
+    """
+    Test exchanging a refresh token and rejecting its reuse.
+    """
+    add_customers(1)
+    with app.app_context():
+        tokens = issue_tokens("user0@example.com")
+    refresh_header = {"Authorization": f"Bearer {tokens['refresh_token']}"}
+
+    response = client.post('/customers/token/refresh', headers=refresh_header)
+    assert response.status_code == 200
+    rotated = response.get_json()
+    assert rotated["token"] and rotated["refresh_token"] != tokens["refresh_token"]
+
+    # Replaying the rotated token revokes the whole family, including the new one
+    response = client.post('/customers/token/refresh', headers=refresh_header)
+    assert response.status_code == 401
+    response = client.post('/customers/token/refresh', headers={"Authorization": f"Bearer {rotated['refresh_token']}"})
+    assert response.status_code == 401
+
+def test_refresh_requires_refresh_token(client, auth_header):
+    """
+    Test that access tokens cannot be used to refresh.
+    """
+    response = client.post('/customers/token/refresh', headers=auth_header)
+    assert response.status_code == 422
+
+def test_login_returns_refresh_token(client):
+    """
+    Test that login issues a registered refresh token.
+    """
+    client.post('/customers/register', json={
+        "username": "testlogin@example.com",
+        "password": "securepassword123"
+    })
+    response = client.post('/customers/login', json={
+        "username": "testlogin@example.com",
+        "password": "securepassword123"
+    })
+    assert response.status_code == 200
+    assert response.get_json()["refresh_token"]
+    with app.app_context():
+        assert RefreshToken.query.filter_by(username="testlogin@example.com").count() == 1
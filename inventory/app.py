@@ -1,25 +1,49 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, exc, literal_column, tuple_
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-import cProfile
-import pstats
-from io import StringIO
 from memory_profiler import profile
+import csv
+import gzip
+import io
+import json
 import logging
+import time
+import urllib.request
+import zlib
+import click
 from flask_caching import Cache
+from common.catalog import VersionedResponses, bump_version, current_version, versioned_table
+from common.identity import admin_usernames
+from common.profiling import SamplingProfiler
+from common import reservations, stock
+from inventory import search
 
 # Initialize the app and database
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///C:\\Users\\nsucc\\Desktop\\python env\\ecommerce_AbiRizk_Succar\\database\\database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = 'YourSecretKey'  # Change this to a secure key
+app.config['ADMIN_USERNAMES'] = admin_usernames()  # JWT subjects allowed on /admin endpoints
 app.config['CACHE_TYPE'] = 'simple'  # You can change this to 'redis' for better performance
 app.config['CACHE_DEFAULT_TIMEOUT'] = 300  # Cache timeout in seconds
+app.config['INVENTORY_BULK_CHUNK'] = 1000  # Rows applied per transaction by bulk upserts
+app.config['INVENTORY_PAGE_SIZE'] = 100  # Default page size of GET /inventory
+app.config['INVENTORY_MAX_PAGE_SIZE'] = 1000
+app.config['INVENTORY_STREAM_BATCH'] = 1000  # Rows fetched and written per chunk by exports
+app.config['CHANGE_FEED_PAGE_SIZE'] = 1000  # Changes returned per poll of the change feed
+app.config['CHANGE_FEED_MAX_WAIT'] = 30  # Longest long-poll, in seconds
+app.config['CHANGE_FEED_POLL_INTERVAL'] = 0.5  # Seconds between checks for new changes
+app.config['CHANGE_FEED_STREAM_TIMEOUT'] = 300  # Seconds an SSE stream lasts before the client reconnects
+app.config['LOW_STOCK_WEBHOOK_URL'] = None  # POSTed pending low-stock alerts when set
+app.config['RESERVATION_TTL'] = 600  # Seconds a checkout holds reserved stock
+app.config['RESERVATION_SWEEP_BATCH'] = 1000  # Expired holds released per sweep
 
 # Initialize extensions
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
 cache = Cache(app)
+profiler = SamplingProfiler(app, url_prefix='/inventory')  # Off unless PROFILING_ENABLED is set
 
 # Set up logging configuration
 logging.basicConfig(
@@ -44,27 +68,264 @@ class User(db.Model):
 class Inventory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    category = db.Column(db.String(50), nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    category = db.Column(db.String(50), nullable=False, index=True)
+    price = db.Column(db.Float, nullable=False, index=True)
     description = db.Column(db.String(255))
+    count = db.Column(db.Integer, nullable=False, index=True)
+    reorder_threshold = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    __table_args__ = (
+        # Serves category filters combined with price ranges or price ordering
+        db.Index('ix_inventory_category_price', 'category', 'price'),
+        # In-stock items in id order, for in_stock listings paged by id
+        db.Index('ix_inventory_in_stock', 'id', sqlite_where=literal_column('count > 0')),
+        # The low-stock set: kept up to date by SQLite on every write to
+        # count or reorder_threshold, from this service or from sales
+        db.Index('ix_inventory_low_stock', 'id', sqlite_where=literal_column('count <= reorder_threshold')),
+    )
+
+search.install_fts(Inventory.__table__)  # inventory_fts follows every insert, update and delete
+
+# Outbox of items that fell to their reorder threshold, filled by a trigger
+class LowStockAlert(db.Model):
+    __tablename__ = 'low_stock_alert'
+    id = db.Column(db.Integer, primary_key=True)
+    inventory_id = db.Column(db.Integer, nullable=False)
     count = db.Column(db.Integer, nullable=False)
+    reorder_threshold = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
+    sent_at = db.Column(db.DateTime, index=True)
+
+# Fills the outbox; created with the table, or by migrate-inventory on older databases
+LOW_STOCK_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS inventory_low_stock_{_event.split()[0].lower()} "
+    f"AFTER {_event} ON inventory WHEN {_crossed} BEGIN "
+    f"INSERT INTO low_stock_alert (inventory_id, count, reorder_threshold) "
+    f"VALUES (new.id, new.count, new.reorder_threshold); END"
+    for _event, _crossed in (
+        ('INSERT', 'new.count <= new.reorder_threshold'),
+        ('UPDATE OF count, reorder_threshold',
+         'new.count <= new.reorder_threshold AND old.count > old.reorder_threshold'))
+]
+for _trigger in LOW_STOCK_TRIGGERS:
+    event.listen(Inventory.__table__, 'after_create', DDL(_trigger).execute_if(dialect='sqlite'))
+
+# Append-only log of inventory changes, filled by triggers on every write
+class InventoryChange(db.Model):
+    __tablename__ = 'inventory_change'
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    inventory_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(6), nullable=False)  # insert, update or delete
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
+    __table_args__ = {'sqlite_autoincrement': True}  # Sequence numbers are never reused
+
+# Fills the change feed; created with the table, or by migrate-inventory on older databases
+CHANGE_TRIGGERS = [
+    f"CREATE TRIGGER IF NOT EXISTS inventory_change_{_op} AFTER {_op.upper()} ON inventory BEGIN "
+    f"INSERT INTO inventory_change (inventory_id, op) VALUES ({_row}.id, '{_op}'); END"
+    for _op, _row in (('insert', 'new'), ('update', 'new'), ('delete', 'old'))
+]
+for _trigger in CHANGE_TRIGGERS:
+    event.listen(Inventory.__table__, 'after_create', DDL(_trigger).execute_if(dialect='sqlite'))
+
+# Stock held for a checkout; the units are already taken out of Inventory.count
+class Reservation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    holder = db.Column(db.String(50), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# Catalog version: bumped by every write to the inventory, backs the listing ETags
+@versioned_table
+class CatalogVersion(db.Model):
+    __tablename__ = 'catalog_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+catalog_responses = VersionedResponses()
+search_responses = VersionedResponses()
+
+# Columns that may be set through the API
+ITEM_FIELDS = ('name', 'category', 'price', 'description', 'count', 'reorder_threshold')
+
+def validate_item(data, partial=False):
+    """
+    Validates an inventory payload; ``partial`` payloads only update some fields.
+
+    Returns an error message, or ``None`` if the payload is valid.
+    """
+    if not isinstance(data, dict):
+        return "Item must be an object"
+    if not partial and not all(key in data for key in ['name', 'category', 'price', 'count']):
+        return "Missing required fields"
+    if 'id' in data and not is_integer(data['id']):
+        return "Id must be an integer"
+    for field in ('name', 'category'):
+        if field in data and not isinstance(data[field], str):
+            return f"{field.capitalize()} must be a string"
+    if data.get('description') is not None and not isinstance(data['description'], str):
+        return "Description must be a string"
+    if 'price' in data and (not isinstance(data['price'], (int, float)) or isinstance(data['price'], bool)
+                            or data['price'] <= 0):
+        return "Price must be a positive number"
+    if 'count' in data and (not is_integer(data['count']) or data['count'] < 0):
+        return "Count must be a non-negative integer"
+    if 'reorder_threshold' in data and (not is_integer(data['reorder_threshold']) or data['reorder_threshold'] < 0):
+        return "Reorder threshold must be a non-negative integer"
+    return None
+
+def is_integer(value):
+    """True for ints, but not bools."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def upsert_items(records, insert_missing=False):
+    """
+    Inserts or updates inventory items in chunked bulk transactions.
+
+    Records carrying an ``id`` update that item (only the given fields),
+    the others are inserted and validated like ``add_goods``. With
+    ``insert_missing``, records whose ``id`` does not exist yet are inserted
+    under that id, which restores an export. ``records`` may be any
+    iterable, so NDJSON and CSV streams are applied chunk by chunk without
+    being loaded whole.
+
+    Returns ``{"inserted", "updated", "failed", "errors"}`` where ``errors``
+    lists ``{"row", "message"}`` for every rejected record.
+    """
+    summary = {"inserted": 0, "updated": 0, "failed": 0, "errors": []}
+    chunk = []
+    for row, data in enumerate(records):
+        chunk.append((row, data))
+        if len(chunk) >= app.config['INVENTORY_BULK_CHUNK']:
+            _apply_chunk(chunk, summary, insert_missing)
+            chunk = []
+    if chunk:
+        _apply_chunk(chunk, summary, insert_missing)
+    summary["failed"] = len(summary["errors"])
+    return summary
+
+def read_ndjson(stream):
+    """Yields one record per non-empty line of an NDJSON byte stream; bad lines yield ``None``."""
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+# Content types of streamed imports and exports
+STREAM_FORMATS = {'application/x-ndjson': 'ndjson', 'text/csv': 'csv'}
+EXPORT_MIMETYPES = {fmt: mimetype for mimetype, fmt in STREAM_FORMATS.items()}
+
+# Column types of CSV imports, whose cells are all strings
+CSV_TYPES = {'id': int, 'price': float, 'count': int, 'reorder_threshold': int}
+
+def read_csv(stream):
+    """
+    Yields one record per row of a CSV byte stream with a header; bad rows yield ``None``.
+
+    Cells missing from short rows are left out, so the row fails validation
+    like any record without those fields.
+    """
+    for record in csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline='')):
+        try:
+            yield {key: CSV_TYPES[key](value) if key in CSV_TYPES else value
+                   for key, value in record.items()
+                   if key is not None and value is not None and (value != '' or key == 'description')}
+        except (TypeError, ValueError):
+            yield None
+
+def read_records(stream, fmt, gzipped=False):
+    """Reads ``ndjson`` or ``csv`` records lazily from a byte stream, gunzipping it if needed."""
+    if gzipped:
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    return read_csv(stream) if fmt == 'csv' else read_ndjson(stream)
+
+# Columns of exports, in CSV column order
+EXPORT_FIELDS = ('id',) + ITEM_FIELDS
+
+def export_chunks(fmt):
+    """
+    Yields the whole catalog as ``ndjson`` or ``csv`` text, one chunk per batch.
+
+    Each batch of ``INVENTORY_STREAM_BATCH`` rows is one short keyset query
+    (``id > last id``), so memory stays constant whatever the catalog size
+    and no read statement stays open, blocking writers, while the client reads.
+    """
+    query = (Inventory.query.with_entities(*(getattr(Inventory, field) for field in EXPORT_FIELDS))
+             .order_by(Inventory.id))
+    batch_size = app.config['INVENTORY_STREAM_BATCH']
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if fmt == 'csv':
+        writer.writerow(EXPORT_FIELDS)
+    after = 0
+    while True:
+        rows = query.filter(Inventory.id > after).limit(batch_size).all()
+        for row in rows:
+            if fmt == 'csv':
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n')
+        if buffer.tell():
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if len(rows) < batch_size:
+            return
+        after = rows[-1][0]
+
+def gzip_chunks(chunks):
+    """Gzips a stream of text chunks incrementally."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _apply_chunk(chunk, summary, insert_missing=False):
+    inserts, updates, errors = [], [], []
+    for row, data in chunk:
+        is_update = isinstance(data, dict) and 'id' in data
+        error = validate_item(data, partial=is_update)
+        if error:
+            errors.append({"row": row, "message": error})
+        elif is_update:
+            updates.append((row, {"id": data['id'], **{key: data[key] for key in ITEM_FIELDS if key in data}}))
+        else:
+            inserts.append({"description": '', **{key: data[key] for key in ITEM_FIELDS if key in data}})
+
+    ids = [values['id'] for _, values in updates]
+    existing = {item_id for (item_id,) in db.session.query(Inventory.id).filter(Inventory.id.in_(ids))} if ids else set()
+    for row, values in updates:
+        if values['id'] in existing:
+            continue
+        error = validate_item(values) if insert_missing else "Item not found"
+        if error:
+            errors.append({"row": row, "message": error})
+        else:
+            inserts.append({"description": '', **values})
+    updates = [values for _, values in updates if values['id'] in existing]
+
+    try:
+        if inserts:
+            db.session.bulk_insert_mappings(Inventory, inserts)
+        if updates:
+            db.session.bulk_update_mappings(Inventory, updates)
+        if inserts or updates:
+            bump_version(db.session, CatalogVersion)
+        db.session.commit()
+    except exc.SQLAlchemyError as e:
+        db.session.rollback()
+        logger.error(f"Bulk upsert chunk failed: {e}")
+        failed = {error["row"] for error in errors}
+        errors.extend({"row": row, "message": "Write failed"} for row, _ in chunk if row not in failed)
+    else:
+        summary["inserted"] += len(inserts)
+        summary["updated"] += len(updates)
+    summary["errors"].extend(sorted(errors, key=lambda error: error["row"]))
 
-# Performance profiling: Start profiling before each request
-@app.before_request
-def start_profiling():
-    request.profiler = cProfile.Profile()
-    request.profiler.enable()
-
-# Performance profiling: Stop profiling and log results after each request
-@app.after_request
-def stop_profiling(response):
-    if hasattr(request, 'profiler'):
-        request.profiler.disable()
-        s = StringIO()
-        ps = pstats.Stats(request.profiler, stream=s).sort_stats('cumulative')
-        ps.print_stats(10)  # Log top 10 slowest functions
-        app.logger.info(s.getvalue())
-    return response
 
 
 
@@ -96,12 +357,9 @@ def add_goods():
     data = request.get_json()
 
     # Validation
-    if not all(key in data for key in ['name', 'category', 'price', 'count']):
-        return jsonify({"message": "Missing required fields"}), 400
-    if not isinstance(data['price'], (int, float)) or data['price'] <= 0:
-        return jsonify({"message": "Price must be a positive number"}), 400
-    if not isinstance(data['count'], int) or data['count'] < 0:
-        return jsonify({"message": "Count must be a non-negative integer"}), 400
+    error = validate_item(data)
+    if error:
+        return jsonify({"message": error}), 400
 
     # Create new item
     new_item = Inventory(
@@ -109,13 +367,78 @@ def add_goods():
         category=data['category'],
         price=data['price'],
         description=data.get('description', ''),
-        count=data['count']
+        count=data['count'],
+        reorder_threshold=data.get('reorder_threshold', 0)
     )
     db.session.add(new_item)
+    bump_version(db.session, CatalogVersion)
     db.session.commit()
     logger.info(f"New item added: {data['name']} (Category: {data['category']})")
     return jsonify({"message": "Item added successfully"}), 201
 
+@app.route('/inventory/bulk', methods=['POST'])
+@jwt_required()
+def bulk_upsert_goods():
+    """
+    Inserts or updates many inventory items in one call.
+
+    Accepts a JSON array, or an NDJSON or CSV stream when sent with
+    ``Content-Type: application/x-ndjson`` or ``text/csv``, optionally with
+    ``Content-Encoding: gzip`` (read line by line, never buffered whole). Items with an ``id`` are updated, the others are added. Invalid
+    rows are reported in ``errors`` and do not abort the batch.
+    """
+    if request.mimetype in STREAM_FORMATS:
+        records = read_records(request.stream, STREAM_FORMATS[request.mimetype],
+                               gzipped=request.content_encoding == 'gzip')
+    else:
+        records = request.get_json()
+        if not isinstance(records, list):
+            return jsonify({"message": "Expected a list of items"}), 400
+
+    summary = upsert_items(records)
+    logger.info(f"Bulk upsert: {summary['inserted']} added, {summary['updated']} updated, {summary['failed']} failed")
+    return jsonify(summary), 200
+
+@app.route('/inventory/import', methods=['POST'])
+@jwt_required()
+def import_goods():
+    """
+    Restores an export: streams NDJSON or CSV records into the catalog.
+
+    Like the streamed ``/inventory/bulk``, but items whose ``id`` does not
+    exist are inserted under that id instead of being rejected.
+    """
+    if request.mimetype not in STREAM_FORMATS:
+        return jsonify({"message": "Content-Type must be application/x-ndjson or text/csv"}), 415
+    records = read_records(request.stream, STREAM_FORMATS[request.mimetype],
+                           gzipped=request.content_encoding == 'gzip')
+    summary = upsert_items(records, insert_missing=True)
+    logger.info(f"Import: {summary['inserted']} added, {summary['updated']} updated, {summary['failed']} failed")
+    return jsonify(summary), 200
+
+@app.route('/inventory/export', methods=['GET'])
+@jwt_required()
+def export_goods():
+    """
+    Streams the whole catalog for backups and feeds.
+
+    Query parameters:
+        format: ``ndjson`` (default) or ``csv``.
+
+    The body is gzipped (``Content-Encoding: gzip``) when the client accepts
+    it. Memory use does not grow with the catalog.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_MIMETYPES:
+        return jsonify({"message": "format must be ndjson or csv"}), 400
+
+    chunks = export_chunks(fmt)
+    headers = {}
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[fmt], headers=headers)
+
 @app.route('/inventory/update/<int:item_id>', methods=['PUT'])
 @jwt_required()
 def update_goods(item_id):
@@ -127,16 +450,16 @@ def update_goods(item_id):
         return jsonify({"message": "Item not found"}), 404
 
     data = request.get_json()
-    if 'price' in data and (not isinstance(data['price'], (int, float)) or data['price'] <= 0):
-        return jsonify({"message": "Price must be a positive number"}), 400
-    if 'count' in data and (not isinstance(data['count'], int) or data['count'] < 0):
-        return jsonify({"message": "Count must be a non-negative integer"}), 400
+    error = validate_item(data, partial=True)
+    if error:
+        return jsonify({"message": error}), 400
 
     # Update fields
     for key, value in data.items():
         if hasattr(item, key):
             setattr(item, key, value)
 
+    bump_version(db.session, CatalogVersion)
     db.session.commit()
     logger.info(f"Item updated: {item.name}")
     return jsonify({"message": "Item updated successfully"}), 200
@@ -146,33 +469,526 @@ def update_goods(item_id):
 def deduct_goods(item_id):
     """
     Deducts a specified quantity of an inventory item.
-    """
-    item = Inventory.query.get(item_id)
-    if not item:
-        return jsonify({"message": "Item not found"}), 404
 
+    The stock check and the write are one conditional UPDATE, so concurrent
+    deductions cannot oversell.
+    """
     data = request.get_json()
     if 'count' not in data or not isinstance(data['count'], int) or data['count'] <= 0:
         return jsonify({"message": "Count must be a positive integer"}), 400
-    if item.count < data['count']:
+
+    remaining = stock.deduct(db.session, Inventory, item_id, data['count'])
+    if remaining is None:
+        db.session.rollback()
+        if stock.failure_reason(db.session, Inventory, item_id) == 'not_found':
+            return jsonify({"message": "Item not found"}), 404
+        return jsonify({"message": "Insufficient stock"}), 400
+
+    bump_version(db.session, CatalogVersion)
+    db.session.commit()
+    logger.info(f"Stock deducted: item {item_id} | Remaining stock: {remaining}")
+    return jsonify({"message": "Stock deducted successfully", "remaining_count": remaining}), 200
+
+@app.route('/inventory/deduct', methods=['POST'])
+@jwt_required()
+def deduct_many_goods():
+    """
+    Deducts several items in one all-or-nothing transaction.
+
+    Expects ``{"items": [{"id": ..., "count": ...}, ...]}`` and returns the
+    remaining count of every item.
+    """
+    data = request.get_json()
+    lines = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(lines, list) or not lines:
+        return jsonify({"message": "items must be a non-empty list"}), 400
+    for line in lines:
+        if not isinstance(line, dict) or not isinstance(line.get('id'), int):
+            return jsonify({"message": "Each item needs an integer id"}), 400
+        if not isinstance(line.get('count'), int) or line['count'] <= 0:
+            return jsonify({"message": "Count must be a positive integer"}), 400
+
+    try:
+        remaining = stock.deduct_many(db.session, Inventory, [(line['id'], line['count']) for line in lines])
+    except stock.StockError as e:
+        db.session.rollback()
+        if e.reason == 'not_found':
+            return jsonify({"message": "Item not found", "item_id": e.item_id}), 404
+        return jsonify({"message": "Insufficient stock", "item_id": e.item_id}), 400
+
+    bump_version(db.session, CatalogVersion)
+    db.session.commit()
+    logger.info(f"Stock deducted for {len(remaining)} items")
+    return jsonify({
+        "message": "Stock deducted successfully",
+        "remaining": [{"id": item_id, "remaining_count": count} for item_id, count in remaining.items()]
+    }), 200
+
+def sweep_reservations():
+    """Releases a batch of expired holds; returns how many were released."""
+    expired = reservations.expire(db.session, Inventory, Reservation,
+                                  batch_size=app.config['RESERVATION_SWEEP_BATCH'])
+    if expired:
+        bump_version(db.session, CatalogVersion)
+    return expired
+
+@app.route('/inventory/reservations', methods=['POST'])
+@jwt_required()
+def reserve_goods():
+    """
+    Holds stock of an item for a customer's checkout.
+
+    Expects ``{"item_id", "count", "holder"}``. The units leave the available
+    count until the hold is confirmed, released or expires after
+    ``RESERVATION_TTL`` seconds. Expired holds are swept first so their
+    units can be reserved again.
+    """
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get('item_id'), int) or not data.get('holder'):
+        return jsonify({"message": "item_id and holder are required"}), 400
+    if not isinstance(data.get('count'), int) or data['count'] <= 0:
+        return jsonify({"message": "Count must be a positive integer"}), 400
+
+    sweep_reservations()
+    reservation = reservations.reserve(db.session, Inventory, Reservation, data['item_id'], data['count'],
+                                       data['holder'], app.config['RESERVATION_TTL'])
+    if reservation is None:
+        reason = stock.failure_reason(db.session, Inventory, data['item_id'])
+        db.session.commit()  # Keep the expired holds that were swept
+        if reason == 'not_found':
+            return jsonify({"message": "Item not found"}), 404
         return jsonify({"message": "Insufficient stock"}), 400
 
-    item.count -= data['count']
+    bump_version(db.session, CatalogVersion)
     db.session.commit()
-    logger.info(f"Stock deducted: {item.name} | Remaining stock: {item.count}")
-    return jsonify({"message": "Stock deducted successfully", "remaining_count": item.count}), 200
+    logger.info(f"Reserved {reservation.quantity} of item {reservation.inventory_id} for {reservation.holder}")
+    return jsonify({
+        "id": reservation.id,
+        "item_id": reservation.inventory_id,
+        "count": reservation.quantity,
+        "holder": reservation.holder,
+        "expires_at": reservation.expires_at.isoformat()
+    }), 201
+
+@app.route('/inventory/reservations/<int:reservation_id>/confirm', methods=['POST'])
+@jwt_required()
+def confirm_reservation(reservation_id):
+    """
+    Consumes an unexpired hold: its units are sold and do not come back.
+
+    An optional ``holder`` in the body must match the hold's holder.
+    """
+    data = request.get_json(silent=True) or {}
+    taken = reservations.confirm(db.session, Reservation, reservation_id, holder=data.get('holder'))
+    if taken is None:
+        db.session.rollback()
+        return jsonify({"message": "Reservation not found or expired"}), 404
+    db.session.commit()
+    return jsonify({"message": "Reservation confirmed", "item_id": taken[0], "count": taken[1]}), 200
+
+@app.route('/inventory/reservations/<int:reservation_id>', methods=['DELETE'])
+@jwt_required()
+def release_reservation(reservation_id):
+    """
+    Releases a hold and puts its units back in stock.
+    """
+    taken = reservations.release(db.session, Inventory, Reservation, reservation_id)
+    if taken is None:
+        db.session.rollback()
+        return jsonify({"message": "Reservation not found"}), 404
+    bump_version(db.session, CatalogVersion)
+    db.session.commit()
+    return jsonify({"message": "Reservation released", "item_id": taken[0], "count": taken[1]}), 200
+
+@app.cli.command('expire-reservations')
+def expire_reservations_command():
+    """Releases every expired stock hold, one batch per transaction."""
+    total = 0
+    while True:
+        expired = sweep_reservations()
+        db.session.commit()
+        total += expired
+        if expired < app.config['RESERVATION_SWEEP_BATCH']:
+            break
+    click.echo(f"Released {total} expired reservations")
+
+# Sort keys of GET /inventory: column and direction, always tie-broken by id
+INVENTORY_SORTS = {'id': (None, False), 'price': ('price', False), '-price': ('price', True)}
+
+def build_inventory_query(args):
+    """
+    Builds the catalog query of GET /inventory from its query parameters.
+
+    Returns ``((query, sort, limit), None)`` or ``(None, error_message)``.
+    """
+    sort = args.get('sort', 'id')
+    if sort not in INVENTORY_SORTS:
+        return None, f"sort must be one of {', '.join(INVENTORY_SORTS)}"
+    try:
+        limit = int(args.get('limit', app.config['INVENTORY_PAGE_SIZE']))
+        min_price = float(args['min_price']) if 'min_price' in args else None
+        max_price = float(args['max_price']) if 'max_price' in args else None
+    except ValueError:
+        return None, "limit, min_price and max_price must be numbers"
+    if limit <= 0:
+        return None, "limit must be greater than 0"
+    limit = min(limit, app.config['INVENTORY_MAX_PAGE_SIZE'])
+
+    query = Inventory.query
+    if args.get('category'):
+        query = query.filter(Inventory.category == args['category'])
+    if min_price is not None:
+        query = query.filter(Inventory.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Inventory.price <= max_price)
+    if args.get('in_stock', '').lower() in ('1', 'true', 'yes'):
+        # Literal so SQLite can match the partial index ix_inventory_in_stock
+        query = query.filter(literal_column('count > 0'))
+
+    column, descending = INVENTORY_SORTS[sort]
+    id_key = Inventory.id
+    if column is None and not args.get('category') and (min_price is not None or max_price is not None):
+        # No index orders a price range by id. Left alone, SQLite walks the
+        # whole table in id order hoping to fill the page early; "id + 0"
+        # cannot use the rowid, so it reads the range from ix_inventory_price.
+        id_key = Inventory.id + 0
+    cursor = args.get('cursor')
+    try:
+        if column is None:
+            if cursor:
+                query = query.filter(id_key > int(cursor))
+            query = query.order_by(id_key)
+        else:
+            key = tuple_(getattr(Inventory, column), Inventory.id)
+            if cursor:
+                value, item_id = cursor.rsplit(':', 1)
+                bound = (float(value), int(item_id))
+                query = query.filter(key < bound if descending else key > bound)
+            order = (getattr(Inventory, column).desc(), Inventory.id.desc()) if descending \
+                else (getattr(Inventory, column), Inventory.id)
+            query = query.order_by(*order)
+    except ValueError:
+        return None, "Invalid cursor"
+    return (query, sort, limit), None
+
+def inventory_cursor(item, sort):
+    """Builds the keyset cursor that continues after ``item``."""
+    column, _ = INVENTORY_SORTS[sort]
+    return str(item.id) if column is None else f"{getattr(item, column)}:{item.id}"
 
 @app.route('/inventory', methods=['GET'])
 def get_inventory():
     """
-    Retrieves all items from the inventory.
+    Retrieves inventory items, filtered, sorted and one page at a time.
+
+    Query parameters:
+        category: Only items of this category.
+        min_price, max_price: Inclusive price range.
+        in_stock: ``true`` to only return items with a positive count.
+        sort: ``id`` (default), ``price`` or ``-price``.
+        limit: Page size (defaults to ``INVENTORY_PAGE_SIZE``, capped at ``INVENTORY_MAX_PAGE_SIZE``).
+        cursor: Value of the ``X-Next-Cursor`` header of the previous page.
+
+    Every supported combination is served by an index on category, price or count.
+    Responses carry the catalog version as a strong ETag and answer
+    ``If-None-Match`` with 304 Not Modified.
+    """
+    args, error = build_inventory_query(request.args)
+    if error:
+        return jsonify({"message": error}), 400
+    query, sort, limit = args
+
+    def build():
+        items = query.limit(limit + 1).all()
+        inventory_list = [
+            {"id": item.id, "name": item.name, "category": item.category, "price": item.price, "count": item.count}
+            for item in items[:limit]
+        ]
+        headers = {'X-Next-Cursor': inventory_cursor(items[limit - 1], sort)} if len(items) > limit else {}
+        return inventory_list, headers
+
+    # Only the catalog_version row is read when the client's copy is current
+    # or the page is already serialized for this version.
+    version = current_version(db.session, CatalogVersion)
+    return catalog_responses.respond(request, version, request.query_string, build)
+
+def read_changes(since, limit):
     """
-    items = Inventory.query.all()
-    inventory_list = [
-        {"id": item.id, "name": item.name, "category": item.category, "price": item.price, "count": item.count}
-        for item in items
-    ]
-    return jsonify(inventory_list), 200
+    Returns up to ``limit`` changes after sequence number ``since``, with the
+    current state of each item (``None`` once deleted).
+
+    Returns ``None`` if changes after ``since`` were already pruned, in which
+    case the consumer must reload the whole catalog.
+    """
+    rows = (db.session.query(InventoryChange, Inventory)
+            .outerjoin(Inventory, Inventory.id == InventoryChange.inventory_id)
+            .filter(InventoryChange.seq > since)
+            .order_by(InventoryChange.seq)
+            .limit(limit).all())
+    if since and (not rows or rows[0][0].seq != since + 1):
+        oldest = db.session.query(db.func.min(InventoryChange.seq)).scalar()
+        if oldest is not None and oldest > since + 1:
+            return None
+    return [{
+        "seq": change.seq,
+        "id": change.inventory_id,
+        "op": change.op,
+        "item": {"id": item.id, "name": item.name, "category": item.category, "price": item.price,
+                 "description": item.description, "count": item.count} if item else None
+    } for change, item in rows]
+
+def wait_for_changes(since, limit, wait):
+    """Polls the change log for up to ``wait`` seconds until there are changes after ``since``."""
+    deadline = time.monotonic() + wait
+    while True:
+        changes = read_changes(since, limit)
+        db.session.rollback()  # End the read transaction so the next poll sees new commits
+        if changes or changes is None or time.monotonic() >= deadline:
+            return changes
+        time.sleep(app.config['CHANGE_FEED_POLL_INTERVAL'])
+
+def parse_since(value):
+    """Parses a sequence number argument; returns ``None`` if it is invalid."""
+    try:
+        since = int(value or 0)
+    except ValueError:
+        return None
+    return since if since >= 0 else None
+
+@app.route('/inventory/changes', methods=['GET'])
+def get_changes():
+    """
+    Long-polls the inventory change feed.
+
+    Query parameters:
+        since: Sequence number of the last change the consumer applied (0 for all).
+        wait: Seconds to wait for a change when there is none yet (capped at ``CHANGE_FEED_MAX_WAIT``).
+
+    Returns ``{"changes": [...], "last_seq": ...}`` where each change holds the
+    item's current state; pass ``last_seq`` as ``since`` on the next call.
+    Answers 410 Gone when ``since`` predates the retained log.
+    """
+    since = parse_since(request.args.get('since'))
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0), app.config['CHANGE_FEED_MAX_WAIT'])
+    except ValueError:
+        wait = None
+    if since is None or wait is None:
+        return jsonify({"message": "since and wait must be non-negative numbers"}), 400
+
+    changes = wait_for_changes(since, app.config['CHANGE_FEED_PAGE_SIZE'], wait)
+    if changes is None:
+        return jsonify({"message": "Changes were pruned, reload the catalog"}), 410
+    return jsonify({"changes": changes, "last_seq": changes[-1]["seq"] if changes else since}), 200
+
+@app.route('/inventory/changes/stream', methods=['GET'])
+def stream_changes():
+    """
+    Streams the inventory change feed as server-sent events.
+
+    Starts after the ``Last-Event-ID`` header (sent by reconnecting
+    ``EventSource`` clients) or the ``since`` query parameter. Each event is
+    a change with its ``seq`` as event id. The stream ends after
+    ``CHANGE_FEED_STREAM_TIMEOUT`` seconds and clients reconnect; a ``reset``
+    event means the consumer must reload the whole catalog.
+    """
+    since = parse_since(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    if since is None:
+        return jsonify({"message": "since must be a non-negative integer"}), 400
+
+    def generate(since):
+        yield 'retry: 1000\n\n'
+        deadline = time.monotonic() + app.config['CHANGE_FEED_STREAM_TIMEOUT']
+        while time.monotonic() < deadline:
+            changes = wait_for_changes(since, app.config['CHANGE_FEED_PAGE_SIZE'],
+                                       min(app.config['CHANGE_FEED_MAX_WAIT'], max(deadline - time.monotonic(), 0)))
+            if changes is None:
+                yield 'event: reset\ndata: {}\n\n'
+                return
+            if not changes:
+                yield ': keepalive\n\n'
+            for change in changes:
+                yield f"id: {change['seq']}\nevent: change\ndata: {json.dumps(change)}\n\n"
+                since = change['seq']
+
+    return Response(stream_with_context(generate(since)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/inventory/low-stock', methods=['GET'])
+@jwt_required()
+def get_low_stock():
+    """
+    Lists the items whose count fell to or below their reorder threshold.
+
+    Query parameters:
+        limit: Page size (defaults to ``INVENTORY_PAGE_SIZE``, capped at ``INVENTORY_MAX_PAGE_SIZE``).
+        cursor: Id of the last item of the previous page (``X-Next-Cursor``).
+
+    Reads only the ``ix_inventory_low_stock`` partial index, so the cost
+    depends on the number of low-stock items, not on the catalog size.
+    """
+    try:
+        limit = min(int(request.args.get('limit', app.config['INVENTORY_PAGE_SIZE'])),
+                    app.config['INVENTORY_MAX_PAGE_SIZE'])
+        cursor = int(request.args.get('cursor', 0))
+    except ValueError:
+        return jsonify({"message": "limit and cursor must be integers"}), 400
+    if limit <= 0:
+        return jsonify({"message": "limit must be greater than 0"}), 400
+
+    items = (Inventory.query
+             .filter(literal_column('count <= reorder_threshold'), Inventory.id > cursor)
+             .order_by(Inventory.id).limit(limit + 1).all())
+    response = jsonify([
+        {"id": item.id, "name": item.name, "count": item.count, "reorder_threshold": item.reorder_threshold}
+        for item in items[:limit]
+    ])
+    if len(items) > limit:
+        response.headers['X-Next-Cursor'] = str(items[limit - 1].id)
+    return response
+
+def send_low_stock_alerts():
+    """
+    Delivers pending low-stock alerts and marks them sent.
+
+    Alerts are POSTed as a JSON list to ``LOW_STOCK_WEBHOOK_URL``; without
+    a URL they are only logged. Returns the number of alerts sent.
+    """
+    alerts = LowStockAlert.query.filter(LowStockAlert.sent_at.is_(None)).order_by(LowStockAlert.id).all()
+    if not alerts:
+        return 0
+    payload = [{"id": alert.inventory_id, "count": alert.count, "reorder_threshold": alert.reorder_threshold,
+                "at": alert.created_at.isoformat()} for alert in alerts]
+
+    url = app.config['LOW_STOCK_WEBHOOK_URL']
+    if url:
+        request_ = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'),
+                                          headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(request_, timeout=10):
+            pass
+    for item in payload:
+        logger.warning(f"Low stock: item {item['id']} has {item['count']} left (threshold {item['reorder_threshold']})")
+
+    LowStockAlert.query.filter(LowStockAlert.id.in_([alert.id for alert in alerts])) \
+        .update({LowStockAlert.sent_at: db.func.current_timestamp()}, synchronize_session=False)
+    db.session.commit()
+    return len(alerts)
+
+@app.route('/inventory/search', methods=['GET'])
+def search_inventory():
+    """
+    Searches items by name, category and description, best matches first.
+
+    Query parameters:
+        q: Words that must all appear; the last one also matches as a prefix.
+        limit: Page size (defaults to ``INVENTORY_PAGE_SIZE``, capped at ``INVENTORY_MAX_PAGE_SIZE``).
+        cursor: Value of the ``X-Next-Cursor`` header of the previous page.
+
+    Ranking is bm25 over the ``inventory_fts`` index, weighting names most.
+    Like ``GET /inventory``, responses carry the catalog version as ETag.
+    """
+    if not search.match_expression(request.args.get('q')):
+        return jsonify({"message": "q must contain at least one word"}), 400
+    try:
+        limit = min(int(request.args.get('limit', app.config['INVENTORY_PAGE_SIZE'])),
+                    app.config['INVENTORY_MAX_PAGE_SIZE'])
+        after = None
+        if request.args.get('cursor'):
+            score, _, item_id = request.args['cursor'].rpartition(':')
+            after = (float(score), int(item_id))
+    except ValueError:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+    if limit <= 0:
+        return jsonify({"message": "Invalid limit or cursor"}), 400
+
+    def build():
+        rows = search.search(db.session, request.args['q'], limit + 1, after)
+        results = [
+            {"id": row.id, "name": row.name, "category": row.category, "price": row.price,
+             "description": row.description, "count": row.count}
+            for row in rows[:limit]
+        ]
+        headers = {'X-Next-Cursor': f"{rows[limit - 1].score!r}:{rows[limit - 1].id}"} if len(rows) > limit else {}
+        return results, headers
+
+    version = current_version(db.session, CatalogVersion)
+    return search_responses.respond(request, version, request.query_string, build)
+
+def file_format(path):
+    """Tells the format and compression of an export file from its name, e.g. ``items.csv.gz``."""
+    gzipped = path.endswith('.gz')
+    name = path[:-3] if gzipped else path
+    return ('csv' if name.endswith('.csv') else 'ndjson'), gzipped
+
+@app.cli.command('export-inventory')
+@click.argument('path')
+def export_inventory_command(path):
+    """Exports the catalog to an NDJSON or CSV file, gzipped if it ends in .gz."""
+    fmt, gzipped = file_format(path)
+    chunks = export_chunks(fmt)
+    with open(path, 'wb') as f:
+        for chunk in gzip_chunks(chunks) if gzipped else (chunk.encode('utf-8') for chunk in chunks):
+            f.write(chunk)
+    click.echo(f"Exported the catalog to {path}")
+
+@app.cli.command('import-inventory')
+@click.argument('path')
+def import_inventory_command(path):
+    """Imports an NDJSON or CSV export (optionally .gz), restoring ids."""
+    fmt, gzipped = file_format(path)
+    with open(path, 'rb') as f:
+        summary = upsert_items(read_records(f, fmt, gzipped), insert_missing=True)
+    for error in summary["errors"]:
+        click.echo(f"Row {error['row']}: {error['message']}", err=True)
+    click.echo(f"Imported {summary['inserted']} items, updated {summary['updated']}, {summary['failed']} failed")
+
+@app.cli.command('prune-changes')
+@click.option('--days', default=7, help='Changes younger than this are kept.')
+def prune_changes_command(days):
+    """Deletes old change feed entries; consumers behind them get 410 and reload."""
+    # The newest entry is always kept so the log still tells which sequence
+    # numbers were pruned.
+    newest = db.session.query(db.func.max(InventoryChange.seq)).scalar() or 0
+    deleted = InventoryChange.query.filter(
+        InventoryChange.created_at < db.func.datetime('now', f'{-days:+d} days'),
+        InventoryChange.seq < newest
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    click.echo(f"Pruned {deleted} changes")
+
+@app.cli.command('send-low-stock-alerts')
+def send_low_stock_alerts_command():
+    """Delivers the pending low-stock alerts to LOW_STOCK_WEBHOOK_URL (or the log)."""
+    click.echo(f"Sent {send_low_stock_alerts()} low-stock alerts")
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Creates the full-text index of an existing database, or reindexes it."""
+    search.rebuild_index(db.session, Inventory.__tablename__)
+    db.session.commit()
+    click.echo("Search index rebuilt")
+
+@app.cli.command('migrate-inventory')
+def migrate_inventory_command():
+    """
+    Upgrades an inventory table created before the current schema, keeping its rows.
+
+    Creates the tables added since, adds ``reorder_threshold``, then the
+    indexes, the low-stock and change-feed triggers and the search index,
+    all of which older databases lack. Safe to run again; the search index
+    is rebuilt on every run.
+    """
+    db.create_all()
+    columns = {row[1] for row in db.session.execute(db.text("PRAGMA table_info(inventory)"))}
+    if 'reorder_threshold' not in columns:
+        db.session.execute(db.text("ALTER TABLE inventory ADD COLUMN reorder_threshold INTEGER NOT NULL DEFAULT 0"))
+    for index in Inventory.__table__.indexes:
+        index.create(db.session.connection(), checkfirst=True)
+    for trigger in LOW_STOCK_TRIGGERS + CHANGE_TRIGGERS:
+        db.session.execute(db.text(trigger))
+    search.rebuild_index(db.session, Inventory.__tablename__)
+    db.session.commit()
+    click.echo("Inventory schema migrated")
 
 if __name__ == '__main__':
     with app.app_context():
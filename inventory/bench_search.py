@@ -0,0 +1,66 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import text
+
+from inventory import search
+from inventory.app import app, db
+
+WORDS = ["wireless", "gaming", "office", "steel", "oak", "led", "portable", "smart", "ergonomic", "compact",
+         "mouse", "keyboard", "desk", "chair", "lamp", "monitor", "laptop", "cable", "speaker", "shelf"]
+
+def fill_catalog(rows, batch_size=50000):
+    """
+    Inserts ``rows`` random items; the FTS triggers index them as they go.
+    """
+    rng = random.Random(42)
+    for start in range(0, rows, batch_size):
+        db.session.execute(text(
+            "INSERT INTO inventory (name, category, price, description, count) "
+            "VALUES (:name, :category, :price, :description, :count)"
+        ), [{
+            "name": " ".join(rng.sample(WORDS, 2)) + f" {start + i}",
+            "category": rng.choice(["Electronics", "Furniture", "Office"]),
+            "price": round(rng.uniform(1, 2000), 2),
+            "description": " ".join(rng.choices(WORDS, k=8)),
+            "count": rng.randint(0, 50),
+        } for i in range(min(batch_size, rows - start))])
+        db.session.commit()
+
+def time_query(run, repeat):
+    """Returns the mean milliseconds of ``run()``."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def run_search_benchmark(rows=1000000, repeat=20):
+    """
+    Compares a LIKE scan of name and description with the FTS5 index on a ``rows`` catalog.
+    """
+    path = os.path.join(tempfile.mkdtemp(), "bench_search.db")
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    with app.app_context():
+        db.create_all()
+        print(f"Filling a catalog of {rows} items...")
+        start = time.perf_counter()
+        fill_catalog(rows)
+        print(f"insert + index:  {time.perf_counter() - start:8.1f} s")
+
+        # Rare terms make LIKE scan the whole table; common ones let it stop
+        # early but FTS5 still ranks every match.
+        for q in [str(rows // 2), f"lamp {rows // 3}", "lamp", "ergonomic chair", "port"]:
+            pattern = f"%{q.split()[-1]}%"
+            like = time_query(lambda: db.session.execute(text(
+                "SELECT id FROM inventory WHERE name LIKE :p OR description LIKE :p LIMIT 100"
+            ), {"p": pattern}).all(), repeat)
+            fts = time_query(lambda: search.search(db.session, q, 100), repeat)
+            print(f"{q!r:18} LIKE: {like:8.1f} ms  FTS5 (ranked): {fts:8.1f} ms")
+        db.drop_all()
+    os.remove(path)
+
+if __name__ == "__main__":
+    run_search_benchmark(*(int(arg) for arg in sys.argv[1:3]))
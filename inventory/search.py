@@ -0,0 +1,91 @@
+"""
+Full-text product search over an SQLite FTS5 index of the inventory.
+
+``inventory_fts`` is an external-content FTS5 table: it stores only the
+index and reads ``name``, ``category`` and ``description`` back from the
+``inventory`` table. Triggers keep it in sync with every insert, delete and
+update of those columns, whether it comes from the ORM, bulk mappings or
+raw SQL; stock changes do not touch it.
+"""
+import re
+
+from sqlalchemy import DDL, event, text
+
+FTS_TABLE = 'inventory_fts'
+FTS_COLUMNS = ('name', 'category', 'description')
+# bm25 weights of FTS_COLUMNS: a hit in the name counts most
+FTS_WEIGHTS = (10.0, 2.0, 1.0)
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def fts_statements(table_name):
+    """DDL creating (if needed) and fully rebuilding the FTS index of ``table_name``."""
+    columns = ', '.join(FTS_COLUMNS)
+    new_values = ', '.join(f'new.{column}' for column in FTS_COLUMNS)
+    old_values = ', '.join(f'old.{column}' for column in FTS_COLUMNS)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        f"{columns}, content='{table_name}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {table_name} BEGIN "
+        f"INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.id, {new_values}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {table_name} BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF {columns} ON {table_name} BEGIN "
+        f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+        f"INSERT INTO {FTS_TABLE}(rowid, {columns}) VALUES (new.id, {new_values}); END",
+    ]
+
+
+def install_fts(table):
+    """Creates the FTS index and its sync triggers with ``table`` and drops them with it."""
+    for statement in fts_statements(table.name):
+        event.listen(table, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(table, 'before_drop', DDL(f'DROP TABLE IF EXISTS {FTS_TABLE}').execute_if(dialect='sqlite'))
+
+
+def rebuild_index(session, table_name):
+    """Creates the index of a database that predates it, or reindexes every item."""
+    for statement in fts_statements(table_name):
+        session.execute(text(statement))
+
+
+def match_expression(q):
+    """
+    Turns a user query into an FTS5 MATCH expression.
+
+    Every word must match, the last one as a prefix so results show up while
+    the user is typing. Words are quoted, so FTS5 operators in the input are
+    searched for literally. Returns ``None`` if ``q`` has no words.
+    """
+    words = _TOKEN.findall(q or '')
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search(session, q, limit, after=None):
+    """
+    Returns up to ``limit`` rows ``(id, name, category, price, description, count, score)``
+    matching ``q``, best first.
+
+    Lower scores rank higher (bm25). ``after`` is the ``(score, id)`` of the
+    last row of the previous page.
+    """
+    weights = ', '.join(str(weight) for weight in FTS_WEIGHTS)
+    sql = (
+        f'SELECT * FROM ('
+        f'SELECT i.id, i.name, i.category, i.price, i.description, i.count, '
+        f'bm25({FTS_TABLE}, {weights}) AS score '
+        f'FROM {FTS_TABLE} JOIN inventory AS i ON i.id = {FTS_TABLE}.rowid '
+        f'WHERE {FTS_TABLE} MATCH :q)'
+    )
+    params = {'q': match_expression(q), 'limit': limit}
+    if after is not None:
+        sql += ' WHERE score > :score OR (score = :score AND id > :id)'
+        params['score'], params['id'] = after
+    sql += ' ORDER BY score, id LIMIT :limit'
+    return session.execute(text(sql), params).all()
@@ -1,5 +1,11 @@
+import gzip
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
 import pytest
-from inventory.app import app, db, Inventory, User
+from inventory.app import app, db, catalog_responses, search_responses, build_inventory_query, Inventory, LowStockAlert, Reservation, User
 from flask_jwt_extended import create_access_token
 
 @pytest.fixture
@@ -14,6 +20,8 @@ def client():
     # Create tables before each test
     with app.app_context():
         db.create_all()
+        catalog_responses.clear()
+        search_responses.clear()
         # Add a test user
         user = User(username="testuser", password="testpassword")
         db.session.add(user)
@@ -109,6 +117,18 @@ def test_get_inventory(client, auth_header):
     assert b"Laptop" in response.data
 
 
+def test_tokens_of_other_services_accepted(client):
+    """
+    Test that inventory checks only the token, not whether its subject is an inventory user.
+    """
+    with app.app_context():
+        headers = {"Authorization": f"Bearer {create_access_token(identity='customer@example.com')}"}
+    response = client.post('/inventory/add', headers=headers, json={
+        "name": "Laptop", "category": "Electronics", "price": 1000.0, "count": 5
+    })
+    assert response.status_code == 201
+
+
 def test_update_goods_protected(client):
     """
     Test that the update goods endpoint is protected.
@@ -160,3 +180,585 @@ def test_deduct_goods(client, auth_header):
     assert response.status_code == 200
     assert b"Stock deducted successfully" in response.data
     assert b"3" in response.data  # Remaining count should be 3
+
+
+def test_bulk_upsert_goods(client, auth_header):
+    """
+    Test bulk inserting and updating items with per-row errors.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Laptop",
+        "category": "Electronics",
+        "price": 1000.0,
+        "count": 5
+    })
+    response = client.post('/inventory/bulk', headers=auth_header, json=[
+        {"name": "Mouse", "category": "Electronics", "price": 20.0, "count": 50},
+        {"id": 1, "price": 900.0},
+        {"name": "Broken", "category": "Electronics", "price": -1, "count": 1},
+        {"id": 99, "count": 3},
+        {"name": "Missing fields"},
+        {"name": "Desk", "category": "Furniture", "price": 150, "description": "Oak", "count": 2},
+    ])
+    assert response.status_code == 200
+    data = response.get_json()
+    assert (data["inserted"], data["updated"], data["failed"]) == (2, 1, 3)
+    assert data["errors"] == [
+        {"row": 2, "message": "Price must be a positive number"},
+        {"row": 3, "message": "Item not found"},
+        {"row": 4, "message": "Missing required fields"},
+    ]
+    with app.app_context():
+        assert Inventory.query.get(1).price == 900.0
+        assert Inventory.query.get(1).count == 5
+        assert Inventory.query.count() == 3
+
+
+def test_bulk_upsert_goods_rejects_mistyped_fields(client, auth_header):
+    """
+    Test that mistyped ids and text fields fail only their own rows.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Laptop", "category": "Electronics", "price": 1000.0, "count": 5
+    })
+    rows = [
+        {"id": [1], "count": 1},
+        {"id": "7", "name": "Desk", "category": "Furniture", "price": 150.0, "count": 2},
+        {"id": True, "count": 1},
+        {"name": {"a": 1}, "category": "Misc", "price": 1.0, "count": 1},
+        {"name": "Lamp", "category": "Misc", "price": 1.0, "count": 1, "description": 3},
+        {"name": "Mouse", "category": "Electronics", "price": 20.0, "count": 50},
+        {"id": 1, "count": 4},
+    ]
+    body = "".join(json.dumps(row) + "\n" for row in rows)
+    response = client.post('/inventory/import', headers={**auth_header, "Content-Type": "application/x-ndjson"},
+                           data=body)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert (data["inserted"], data["updated"], data["failed"]) == (1, 1, 5)
+    assert [error["message"] for error in data["errors"]] == ["Id must be an integer"] * 3 + [
+        "Name must be a string", "Description must be a string"]
+
+
+def test_bulk_upsert_goods_csv_short_rows(client, auth_header):
+    """
+    Test that CSV rows with missing cells are reported as row errors.
+    """
+    response = client.post('/inventory/bulk', headers={**auth_header, "Content-Type": "text/csv"},
+                           data="name,category,price,count\nA,c,1,1\nB,c\nC,c,2,2,extra\n")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert (data["inserted"], data["failed"]) == (2, 1)
+    assert data["errors"] == [{"row": 1, "message": "Missing required fields"}]
+
+
+def test_bulk_upsert_goods_ndjson_chunks(client, auth_header):
+    """
+    Test streaming NDJSON upserts applied over several chunks.
+    """
+    app.config['INVENTORY_BULK_CHUNK'] = 2
+    try:
+        body = "".join(
+            json.dumps({"name": f"Item {i}", "category": "Misc", "price": 1.5, "count": i}) + "\n" for i in range(5)
+        ) + "not json\n"
+        response = client.post('/inventory/bulk', headers=auth_header, data=body, content_type='application/x-ndjson')
+    finally:
+        app.config['INVENTORY_BULK_CHUNK'] = 1000
+    data = response.get_json()
+    assert (data["inserted"], data["failed"]) == (5, 1)
+    assert data["errors"] == [{"row": 5, "message": "Item must be an object"}]
+
+
+def test_deduct_goods_insufficient_and_missing(client, auth_header):
+    """
+    Test deduction failures for missing items and insufficient stock.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Laptop", "category": "Electronics", "price": 1000.0, "count": 1
+    })
+    response = client.post('/inventory/deduct/1', headers=auth_header, json={"count": 2})
+    assert response.status_code == 400
+    assert b"Insufficient stock" in response.data
+    response = client.post('/inventory/deduct/42', headers=auth_header, json={"count": 1})
+    assert response.status_code == 404
+
+
+def test_deduct_goods_concurrent_no_oversell(client, auth_header):
+    """
+    Test that parallel deductions never sell more than the stock.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Console", "category": "Electronics", "price": 500.0, "count": 50
+    })
+
+    def deduct_many():
+        thread_client = app.test_client()
+        return [thread_client.post('/inventory/deduct/1', headers=auth_header, json={"count": 1}).status_code
+                for _ in range(15)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = [status for future in [pool.submit(deduct_many) for _ in range(8)] for status in future.result()]
+
+    assert statuses.count(200) == 50
+    assert statuses.count(400) == 8 * 15 - 50
+    with app.app_context():
+        assert Inventory.query.get(1).count == 0
+
+
+def test_deduct_many_goods(client, auth_header):
+    """
+    Test all-or-nothing multi-item deduction.
+    """
+    client.post('/inventory/bulk', headers=auth_header, json=[
+        {"name": "Laptop", "category": "Electronics", "price": 1000.0, "count": 5},
+        {"name": "Mouse", "category": "Electronics", "price": 20.0, "count": 1},
+    ])
+    response = client.post('/inventory/deduct', headers=auth_header, json={"items": [
+        {"id": 1, "count": 2},
+        {"id": 2, "count": 2},
+    ]})
+    assert response.status_code == 400
+    assert response.get_json()["item_id"] == 2
+    with app.app_context():
+        assert Inventory.query.get(1).count == 5  # Rolled back
+
+    response = client.post('/inventory/deduct', headers=auth_header, json={"items": [
+        {"id": 1, "count": 2},
+        {"id": 2, "count": 1},
+        {"id": 1, "count": 1},
+    ]})
+    assert response.status_code == 200
+    assert response.get_json()["remaining"] == [{"id": 1, "remaining_count": 2}, {"id": 2, "remaining_count": 0}]
+
+
+def add_catalog(client, auth_header):
+    """
+    Adds a small catalog spanning two categories, prices and stock levels.
+    """
+    client.post('/inventory/bulk', headers=auth_header, json=[
+        {"name": "Laptop", "category": "Electronics", "price": 1000.0, "count": 5},
+        {"name": "Mouse", "category": "Electronics", "price": 20.0, "count": 0},
+        {"name": "Desk", "category": "Furniture", "price": 150.0, "count": 2},
+        {"name": "Chair", "category": "Furniture", "price": 80.0, "count": 7},
+        {"name": "Monitor", "category": "Electronics", "price": 200.0, "count": 3},
+    ])
+
+
+def test_get_inventory_filters(client, auth_header):
+    """
+    Test filtering the catalog by category, price range and stock.
+    """
+    add_catalog(client, auth_header)
+    names = lambda query: [item["name"] for item in client.get(f'/inventory?{query}').get_json()]
+    assert names('category=Electronics') == ["Laptop", "Mouse", "Monitor"]
+    assert names('min_price=50&max_price=200') == ["Desk", "Chair", "Monitor"]
+    assert names('category=Electronics&in_stock=true') == ["Laptop", "Monitor"]
+    assert names('in_stock=1&sort=price') == ["Chair", "Desk", "Monitor", "Laptop"]
+    assert names('category=Furniture&sort=-price') == ["Desk", "Chair"]
+    assert client.get('/inventory?sort=name').status_code == 400
+    assert client.get('/inventory?min_price=cheap').status_code == 400
+
+
+def test_get_inventory_keyset_pages(client, auth_header):
+    """
+    Test walking the catalog sorted by price with the keyset cursor.
+    """
+    add_catalog(client, auth_header)
+    seen, cursor = [], None
+    while True:
+        response = client.get('/inventory?sort=-price&limit=2' + (f'&cursor={cursor}' if cursor else ''))
+        seen += [item["name"] for item in response.get_json()]
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert seen == ["Laptop", "Monitor", "Desk", "Chair", "Mouse"]
+
+
+def test_get_inventory_query_plans_use_indexes(client):
+    """
+    Test with EXPLAIN QUERY PLAN that every filter combination reads through an index.
+    """
+    filters = {"category": "Electronics", "min_price": "10", "max_price": "500", "in_stock": "true"}
+    with app.app_context():
+        for size in range(1, len(filters) + 1):
+            for names in combinations(filters, size):
+                for sort, cursor in [("id", "3"), ("price", "20.0:2"), ("-price", "200.0:5")]:
+                    for with_cursor in (False, True):
+                        args = {name: filters[name] for name in names}
+                        args["sort"] = sort
+                        if with_cursor:
+                            args["cursor"] = cursor
+                        (query, _, limit), error = build_inventory_query(args)
+                        assert error is None
+                        sql = str(query.limit(limit + 1).statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+                        plan = [row[3] for row in db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}"))]
+                        access = [step for step in plan if not step.startswith("USE TEMP B-TREE")]
+                        assert access and all("USING INDEX" in step or "INTEGER PRIMARY KEY" in step for step in access), \
+                            (args, plan)
+
+
+def test_get_inventory_etag_not_modified(client, auth_header):
+    """
+    Test that the listing carries the catalog version as ETag and answers 304 until a write.
+    """
+    add_catalog(client, auth_header)
+    response = client.get('/inventory')
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+
+    response = client.get('/inventory', headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    client.put('/inventory/update/1', headers=auth_header, json={"price": 900.0})
+    response = client.get('/inventory', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.get_json()[0]["price"] == 900.0
+
+
+def test_get_inventory_serves_cached_body_per_version(client, auth_header):
+    """
+    Test that an unchanged catalog is served from the pre-serialized body.
+    """
+    add_catalog(client, auth_header)
+    first = client.get('/inventory?sort=price')
+    with app.app_context():
+        db.session.execute(db.text("UPDATE inventory SET price = 1 WHERE id = 1"))
+        db.session.commit()
+    assert client.get('/inventory?sort=price').data == first.data
+
+    client.post('/inventory/deduct/1', headers=auth_header, json={"count": 1})
+    assert client.get('/inventory?sort=price').data != first.data
+
+
+def test_reservation_holds_and_releases_stock(client, auth_header):
+    """
+    Test that a hold takes units out of the available count until it is released.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Phone", "category": "Electronics", "price": 500.0, "count": 5
+    })
+    response = client.post('/inventory/reservations', headers=auth_header, json={
+        "item_id": 1, "count": 3, "holder": "jodim"
+    })
+    assert response.status_code == 201
+    reservation_id = response.get_json()["id"]
+    assert client.get('/inventory').get_json()[0]["count"] == 2
+
+    response = client.post('/inventory/reservations', headers=auth_header, json={
+        "item_id": 1, "count": 3, "holder": "other"
+    })
+    assert response.status_code == 400
+
+    assert client.delete(f'/inventory/reservations/{reservation_id}', headers=auth_header).status_code == 200
+    assert client.delete(f'/inventory/reservations/{reservation_id}', headers=auth_header).status_code == 404
+    assert client.get('/inventory').get_json()[0]["count"] == 5
+
+
+def test_reservation_confirm_consumes_hold_once(client, auth_header):
+    """
+    Test that a confirmed hold keeps its units sold and cannot be confirmed again.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Phone", "category": "Electronics", "price": 500.0, "count": 5
+    })
+    reservation_id = client.post('/inventory/reservations', headers=auth_header, json={
+        "item_id": 1, "count": 2, "holder": "jodim"
+    }).get_json()["id"]
+
+    url = f'/inventory/reservations/{reservation_id}/confirm'
+    assert client.post(url, headers=auth_header, json={"holder": "other"}).status_code == 404
+    response = client.post(url, headers=auth_header, json={"holder": "jodim"})
+    assert response.status_code == 200
+    assert response.get_json()["count"] == 2
+    assert client.post(url, headers=auth_header, json={"holder": "jodim"}).status_code == 404
+    assert client.get('/inventory').get_json()[0]["count"] == 3
+
+
+def test_expired_reservations_are_swept(client, auth_header):
+    """
+    Test that expired holds give their units back before new holds are made.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Phone", "category": "Electronics", "price": 500.0, "count": 5
+    })
+    app.config['RESERVATION_TTL'] = -1
+    try:
+        client.post('/inventory/reservations', headers=auth_header, json={
+            "item_id": 1, "count": 5, "holder": "jodim"
+        })
+    finally:
+        app.config['RESERVATION_TTL'] = 600
+    assert client.get('/inventory').get_json()[0]["count"] == 0
+
+    response = client.post('/inventory/reservations', headers=auth_header, json={
+        "item_id": 1, "count": 4, "holder": "other"
+    })
+    assert response.status_code == 201
+    assert client.get('/inventory').get_json()[0]["count"] == 1
+    with app.app_context():
+        assert Reservation.query.count() == 1
+
+
+def test_expire_reservations_command(client, auth_header):
+    """
+    Test the CLI sweeper releasing expired holds in batches.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Phone", "category": "Electronics", "price": 500.0, "count": 5
+    })
+    with app.app_context():
+        expired = datetime.utcnow() - timedelta(minutes=1)
+        db.session.add_all([Reservation(inventory_id=1, quantity=1, holder="jodim", expires_at=expired)
+                            for _ in range(3)])
+        Inventory.query.get(1).count = 2
+        db.session.commit()
+
+    app.config['RESERVATION_SWEEP_BATCH'] = 2
+    try:
+        result = app.test_cli_runner().invoke(args=['expire-reservations'])
+    finally:
+        app.config['RESERVATION_SWEEP_BATCH'] = 1000
+    assert "Released 3 expired reservations" in result.output
+    assert client.get('/inventory').get_json()[0]["count"] == 5
+
+
+def test_search_ranks_name_matches_and_prefixes(client, auth_header):
+    """
+    Test full-text search with ranking by field and prefix matching of the last word.
+    """
+    client.post('/inventory/bulk', headers=auth_header, json=[
+        {"name": "Desk lamp", "category": "Furniture", "price": 30.0, "count": 4, "description": "LED"},
+        {"name": "Office chair", "category": "Furniture", "price": 80.0, "count": 2,
+         "description": "Pairs well with a lamp"},
+        {"name": "Laptop", "category": "Electronics", "price": 1000.0, "count": 1, "description": "Gaming"},
+    ])
+    response = client.get('/inventory/search?q=lamp')
+    assert [item["name"] for item in response.get_json()] == ["Desk lamp", "Office chair"]
+    prefixed = client.get('/inventory/search?q=la').get_json()
+    assert {item["name"] for item in prefixed} == {"Laptop", "Desk lamp", "Office chair"}
+    assert prefixed[-1]["name"] == "Office chair"  # Only matched in the description
+    assert client.get('/inventory/search?q=desk+la').get_json()[0]["name"] == "Desk lamp"
+    assert client.get('/inventory/search?q="OR').status_code == 200
+    assert client.get('/inventory/search?q=%20').status_code == 400
+
+
+def test_search_index_follows_updates(client, auth_header):
+    """
+    Test that renamed items are found under their new name only.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Phone", "category": "Electronics", "price": 500.0, "count": 5
+    })
+    client.put('/inventory/update/1', headers=auth_header, json={"name": "Tablet"})
+    assert client.get('/inventory/search?q=phone').get_json() == []
+    assert client.get('/inventory/search?q=tablet').get_json()[0]["id"] == 1
+
+
+def test_search_paginates_with_cursor(client, auth_header):
+    """
+    Test walking search results page by page with the keyset cursor.
+    """
+    client.post('/inventory/bulk', headers=auth_header, json=[
+        {"name": f"Cable {i}", "category": "Electronics", "price": 5.0, "count": 1} for i in range(5)
+    ])
+    seen, cursor = [], None
+    while True:
+        response = client.get('/inventory/search?q=cable&limit=2' + (f'&cursor={cursor}' if cursor else ''))
+        seen += [item["id"] for item in response.get_json()]
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert sorted(seen) == [1, 2, 3, 4, 5] and len(seen) == 5
+
+
+def test_export_and_import_round_trip(client, auth_header):
+    """
+    Test streaming the catalog out as NDJSON and CSV, gzipped or not, and restoring it.
+    """
+    add_catalog(client, auth_header)
+    for fmt, mimetype in [("ndjson", "application/x-ndjson"), ("csv", "text/csv")]:
+        for encoding in ("identity", "gzip"):
+            response = client.get(f'/inventory/export?format={fmt}',
+                                  headers={**auth_header, "Accept-Encoding": encoding})
+            assert response.status_code == 200
+            assert response.mimetype == mimetype
+            body = response.data
+            if encoding == "gzip":
+                assert response.headers["Content-Encoding"] == "gzip"
+                assert gzip.decompress(body).count(b"\n") == (6 if fmt == "csv" else 5)
+
+            with app.app_context():
+                Inventory.query.delete()
+                db.session.commit()
+            headers = {**auth_header, "Content-Type": mimetype}
+            if encoding == "gzip":
+                headers["Content-Encoding"] = "gzip"
+            summary = client.post('/inventory/import', headers=headers, data=body).get_json()
+            assert summary == {"inserted": 5, "updated": 0, "failed": 0, "errors": []}
+            items = client.get('/inventory?sort=price').get_json()
+            assert [(item["id"], item["name"], item["count"]) for item in items] == \
+                [(2, "Mouse", 0), (4, "Chair", 7), (3, "Desk", 2), (5, "Monitor", 3), (1, "Laptop", 5)]
+
+
+def test_export_stream_does_not_block_writers(client, auth_header, monkeypatch):
+    """
+    Test that stock can be written while an export is half read.
+    """
+    add_catalog(client, auth_header)
+    monkeypatch.setitem(app.config, 'INVENTORY_STREAM_BATCH', 2)
+    response = client.get('/inventory/export', headers=auth_header, buffered=False)
+    chunks = response.iter_encoded()
+    first = next(chunks)
+    with app.app_context():
+        writer = sqlite3.connect(db.engine.url.database, timeout=0)
+    writer.execute("UPDATE inventory SET count = 0 WHERE id = 5")
+    writer.commit()
+    writer.close()
+    body = first + b"".join(chunks)
+    response.close()
+    assert [json.loads(line)["id"] for line in body.splitlines()] == [1, 2, 3, 4, 5]
+    assert json.loads(body.splitlines()[-1])["count"] == 0
+
+
+def test_export_import_cli(client, auth_header, tmp_path):
+    """
+    Test the export-inventory and import-inventory commands with a gzipped CSV file.
+    """
+    add_catalog(client, auth_header)
+    path = str(tmp_path / "catalog.csv.gz")
+    runner = app.test_cli_runner()
+    assert "Exported" in runner.invoke(args=['export-inventory', path]).output
+    with gzip.open(path, 'rt') as f:
+        assert f.readline() == "id,name,category,price,description,count,reorder_threshold\n"
+
+    client.put('/inventory/update/1', headers=auth_header, json={"count": 0})
+    result = runner.invoke(args=['import-inventory', path])
+    assert "Imported 0 items, updated 5, 0 failed" in result.output
+    assert client.get('/inventory').get_json()[0]["count"] == 5
+
+
+def test_change_feed_long_poll(client, auth_header):
+    """
+    Test that every write shows up in the change feed with the item's current state.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Phone", "category": "Electronics", "price": 500.0, "count": 5
+    })
+    client.post('/inventory/deduct/1', headers=auth_header, json={"count": 2})
+    feed = client.get('/inventory/changes').get_json()
+    assert [(change["seq"], change["op"]) for change in feed["changes"]] == [(1, "insert"), (2, "update")]
+    assert feed["changes"][0]["item"]["count"] == 3
+    assert feed["last_seq"] == 2
+
+    assert client.get('/inventory/changes?since=2&wait=0.1').get_json() == {"changes": [], "last_seq": 2}
+    with app.app_context():
+        db.session.delete(Inventory.query.get(1))
+        db.session.commit()
+    feed = client.get('/inventory/changes?since=2').get_json()
+    assert feed["changes"] == [{"seq": 3, "id": 1, "op": "delete", "item": None}]
+    assert client.get('/inventory/changes?since=-1').status_code == 400
+
+
+def test_change_feed_gone_after_prune(client, auth_header):
+    """
+    Test that consumers behind pruned changes are told to reload the catalog.
+    """
+    add_catalog(client, auth_header)
+    result = app.test_cli_runner().invoke(args=['prune-changes', '--days', '-1'])
+    assert "Pruned 4 changes" in result.output
+    assert client.get('/inventory/changes?since=1').status_code == 410
+    assert client.get('/inventory/changes?since=4').get_json()["changes"][0]["seq"] == 5
+
+
+def test_change_feed_server_sent_events(client, auth_header):
+    """
+    Test the SSE stream resuming after Last-Event-ID.
+    """
+    add_catalog(client, auth_header)
+    app.config['CHANGE_FEED_STREAM_TIMEOUT'] = 0.2
+    app.config['CHANGE_FEED_POLL_INTERVAL'] = 0.05
+    try:
+        response = client.get('/inventory/changes/stream', headers={"Last-Event-ID": "3"})
+        body = response.get_data(as_text=True)
+    finally:
+        app.config['CHANGE_FEED_STREAM_TIMEOUT'] = 300
+        app.config['CHANGE_FEED_POLL_INTERVAL'] = 0.5
+    assert response.mimetype == 'text/event-stream'
+    events = [block for block in body.split("\n\n") if block.startswith("id: ")]
+    assert [event.splitlines()[0] for event in events] == ["id: 4", "id: 5"]
+    assert json.loads(events[0].splitlines()[2][len("data: "):])["item"]["name"] == "Chair"
+
+
+def test_low_stock_follows_stock_changes(client, auth_header):
+    """
+    Test that items enter and leave the low-stock list as their count and threshold change.
+    """
+    client.post('/inventory/bulk', headers=auth_header, json=[
+        {"name": "Phone", "category": "Electronics", "price": 500.0, "count": 5, "reorder_threshold": 2},
+        {"name": "Cable", "category": "Electronics", "price": 5.0, "count": 1, "reorder_threshold": 3},
+        {"name": "Desk", "category": "Furniture", "price": 150.0, "count": 0},
+    ])
+    low_stock = lambda: [item["id"] for item in client.get('/inventory/low-stock', headers=auth_header).get_json()]
+    assert low_stock() == [2, 3]
+
+    client.post('/inventory/deduct/1', headers=auth_header, json={"count": 3})
+    assert low_stock() == [1, 2, 3]
+    client.put('/inventory/update/2', headers=auth_header, json={"count": 10})
+    client.put('/inventory/update/1', headers=auth_header, json={"reorder_threshold": 1})
+    assert low_stock() == [3]
+    assert client.put('/inventory/update/1', headers=auth_header, json={"reorder_threshold": -1}).status_code == 400
+
+    response = client.get('/inventory/low-stock?limit=1', headers=auth_header)
+    assert response.headers.get('X-Next-Cursor') is None
+    with app.app_context():
+        sql = "EXPLAIN QUERY PLAN SELECT id FROM inventory WHERE count <= reorder_threshold AND id > 0 ORDER BY id"
+        assert "ix_inventory_low_stock" in db.session.execute(db.text(sql)).all()[0][3]
+
+
+def test_low_stock_alerts_are_sent_once_per_crossing(client, auth_header):
+    """
+    Test that an alert is queued when an item falls to its threshold and delivered once.
+    """
+    client.post('/inventory/add', headers=auth_header, json={
+        "name": "Phone", "category": "Electronics", "price": 500.0, "count": 5, "reorder_threshold": 2
+    })
+    client.post('/inventory/deduct/1', headers=auth_header, json={"count": 3})
+    client.post('/inventory/deduct/1', headers=auth_header, json={"count": 1})
+    with app.app_context():
+        assert [(alert.inventory_id, alert.count) for alert in LowStockAlert.query.all()] == [(1, 2)]
+
+    runner = app.test_cli_runner()
+    assert "Sent 1 low-stock alerts" in runner.invoke(args=['send-low-stock-alerts']).output
+    assert "Sent 0 low-stock alerts" in runner.invoke(args=['send-low-stock-alerts']).output
+
+
+def test_migrate_inventory_command(client, auth_header):
+    """
+    Test upgrading an inventory table created before stock thresholds, the change feed and search.
+    """
+    with app.app_context():
+        db.drop_all()
+        db.session.execute(db.text(
+            "CREATE TABLE inventory (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, "
+            "category VARCHAR(50) NOT NULL, price FLOAT NOT NULL, description VARCHAR(255), count INTEGER NOT NULL)"))
+        db.session.execute(db.text(
+            "INSERT INTO inventory (name, category, price, description, count) "
+            "VALUES ('Wireless Mouse', 'Electronics', 25.0, '', 4)"))
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    assert "Inventory schema migrated" in runner.invoke(args=['migrate-inventory']).output
+    assert "Inventory schema migrated" in runner.invoke(args=['migrate-inventory']).output
+    response = client.get('/inventory')
+    assert response.status_code == 200 and response.get_json()[0]["name"] == "Wireless Mouse"
+    assert client.get('/inventory/search?q=mouse').get_json()[0]["id"] == 1
+
+    client.put('/inventory/update/1', headers=auth_header, json={"reorder_threshold": 5})
+    assert [change["op"] for change in client.get('/inventory/changes').get_json()["changes"]] == ["update"]
+    assert [item["id"] for item in client.get('/inventory/low-stock', headers=auth_header).get_json()] == [1]
+    with app.app_context():
+        assert LowStockAlert.query.count() == 1
+        indexes = {row[1] for row in db.session.execute(db.text("PRAGMA index_list(inventory)"))}
+        assert {'ix_inventory_category_price', 'ix_inventory_low_stock', 'ix_inventory_in_stock'} <= indexes
@@ -1,25 +1,30 @@
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
-import cProfile
-import pstats
-from io import StringIO
 from memory_profiler import profile
 import logging
 from flask_caching import Cache
+import click
+from sqlalchemy.dialects.sqlite import insert
+from common.identity import Identity, IdentityCache, admin_usernames
+from common.profiling import SamplingProfiler
 
 # Initialize the app and database
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///C:\\Users\\nsucc\\Desktop\\python env\\ecommerce_AbiRizk_Succar\\database\\database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = 'YourSecretKey'
+app.config['ADMIN_USERNAMES'] = admin_usernames()  # JWT subjects allowed on /admin endpoints
 app.config['CACHE_TYPE'] = 'simple'  # You can change this to 'redis' for better performance
 app.config['CACHE_DEFAULT_TIMEOUT'] = 300  # Cache timeout in seconds
+app.config['IDENTITY_CACHE_TTL'] = 300  # Seconds a username -> id mapping is trusted
+app.config['RATING_SUMMARY_BATCH_LIMIT'] = 500  # Most product ids per batch summary request
 
 # Initialize extensions
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
 cache = Cache(app)
+profiler = SamplingProfiler(app, url_prefix='/reviews')  # Off unless PROFILING_ENABLED is set
 
 # Set up logging configuration
 logging.basicConfig(
@@ -42,6 +47,63 @@ class Review(db.Model):
     comment = db.Column(db.String(255))
     status = db.Column(db.String(20), default='Pending')
 
+class RatingSummary(db.Model):
+    __tablename__ = 'rating_summary'
+    inventory_id = db.Column(db.Integer, primary_key=True)
+    # Every review of the item, whatever its moderation status
+    review_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_1 = db.Column(db.Integer, nullable=False, default=0)
+    rating_2 = db.Column(db.Integer, nullable=False, default=0)
+    rating_3 = db.Column(db.Integer, nullable=False, default=0)
+    rating_4 = db.Column(db.Integer, nullable=False, default=0)
+    rating_5 = db.Column(db.Integer, nullable=False, default=0)
+    # Approved reviews only
+    approved_count = db.Column(db.Integer, nullable=False, default=0)
+    approved_sum = db.Column(db.Integer, nullable=False, default=0)
+    approved_1 = db.Column(db.Integer, nullable=False, default=0)
+    approved_2 = db.Column(db.Integer, nullable=False, default=0)
+    approved_3 = db.Column(db.Integer, nullable=False, default=0)
+    approved_4 = db.Column(db.Integer, nullable=False, default=0)
+    approved_5 = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = {'sqlite_with_rowid': False}
+
+def count_rating(inventory_id, rating, sign, reviews=True, approved=False):
+    """
+    Adds (``sign=1``) or removes (``sign=-1``) one ``rating`` of an item in its summary.
+
+    ``reviews`` and ``approved`` pick the all-reviews and approved-only
+    figures. Runs in the caller's transaction, so the summary commits or rolls
+    back with the review.
+    """
+    deltas = {}
+    if reviews:
+        deltas.update({'review_count': sign, 'rating_sum': sign * rating, f'rating_{rating}': sign})
+    if approved:
+        deltas.update({'approved_count': sign, 'approved_sum': sign * rating, f'approved_{rating}': sign})
+    if not deltas:
+        return
+    table = RatingSummary.__table__
+    statement = insert(table).values(inventory_id=inventory_id, **deltas)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[table.c.inventory_id],
+        set_={column: table.c[column] + statement.excluded[column] for column in deltas}))
+
+def summary_json(inventory_id, summary=None):
+    """Count, average and histogram of an item's ratings, all and approved only."""
+    def figures(prefix, count_column, sum_column):
+        count = getattr(summary, count_column) if summary else 0
+        total = getattr(summary, sum_column) if summary else 0
+        return {
+            "count": count,
+            "average": round(total / count, 2) if count else None,
+            "histogram": {str(stars): getattr(summary, f'{prefix}_{stars}') if summary else 0
+                          for stars in range(1, 6)},
+        }
+    return {"inventory_id": inventory_id,
+            **figures('rating', 'review_count', 'rating_sum'),
+            "approved": figures('approved', 'approved_count', 'approved_sum')}
+
 class Customer(db.Model):
     __tablename__ = 'customers'
     id = db.Column(db.Integer, primary_key=True)
@@ -52,7 +114,14 @@ class Customer(db.Model):
     address = db.Column(db.String(200))
     gender = db.Column(db.String(10))
     marital_status = db.Column(db.String(20))
-    wallet_balance = db.Column(db.Float)
+    opening_balance_cents = db.Column(db.Integer, nullable=False, default=0)  # Live balance is kept in the wallet ledger
+
+def load_identity(username):
+    """Loads the identity cached for a JWT subject."""
+    row = db.session.query(Customer.id).filter_by(username=username).first()
+    return Identity(row.id, username, ('customer',)) if row else None
+
+identities = IdentityCache(load_identity, ttl=app.config['IDENTITY_CACHE_TTL'])
 
 class Inventory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -62,21 +131,47 @@ class Inventory(db.Model):
     description = db.Column(db.String(255))
     count = db.Column(db.Integer, nullable=False)
 
-# Performance profiling
-@app.before_request
-def start_profiling():
-    request.profiler = cProfile.Profile()
-    request.profiler.enable()
-
-@app.after_request
-def stop_profiling(response):
-    if hasattr(request, 'profiler'):
-        request.profiler.disable()
-        s = StringIO()
-        ps = pstats.Stats(request.profiler, stream=s).sort_stats('cumulative')
-        ps.print_stats(10)
-        app.logger.info(s.getvalue())
-    return response
+
+def valid_rating(rating):
+    """True for a whole-star rating from 1 to 5."""
+    return isinstance(rating, int) and not isinstance(rating, bool) and 1 <= rating <= 5
+
+def change_review(review_id, values=None):
+    """
+    Updates a review with ``values`` (or deletes it when ``values`` is None) and its rating summary.
+
+    The row is only written if its rating and status are still the ones the
+    summary change was computed from; a concurrent change makes it re-read
+    the review and try again, so no review is counted twice. Runs in the
+    caller's transaction and returns False if the review does not exist.
+    """
+    while True:
+        old = db.session.query(Review.inventory_id, Review.rating, Review.status).filter_by(id=review_id).first()
+        if old is None:
+            return False
+        unchanged = Review.query.filter_by(id=review_id, rating=old.rating, status=old.status)
+        if values is None:
+            written = unchanged.delete(synchronize_session=False)
+        elif values:
+            written = unchanged.update(values, synchronize_session=False)
+        else:
+            return True
+        if written == 1:
+            break
+        db.session.rollback()
+
+    was_approved = old.status == 'Approved'
+    if values is None:
+        count_rating(old.inventory_id, old.rating, -1, approved=was_approved)
+        return True
+    rating = values.get('rating', old.rating)
+    approved = values.get('status', old.status) == 'Approved'
+    if rating != old.rating:
+        count_rating(old.inventory_id, old.rating, -1, approved=was_approved)
+        count_rating(old.inventory_id, rating, 1, approved=approved)
+    elif approved != was_approved:
+        count_rating(old.inventory_id, rating, 1 if approved else -1, reviews=False, approved=True)
+    return True
 
 # Routes
 @profile
@@ -84,13 +179,13 @@ def stop_profiling(response):
 @jwt_required()
 def submit_review():
     data = request.get_json()
-    customer = Customer.query.filter_by(username=data['username']).first()
+    customer = identities.get(data['username'])
     item = Inventory.query.get(data['item_id'])
 
     if not customer or not item:
         return jsonify({"message": "Customer or item not found"}), 404
 
-    if not 1 <= data['rating'] <= 5:
+    if not valid_rating(data['rating']):
         return jsonify({"message": "Rating must be between 1 and 5"}), 400
 
     new_review = Review(
@@ -100,6 +195,7 @@ def submit_review():
         comment=data.get('comment', '')
     )
     db.session.add(new_review)
+    count_rating(item.id, new_review.rating, 1)
     db.session.commit()
     logger.info(f"Review submitted: {data['username']} for {item.name}")
     return jsonify({"message": "Review submitted successfully"}), 201
@@ -107,49 +203,37 @@ def submit_review():
 @app.route('/reviews/update/<int:review_id>', methods=['PUT'])
 @jwt_required()
 def update_review(review_id):
-    review = Review.query.get(review_id)
-    if not review:
-        return jsonify({"message": "Review not found"}), 404
-
     data = request.get_json()
-    if 'rating' in data and not 1 <= data['rating'] <= 5:
+    if 'rating' in data and not valid_rating(data['rating']):
         return jsonify({"message": "Rating must be between 1 and 5"}), 400
-    if 'rating' in data:
-        review.rating = data['rating']
-    if 'comment' in data:
-        review.comment = data['comment']
 
+    if not change_review(review_id, {key: data[key] for key in ('rating', 'comment') if key in data}):
+        return jsonify({"message": "Review not found"}), 404
     db.session.commit()
-    logger.info(f"Review updated: {review.id}")
+    logger.info(f"Review updated: {review_id}")
     return jsonify({"message": "Review updated successfully"}), 200
 
 @app.route('/reviews/delete/<int:review_id>', methods=['DELETE'])
 @jwt_required()
 def delete_review(review_id):
-    review = Review.query.get(review_id)
-    if not review:
+    if not change_review(review_id):
         return jsonify({"message": "Review not found"}), 404
-
-    db.session.delete(review)
     db.session.commit()
-    logger.info(f"Review deleted: {review.id}")
+    logger.info(f"Review deleted: {review_id}")
     return jsonify({"message": "Review deleted successfully"}), 200
 
 @app.route('/reviews/moderate/<int:review_id>', methods=['POST'])
 @jwt_required()
 def moderate_review(review_id):
-    review = Review.query.get(review_id)
-    if not review:
-        return jsonify({"message": "Review not found"}), 404
-
     data = request.get_json()
     if data['status'] not in ['Approved', 'Rejected']:
         return jsonify({"message": "Invalid status"}), 400
 
-    review.status = data['status']
+    if not change_review(review_id, {'status': data['status']}):
+        return jsonify({"message": "Review not found"}), 404
     db.session.commit()
-    logger.info(f"Review moderated: {review.id} | Status: {review.status}")
-    return jsonify({"message": f"Review status updated to {review.status}"}), 200
+    logger.info(f"Review moderated: {review_id} | Status: {data['status']}")
+    return jsonify({"message": f"Review status updated to {data['status']}"}), 200
 
 @app.route('/reviews/product/<int:inventory_id>', methods=['GET'])
 def get_product_reviews(inventory_id):
@@ -171,6 +255,52 @@ def get_product_reviews(inventory_id):
     ]
     return jsonify(reviews_list), 200
 
+@app.route('/reviews/product/<int:inventory_id>/summary', methods=['GET'])
+def get_product_summary(inventory_id):
+    """
+    Returns the rating count, average and 1-5 histogram of a product, with an approved-only variant.
+
+    A product without reviews has a zero summary.
+    """
+    return jsonify(summary_json(inventory_id, RatingSummary.query.get(inventory_id))), 200
+
+@app.route('/reviews/summary', methods=['GET'])
+def get_product_summaries():
+    """
+    Returns the rating summaries of the comma-separated product ``ids``, keyed by id, in one query.
+    """
+    try:
+        ids = list(dict.fromkeys(int(part) for part in request.args.get('ids', '').split(',') if part.strip()))
+    except ValueError:
+        return jsonify({"message": "ids must be comma-separated integers"}), 400
+    if not ids:
+        return jsonify({"message": "ids is required"}), 400
+    limit = app.config['RATING_SUMMARY_BATCH_LIMIT']
+    if len(ids) > limit:
+        return jsonify({"message": f"At most {limit} ids per request"}), 400
+
+    summaries = {summary.inventory_id: summary
+                 for summary in RatingSummary.query.filter(RatingSummary.inventory_id.in_(ids))}
+    return jsonify({str(inventory_id): summary_json(inventory_id, summaries.get(inventory_id))
+                    for inventory_id in ids}), 200
+
+@app.cli.command('rebuild-rating-summaries')
+def rebuild_rating_summaries_command():
+    """
+    Recomputes every rating summary from the reviews, e.g. for reviews written before summaries existed.
+    """
+    histogram = ', '.join(f"SUM(rating = {stars}), SUM(approved AND rating = {stars})" for stars in range(1, 6))
+    columns = ', '.join(f"rating_{stars}, approved_{stars}" for stars in range(1, 6))
+    RatingSummary.query.delete()
+    db.session.execute(db.text(
+        f"INSERT INTO rating_summary (inventory_id, review_count, rating_sum, approved_count, approved_sum, {columns}) "
+        f"SELECT inventory_id, COUNT(*), SUM(rating), SUM(approved), SUM(approved * rating), {histogram} "
+        f"FROM (SELECT inventory_id, rating, status = 'Approved' AS approved FROM review) "
+        f"GROUP BY inventory_id"
+    ))
+    db.session.commit()
+    click.echo(f"Rebuilt {RatingSummary.query.count()} rating summaries")
+
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5004)
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 from reviews.app import app, db, Review, Customer, Inventory
 from flask_jwt_extended import create_access_token
@@ -25,7 +26,7 @@ def client():
             address="hamra bliss",
             gender="Male",
             marital_status="Single",
-            wallet_balance=500.0
+            opening_balance_cents=50000
         )
         db.session.add(user1)
 
@@ -85,6 +86,23 @@ def test_submit_review_invalid_rating(client, auth_header):
     assert b"Rating must be between 1 and 5" in response.data
 
 
+def test_non_integer_ratings_are_rejected(client, auth_header):
+    """
+    Test that fractional and boolean ratings are refused before the summary is touched.
+    """
+    for rating in (4.5, True):
+        response = client.post('/reviews/submit', headers=auth_header, json={
+            "username": "jodim", "item_id": 1, "rating": rating, "comment": ""
+        })
+        assert response.status_code == 400
+    client.post('/reviews/submit', headers=auth_header, json={
+        "username": "jodim", "item_id": 1, "rating": 4, "comment": ""
+    })
+    assert client.put('/reviews/update/1', headers=auth_header, json={"rating": 3.5}).status_code == 400
+    summary = client.get('/reviews/product/1/summary').get_json()
+    assert summary["count"] == 1 and summary["histogram"]["4"] == 1
+
+
 def test_update_review(client, auth_header):
     """
     Test updating an existing review.
@@ -149,3 +167,91 @@ def test_get_product_reviews(client, auth_header):
     assert response.status_code == 200
     assert b"Excellent product!" in response.data
 
+
+
+def submit(client, auth_header, rating):
+    """Submits a review of the laptop and returns its id."""
+    client.post('/reviews/submit', headers=auth_header, json={
+        "username": "jodim", "item_id": 1, "rating": rating, "comment": ""
+    })
+    with app.app_context():
+        return Review.query.order_by(Review.id.desc()).first().id
+
+
+def test_product_summary_follows_review_changes(client, auth_header):
+    """
+    Test that the rating summary is updated by submit, update, moderate and delete.
+    """
+    empty = client.get('/reviews/product/1/summary').get_json()
+    assert empty["count"] == 0 and empty["average"] is None
+
+    first = submit(client, auth_header, 5)
+    second = submit(client, auth_header, 2)
+    summary = client.get('/reviews/product/1/summary').get_json()
+    assert summary["count"] == 2
+    assert summary["average"] == 3.5
+    assert summary["histogram"] == {"1": 0, "2": 1, "3": 0, "4": 0, "5": 1}
+    assert summary["approved"]["count"] == 0
+
+    client.post(f'/reviews/moderate/{first}', headers=auth_header, json={"status": "Approved"})
+    client.put(f'/reviews/update/{first}', headers=auth_header, json={"rating": 4})
+    summary = client.get('/reviews/product/1/summary').get_json()
+    assert summary["histogram"] == {"1": 0, "2": 1, "3": 0, "4": 1, "5": 0}
+    assert summary["approved"] == {"count": 1, "average": 4.0,
+                                   "histogram": {"1": 0, "2": 0, "3": 0, "4": 1, "5": 0}}
+
+    client.post(f'/reviews/moderate/{first}', headers=auth_header, json={"status": "Rejected"})
+    client.delete(f'/reviews/delete/{second}', headers=auth_header)
+    summary = client.get('/reviews/product/1/summary').get_json()
+    assert (summary["count"], summary["average"]) == (1, 4.0)
+    assert summary["approved"]["count"] == 0
+
+
+def test_batch_summaries(client, auth_header):
+    """
+    Test fetching the summaries of several products at once.
+    """
+    submit(client, auth_header, 3)
+    response = client.get('/reviews/summary?ids=1,2')
+    assert response.status_code == 200
+    summaries = response.get_json()
+    assert summaries["1"]["count"] == 1 and summaries["1"]["average"] == 3.0
+    assert summaries["2"]["count"] == 0
+
+    assert client.get('/reviews/summary?ids=1,x').status_code == 400
+    assert client.get('/reviews/summary').status_code == 400
+
+
+def test_rebuild_rating_summaries(client, auth_header):
+    """
+    Test that the rebuild command recomputes summaries from the reviews.
+    """
+    review_id = submit(client, auth_header, 4)
+    client.post(f'/reviews/moderate/{review_id}', headers=auth_header, json={"status": "Approved"})
+    submit(client, auth_header, 1)
+    before = client.get('/reviews/product/1/summary').get_json()
+
+    result = app.test_cli_runner().invoke(args=['rebuild-rating-summaries'])
+    assert "Rebuilt 1 rating summaries" in result.output
+    assert client.get('/reviews/product/1/summary').get_json() == before
+
+
+def test_concurrent_moderation_counts_each_review_once(client, auth_header):
+    """
+    Test that racing moderations of the same reviews leave the summary matching the reviews.
+    """
+    ids = [submit(client, auth_header, rating) for rating in (1, 3, 5)]
+
+    def moderate(i):
+        return app.test_client().post(f'/reviews/moderate/{ids[i % 3]}', headers=auth_header, json={
+            "status": "Approved" if i % 2 else "Rejected"
+        }).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert set(pool.map(moderate, range(48))) == {200}
+
+    with app.app_context():
+        approved = [review.rating for review in Review.query.filter_by(status='Approved')]
+    summary = client.get('/reviews/product/1/summary').get_json()
+    assert summary["approved"]["count"] == len(approved)
+    assert summary["approved"]["histogram"] == {str(stars): approved.count(stars) for stars in range(1, 6)}
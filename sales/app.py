@@ -1,24 +1,48 @@
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy import func, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import object_session
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token
-import cProfile
-import pstats
-from io import StringIO
 import logging
+import click
+from datetime import date, datetime
 from flask_caching import Cache
+from common.catalog import InStockCatalog, VersionedResponses, bump_version, current_version, versioned_table
+from common.group_commit import GroupCommitter, Rollback
+from common.idempotency import Idempotency
+from common.identity import Identity, IdentityCache, admin_usernames
+from common.profiling import SamplingProfiler
+from common import reservations, stock
+from common.wallet import Wallet, from_cents, to_cents
 
 # Initialize the app and database
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///C:\\Users\\nsucc\\Desktop\\python env\\ecommerce_AbiRizk_Succar\\database\\database.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = 'YourSecretKey'
+app.config['ADMIN_USERNAMES'] = admin_usernames()  # JWT subjects allowed on /admin endpoints
 app.config['CACHE_TYPE'] = 'simple'
+app.config['WALLET_SNAPSHOT_INTERVAL'] = 100  # Ledger entries between two balance snapshots
 app.config['CACHE_DEFAULT_TIMEOUT'] = 300
+app.config['IDENTITY_CACHE_TTL'] = 300  # Seconds a username -> id mapping is trusted
+app.config['SALES_HISTORY_PAGE_SIZE'] = 100  # Default page size of GET /sales/history/<username>
+app.config['SALES_HISTORY_MAX_PAGE_SIZE'] = 1000
+app.config['SALES_GOODS_PAGE_SIZE'] = 100  # Default page size of GET /sales/goods
+app.config['SALES_GOODS_MAX_PAGE_SIZE'] = 1000
+app.config['SALES_STATS_TOP_ITEMS'] = 10  # Default number of items in /sales/stats/top-items
+app.config['SALES_GROUP_COMMIT'] = False  # Batch concurrent sales into shared transactions on a writer thread
+app.config['SALES_GROUP_COMMIT_MAX_BATCH'] = 64  # Most sales committed together
+app.config['SALES_GROUP_COMMIT_MAX_DELAY'] = 0.005  # Seconds the writer waits to fill a batch
+app.config['IDEMPOTENCY_TTL'] = 86400  # Seconds a response is replayed for a repeated Idempotency-Key
+app.config['IDEMPOTENCY_LOCK_TIMEOUT'] = 60  # Seconds before an unfinished request's key can be reused
 
 # Initialize extensions
 db = SQLAlchemy(app)
 jwt = JWTManager(app)
 cache = Cache(app)
+profiler = SamplingProfiler(app, url_prefix='/sales')  # Off unless PROFILING_ENABLED is set
 
 # Set up logging configuration
 logging.basicConfig(
@@ -32,13 +56,55 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Models: Sale, Customer, Inventory
+# Models: Sale, Order, Customer, Inventory
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
     inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
-    sale_date = db.Column(db.DateTime, default=db.func.current_timestamp())
+    # What was paid, as sold: later price changes do not rewrite history
+    unit_price_cents = db.Column(db.Integer)
+    total_cents = db.Column(db.Integer)
+    item_name = db.Column(db.String(100))
+    sale_date = db.Column(db.DateTime, default=datetime.utcnow)  # Microseconds keep same-second sales ordered
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), index=True)  # Set on the lines of a cart order
+    # Purchase history of a customer in date order, paged by (sale_date, id)
+    __table_args__ = (db.Index('ix_sale_customer_id_sale_date_id', 'customer_id', 'sale_date', 'id'),)
+
+# Order header of a cart checkout; its lines are Sale rows
+class Order(db.Model):
+    __tablename__ = 'orders'
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    total_cents = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    lines = db.relationship('Sale', backref='order')
+
+# Units and revenue per item per day, kept up to date by every sale
+class SalesRollup(db.Model):
+    __tablename__ = 'sales_rollup'
+    day = db.Column(db.Date, primary_key=True)
+    inventory_id = db.Column(db.Integer, primary_key=True)
+    category = db.Column(db.String(50), nullable=False)  # Category of the item when it sold
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue_cents = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = {'sqlite_with_rowid': False}
+
+def record_rollups(lines, day=None):
+    """
+    Adds sold ``(item_id, category, units, revenue_cents)`` lines to the rollups of ``day``.
+
+    Runs in the caller's transaction, so rollups commit or roll back with the sale.
+    """
+    table = SalesRollup.__table__
+    day = day or datetime.utcnow().date()
+    for item_id, category, units, revenue_cents in lines:
+        statement = insert(table).values(day=day, inventory_id=item_id, category=category,
+                                         units=units, revenue_cents=revenue_cents)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.day, table.c.inventory_id],
+            set_={'units': table.c.units + statement.excluded.units,
+                  'revenue_cents': table.c.revenue_cents + statement.excluded.revenue_cents}))
 
 class Customer(db.Model):
     __tablename__ = 'customers'
@@ -50,7 +116,50 @@ class Customer(db.Model):
     address = db.Column(db.String(200))
     gender = db.Column(db.String(10))
     marital_status = db.Column(db.String(20))
-    wallet_balance = db.Column(db.Float, default=0.0)
+    opening_balance_cents = db.Column(db.Integer, nullable=False, default=0)  # Live balance is kept in the wallet ledger
+
+    @hybrid_property
+    def wallet_balance(self):
+        """Live wallet balance as a decimal amount."""
+        return from_cents(wallet.balance(object_session(self), self.id))
+
+    @wallet_balance.setter
+    def wallet_balance(self, amount):
+        """Sets the opening balance; only meaningful before the first ledger entry."""
+        self.opening_balance_cents = to_cents(amount)
+
+    @wallet_balance.expression
+    def wallet_balance(cls):
+        return wallet.balance_expression() / 100.0
+
+# Wallet ledger: charges and debits are appended, never applied to the customer row
+class WalletEntry(db.Model):
+    __tablename__ = 'wallet_ledger'
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    amount_cents = db.Column(db.Integer, nullable=False)  # Positive for charges, negative for debits
+    kind = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    __table_args__ = (db.Index('ix_wallet_ledger_customer_id_id', 'customer_id', 'id'),)
+
+# Wallet snapshot: balance of a customer up to and including ledger entry ledger_id
+class WalletSnapshot(db.Model):
+    __tablename__ = 'wallet_snapshot'
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    ledger_id = db.Column(db.Integer, nullable=False)
+    balance_cents = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    __table_args__ = (db.Index('ix_wallet_snapshot_customer_id_ledger_id', 'customer_id', 'ledger_id'),)
+
+wallet = Wallet(Customer, WalletEntry, WalletSnapshot, snapshot_interval=app.config['WALLET_SNAPSHOT_INTERVAL'])
+
+def load_identity(username):
+    """Loads the identity cached for a JWT subject."""
+    row = db.session.query(Customer.id).filter_by(username=username).first()
+    return Identity(row.id, username, ('customer',)) if row else None
+
+identities = IdentityCache(load_identity, ttl=app.config['IDENTITY_CACHE_TTL'])
 
 class Inventory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -60,78 +169,467 @@ class Inventory(db.Model):
     description = db.Column(db.String(255))
     count = db.Column(db.Integer, nullable=False)
 
-# Performance profiling
-@app.before_request
-def start_profiling():
-    request.profiler = cProfile.Profile()
-    request.profiler.enable()
-
-@app.after_request
-def stop_profiling(response):
-    if hasattr(request, 'profiler'):
-        request.profiler.disable()
-        s = StringIO()
-        ps = pstats.Stats(request.profiler, stream=s).sort_stats('cumulative')
-        ps.print_stats(10)
-        logger.info(s.getvalue())
-    return response
+# Stock holds made through the inventory service, confirmed by sales
+class Reservation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    holder = db.Column(db.String(50), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+# Responses of requests sent with an Idempotency-Key, replayed to retries
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_key'
+    key = db.Column(db.LargeBinary(16), primary_key=True)  # Digest of the identity, path and client key
+    request_hash = db.Column(db.LargeBinary(8), nullable=False)
+    status = db.Column(db.Integer)  # None while the first request runs, 0 once its writes committed
+    body = db.Column(db.Text)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    __table_args__ = {'sqlite_with_rowid': False}
+
+idempotency = Idempotency(db.session, IdempotencyKey, ttl=app.config['IDEMPOTENCY_TTL'],
+                          lock_timeout=app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+
+# Catalog version shared with the inventory service, bumped by every sale
+@versioned_table
+class CatalogVersion(db.Model):
+    __tablename__ = 'catalog_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+catalog_responses = VersionedResponses()
+
+def load_in_stock():
+    """Loads every in-stock item for the in-memory goods listing."""
+    rows = (db.session.query(Inventory.id, Inventory.name, Inventory.price, Inventory.count)
+            .filter(Inventory.count > 0).order_by(Inventory.id))
+    return [{"id": row.id, "name": row.name, "price": row.price, "count": row.count} for row in rows]
+
+in_stock = InStockCatalog(load_in_stock)  # Sales apply their own stock changes, other changes reload it
+
+# Writes sales inline, or batched when SALES_GROUP_COMMIT is set
+sale_writer = GroupCommitter(app, db.session, 'SALES_GROUP_COMMIT',
+                             max_batch=app.config['SALES_GROUP_COMMIT_MAX_BATCH'],
+                             max_delay=app.config['SALES_GROUP_COMMIT_MAX_DELAY'])
 
 # Routes
+def record_sale(customer, data, idempotency_key=None):
+    """
+    Writes one sale: stock (or the customer's hold), wallet debit, sale row and rollups.
+
+    Runs through ``sale_writer``, so it never commits; it raises ``Rollback``
+    with the error response when the sale cannot go through. The request's
+    ``idempotency_key`` is marked applied with the sale, as the writer
+    thread's commit does not see the request's key. Returns
+    ``(body, status, stock_change)`` where ``stock_change`` is the
+    ``(catalog_version, {item_id: count})`` to apply to ``in_stock``.
+    """
+    if 'reservation_id' in data:
+        held = reservations.confirm(db.session, Reservation, data['reservation_id'], holder=customer.username)
+        if held is None:
+            raise Rollback(({"message": "Reservation not found or expired"}, 404, None))
+        item_id, quantity = held
+    else:
+        item_id, quantity = data['item_id'], data['quantity']
+    item = Inventory.query.get(item_id)
+    if not item:
+        raise Rollback(({"message": "Customer or item not found"}, 404, None))
+
+    # Both writes are conditional statements: they fail instead of
+    # overselling or overdrawing under concurrency.
+    stock_change = None
+    if 'reservation_id' not in data:
+        remaining = stock.deduct(db.session, Inventory, item.id, quantity)
+        if remaining is None:
+            raise Rollback(({"message": "Insufficient stock"}, 400, None))
+        stock_change = (bump_version(db.session, CatalogVersion), {item.id: remaining})
+
+    balance = wallet.debit(db.session, customer.id, to_cents(item.price) * quantity, kind='sale')
+    if balance is None:
+        raise Rollback(({"message": "Insufficient funds"}, 400, None))
+
+    new_sale = Sale(customer_id=customer.id, inventory_id=item.id, quantity=quantity, item_name=item.name,
+                    unit_price_cents=to_cents(item.price), total_cents=to_cents(item.price) * quantity)
+    db.session.add(new_sale)
+    record_rollups([(item.id, item.category, quantity, new_sale.total_cents)])
+    if idempotency_key is not None:
+        idempotency.mark_applied(idempotency_key)
+    logger.info(f"Sale processed: {customer.username} bought {quantity} of {item.name}")
+    return {"message": "Sale processed successfully", "remaining_balance": from_cents(balance)}, 200, stock_change
+
 @app.route('/sales', methods=['POST'])
 @jwt_required()
+@idempotency.idempotent
 def process_sale():
     """
     Processes a sale transaction for a customer.
+
+    Retries sent with the same ``Idempotency-Key`` header get the first
+    response back instead of buying again.
+
+    With a ``reservation_id`` (from ``POST /inventory/reservations``) the
+    customer's hold is confirmed instead of deducting stock again, and the
+    item and quantity are those of the hold.
+
+    With ``SALES_GROUP_COMMIT`` set, the sale is written by the group-commit
+    writer together with other sales, and answered once their shared
+    transaction committed.
     """
     data = request.get_json()
-    customer = Customer.query.filter_by(username=data['username']).first()
-    item = Inventory.query.get(data['item_id'])
-
-    if not customer or not item:
+    customer = identities.get(data['username'])
+    if not customer or ('reservation_id' not in data and 'item_id' not in data):
         return jsonify({"message": "Customer or item not found"}), 404
-
-    if not isinstance(data['quantity'], int) or data['quantity'] <= 0:
+    if 'reservation_id' not in data and (not isinstance(data.get('quantity'), int) or data['quantity'] <= 0):
         return jsonify({"message": "Quantity must be a positive integer"}), 400
 
-    if customer.wallet_balance < item.price * data['quantity']:
-        return jsonify({"message": "Insufficient funds"}), 400
+    body, status, stock_change = sale_writer.execute(record_sale, customer, data, idempotency.pending_key())
+    if stock_change:
+        in_stock.apply(*stock_change)
+    return jsonify(body), status
 
-    if item.count < data['quantity']:
-        return jsonify({"message": "Insufficient stock"}), 400
+@app.route('/sales/orders', methods=['POST'])
+@jwt_required()
+@idempotency.idempotent
+def checkout_order():
+    """
+    Checks out a cart of several items as one all-or-nothing order.
 
-    total_price = item.price * data['quantity']
-    customer.wallet_balance -= total_price
-    item.count -= data['quantity']
+    Expects ``{"username": ..., "items": [{"item_id": ..., "quantity": ...}, ...]}``.
+    All lines are priced with one query, then the stock of every line and
+    the order total are deducted in a single transaction: either the whole
+    order goes through or nothing changes. Honors ``Idempotency-Key`` like
+    ``POST /sales``.
+    """
+    data = request.get_json()
+    lines = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(lines, list) or not lines:
+        return jsonify({"message": "items must be a non-empty list"}), 400
+    quantities = {}
+    for line in lines:
+        if not isinstance(line, dict) or not isinstance(line.get('item_id'), int):
+            return jsonify({"message": "Each line needs an integer item_id"}), 400
+        if not isinstance(line.get('quantity'), int) or line['quantity'] <= 0:
+            return jsonify({"message": "Quantity must be a positive integer"}), 400
+        quantities[line['item_id']] = quantities.get(line['item_id'], 0) + line['quantity']
 
-    new_sale = Sale(customer_id=customer.id, inventory_id=item.id, quantity=data['quantity'])
-    db.session.add(new_sale)
+    customer = identities.get(data.get('username'))
+    if not customer:
+        return jsonify({"message": "Customer not found"}), 404
+    items = {item.id: item for item in db.session.query(Inventory.id, Inventory.name, Inventory.price,
+                                                        Inventory.category)
+             .filter(Inventory.id.in_(list(quantities)))}
+    missing = sorted(set(quantities) - set(items))
+    if missing:
+        return jsonify({"message": "Item not found", "item_id": missing[0]}), 404
+    amounts = {item_id: to_cents(items[item_id].price) * quantity for item_id, quantity in quantities.items()}
+    total = sum(amounts.values())
+
+    try:
+        remaining = stock.deduct_many(db.session, Inventory, quantities.items())
+    except stock.StockError as e:
+        db.session.rollback()
+        return jsonify({"message": "Insufficient stock", "item_id": e.item_id}), 400
+
+    balance = wallet.debit(db.session, customer.id, total, kind='order')
+    if balance is None:
+        db.session.rollback()
+        return jsonify({"message": "Insufficient funds"}), 400
+
+    order = Order(customer_id=customer.id, total_cents=total, lines=[
+        Sale(customer_id=customer.id, inventory_id=item_id, quantity=quantity, item_name=items[item_id].name,
+             unit_price_cents=to_cents(items[item_id].price), total_cents=amounts[item_id])
+        for item_id, quantity in quantities.items()
+    ])
+    db.session.add(order)
+    record_rollups([(item_id, items[item_id].category, quantity, amounts[item_id])
+                    for item_id, quantity in quantities.items()])
+    version = bump_version(db.session, CatalogVersion)
     db.session.commit()
+    in_stock.apply(version, remaining)
 
-    logger.info(f"Sale processed: {data['username']} bought {data['quantity']} of {item.name}")
-    return jsonify({"message": "Sale processed successfully", "remaining_balance": customer.wallet_balance}), 200
+    logger.info(f"Order {order.id} processed: {customer.username} bought {len(quantities)} items for {from_cents(total)}")
+    return jsonify({
+        "message": "Order processed successfully",
+        "order_id": order.id,
+        "total": from_cents(total),
+        "remaining_balance": from_cents(balance),
+        "lines": [{"item_id": item_id, "quantity": quantity} for item_id, quantity in quantities.items()]
+    }), 201
 
 @app.route('/sales/goods', methods=['GET'])
 def display_goods():
     """
-    Displays all available goods in stock.
+    Displays the goods in stock, in id order, one page at a time.
+
+    Query parameters:
+        limit: Page size (defaults to ``SALES_GOODS_PAGE_SIZE``, capped at ``SALES_GOODS_MAX_PAGE_SIZE``).
+        cursor: Id of the last item of the previous page (``X-Next-Cursor``).
+
+    Pages are served from the in-memory ``in_stock`` catalog; only the
+    catalog version is read per request, and the items are reloaded when it
+    changed in a way this service did not apply itself. The response
+    carries the version as a strong ETag; unchanged catalogs are answered
+    with 304 or a pre-serialized body.
+    """
+    try:
+        limit = min(int(request.args.get('limit', app.config['SALES_GOODS_PAGE_SIZE'])),
+                    app.config['SALES_GOODS_MAX_PAGE_SIZE'])
+        cursor = int(request.args.get('cursor', 0))
+    except ValueError:
+        return jsonify({"message": "limit and cursor must be integers"}), 400
+    if limit <= 0:
+        return jsonify({"message": "limit must be greater than 0"}), 400
+
+    def build():
+        goods, more = in_stock.page(cursor, limit)
+        return goods, {'X-Next-Cursor': str(goods[-1]["id"])} if more else {}
+
+    version = current_version(db.session, CatalogVersion)
+    in_stock.sync(version)
+    return catalog_responses.respond(request, version, request.query_string, build)
+
+def parse_history_args(args):
+    """
+    Parses the query parameters of ``purchase_history``.
+
+    Returns ``((limit, start, end, after), None)`` or ``(None, error_message)``;
+    ``after`` is the ``(sale_date, id)`` of the cursor.
     """
-    items = Inventory.query.filter(Inventory.count > 0).all()
-    goods = [{"id": item.id, "name": item.name, "price": item.price, "count": item.count} for item in items]
-    return jsonify(goods), 200
+    try:
+        limit = int(args.get('limit', app.config['SALES_HISTORY_PAGE_SIZE']))
+        start = datetime.fromisoformat(args['start']) if args.get('start') else None
+        end = datetime.fromisoformat(args['end']) if args.get('end') else None
+        after = None
+        if args.get('cursor'):
+            sale_date, _, sale_id = args['cursor'].rpartition(':')
+            after = (datetime.fromisoformat(sale_date), int(sale_id))
+    except ValueError:
+        return None, "limit, start, end or cursor is invalid"
+    if limit <= 0:
+        return None, "limit must be greater than 0"
+    return (min(limit, app.config['SALES_HISTORY_MAX_PAGE_SIZE']), start, end, after), None
 
 @app.route('/sales/history/<username>', methods=['GET'])
 @jwt_required()
 def purchase_history(username):
     """
-    Retrieves the purchase history of a customer.
+    Retrieves the purchase history of a customer, oldest first, one page at a time.
+
+    Query parameters:
+        start, end: ISO dates or datetimes; sales from ``start`` (inclusive) to ``end`` (exclusive).
+        limit: Page size (defaults to ``SALES_HISTORY_PAGE_SIZE``, capped at ``SALES_HISTORY_MAX_PAGE_SIZE``).
+        cursor: Value of the ``X-Next-Cursor`` header of the previous page.
+
+    Each row carries the item name, unit price and total as sold, so
+    clients need no inventory lookups. Pages are read from the sale table
+    alone, through the ``(customer_id, sale_date, id)`` index.
     """
-    customer = Customer.query.filter_by(username=username).first()
+    customer = identities.get(username)
     if not customer:
         return jsonify({"message": "Customer not found"}), 404
+    args, error = parse_history_args(request.args)
+    if error:
+        return jsonify({"message": error}), 400
+    limit, start, end, after = args
+
+    query = (db.session.query(Sale.id, Sale.inventory_id, Sale.item_name, Sale.quantity, Sale.unit_price_cents,
+                              Sale.total_cents, Sale.sale_date)
+             .filter(Sale.customer_id == customer.id))
+    if start:
+        query = query.filter(Sale.sale_date >= start)
+    if end:
+        query = query.filter(Sale.sale_date < end)
+    if after:
+        query = query.filter(tuple_(Sale.sale_date, Sale.id) > after)
+    rows = query.order_by(Sale.sale_date, Sale.id).limit(limit + 1).all()
+
+    response = jsonify([{
+        "id": row.id,
+        "item_id": row.inventory_id,
+        "name": row.item_name,
+        "unit_price": from_cents(row.unit_price_cents),
+        "quantity": row.quantity,
+        "total": from_cents(row.total_cents),
+        "date": row.sale_date
+    } for row in rows[:limit]])
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        response.headers['X-Next-Cursor'] = f"{last.sale_date.isoformat()}:{last.id}"
+    return response
+
+def parse_stats_args(args):
+    """
+    Parses the ``start`` (inclusive) and ``end`` (exclusive) ISO dates of the stats endpoints.
+
+    Returns ``((start, end), None)`` or ``(None, error_message)``.
+    """
+    try:
+        start = date.fromisoformat(args['start']) if args.get('start') else None
+        end = date.fromisoformat(args['end']) if args.get('end') else None
+    except ValueError:
+        return None, "start and end must be ISO dates"
+    return (start, end), None
+
+def rollups_between(query, start, end):
+    """Restricts a rollup query to the days from ``start`` to ``end`` (exclusive)."""
+    if start:
+        query = query.filter(SalesRollup.day >= start)
+    if end:
+        query = query.filter(SalesRollup.day < end)
+    return query
+
+@app.route('/sales/stats/daily', methods=['GET'])
+@jwt_required()
+def daily_stats():
+    """
+    Units sold and revenue per day, oldest first.
+
+    Query parameters:
+        start, end: ISO dates; days from ``start`` (inclusive) to ``end`` (exclusive).
+
+    Reads only the rollups, never the sales.
+    """
+    args, error = parse_stats_args(request.args)
+    if error:
+        return jsonify({"message": error}), 400
+    query = db.session.query(SalesRollup.day, func.sum(SalesRollup.units), func.sum(SalesRollup.revenue_cents))
+    rows = rollups_between(query, *args).group_by(SalesRollup.day).order_by(SalesRollup.day).all()
+    return jsonify([{"day": day.isoformat(), "units": units, "revenue": from_cents(revenue)}
+                    for day, units, revenue in rows]), 200
+
+@app.route('/sales/stats/top-items', methods=['GET'])
+@jwt_required()
+def top_items_stats():
+    """
+    Best-selling items over a date range.
+
+    Query parameters:
+        start, end: ISO dates; days from ``start`` (inclusive) to ``end`` (exclusive).
+        by: ``revenue`` (default) or ``units``.
+        limit: Number of items (defaults to ``SALES_STATS_TOP_ITEMS``).
+    """
+    args, error = parse_stats_args(request.args)
+    if error:
+        return jsonify({"message": error}), 400
+    by = request.args.get('by', 'revenue')
+    try:
+        limit = int(request.args.get('limit', app.config['SALES_STATS_TOP_ITEMS']))
+    except ValueError:
+        limit = 0
+    if by not in ('revenue', 'units') or limit <= 0:
+        return jsonify({"message": "by must be revenue or units and limit a positive integer"}), 400
+
+    units = func.sum(SalesRollup.units).label('units')
+    revenue = func.sum(SalesRollup.revenue_cents).label('revenue')
+    top = (rollups_between(db.session.query(SalesRollup.inventory_id, units, revenue), *args)
+           .group_by(SalesRollup.inventory_id)
+           .order_by((revenue if by == 'revenue' else units).desc(), SalesRollup.inventory_id)
+           .limit(limit).all())
+    names = dict(db.session.query(Inventory.id, Inventory.name).filter(Inventory.id.in_([row[0] for row in top])))
+    return jsonify([{"item_id": item_id, "name": names.get(item_id), "units": units, "revenue": from_cents(revenue)}
+                    for item_id, units, revenue in top]), 200
+
+@app.route('/sales/stats/categories', methods=['GET'])
+@jwt_required()
+def category_stats():
+    """
+    Units sold and revenue per category over a date range, highest revenue first.
+
+    Query parameters:
+        start, end: ISO dates; days from ``start`` (inclusive) to ``end`` (exclusive).
+    """
+    args, error = parse_stats_args(request.args)
+    if error:
+        return jsonify({"message": error}), 400
+    revenue = func.sum(SalesRollup.revenue_cents)
+    query = db.session.query(SalesRollup.category, func.sum(SalesRollup.units), revenue)
+    rows = rollups_between(query, *args).group_by(SalesRollup.category) \
+        .order_by(revenue.desc(), SalesRollup.category).all()
+    return jsonify([{"category": category, "units": units, "revenue": from_cents(revenue)}
+                    for category, units, revenue in rows]), 200
+
+@app.cli.command('rebuild-sales-rollups')
+def rebuild_sales_rollups_command():
+    """
+    Recomputes every rollup from the sales, e.g. to backfill sales made before rollups existed.
+
+    Revenue is what the sales recorded; run ``backfill-sale-prices`` first
+    for sales made before prices were recorded.
+    """
+    SalesRollup.query.delete()
+    db.session.execute(db.text(
+        "INSERT INTO sales_rollup (day, inventory_id, category, units, revenue_cents) "
+        "SELECT date(sale.sale_date), sale.inventory_id, inventory.category, SUM(sale.quantity), "
+        "SUM(sale.total_cents) "
+        "FROM sale JOIN inventory ON inventory.id = sale.inventory_id "
+        "GROUP BY date(sale.sale_date), sale.inventory_id"
+    ))
+    db.session.commit()
+    click.echo(f"Rebuilt {SalesRollup.query.count()} rollups")
+
+@app.cli.command('backfill-sale-prices')
+@click.option('--batch-size', default=10000, help='Sale ids updated per transaction.')
+def backfill_sale_prices_command(batch_size):
+    """
+    Adds the price columns to an existing sale table and fills sales made before them.
+
+    Old sales did not record their price, so the current item price and name are used.
+    Their ``CURRENT_TIMESTAMP`` dates are also given the microseconds new sales
+    store, so purchase history cursors compare them correctly.
+    """
+    columns = {row[1] for row in db.session.execute(db.text("PRAGMA table_info(sale)"))}
+    for column, sql_type in (('unit_price_cents', 'INTEGER'), ('total_cents', 'INTEGER'),
+                             ('item_name', 'VARCHAR(100)')):
+        if column not in columns:
+            db.session.execute(db.text(f"ALTER TABLE sale ADD COLUMN {column} {sql_type}"))
+    db.session.commit()
+
+    filled = normalized = 0
+    last_id = db.session.query(func.max(Sale.id)).scalar() or 0
+    for low in range(0, last_id, batch_size):
+        # 'YYYY-MM-DD HH:MM:SS' sorts before the '...SS.000000' of a cursor for the same second
+        normalized += db.session.execute(db.text(
+            "UPDATE sale SET sale_date = sale_date || '.000000' "
+            "WHERE id > :low AND id <= :high AND length(sale_date) = 19"
+        ), {'low': low, 'high': low + batch_size}).rowcount
+        filled += db.session.execute(db.text(
+            "UPDATE sale SET "
+            "unit_price_cents = (SELECT CAST(ROUND(price * 100) AS INTEGER) FROM inventory WHERE id = sale.inventory_id), "
+            "item_name = (SELECT name FROM inventory WHERE id = sale.inventory_id) "
+            "WHERE id > :low AND id <= :high AND unit_price_cents IS NULL "
+            "AND inventory_id IN (SELECT id FROM inventory)"
+        ), {'low': low, 'high': low + batch_size}).rowcount
+        db.session.execute(db.text(
+            "UPDATE sale SET total_cents = quantity * unit_price_cents "
+            "WHERE id > :low AND id <= :high AND total_cents IS NULL"
+        ), {'low': low, 'high': low + batch_size})
+        db.session.commit()
+    # Sales of deleted items have no price left to copy and stay NULL
+    unpriced = Sale.query.filter(Sale.unit_price_cents.is_(None)).count()
+    click.echo(f"Backfilled {filled} sales, normalized {normalized} sale dates, {unpriced} could not be priced")
+
+@app.cli.command('migrate-wallets')
+def migrate_wallets_command():
+    """
+    Upgrades an existing database to the wallet ledger without losing balances.
+
+    Adds opening_balance_cents to the customer table, fills it from the old
+    wallet_balance column and creates the ledger and snapshot tables.
+    """
+    filled = wallet.migrate(db.session)
+    db.session.commit()
+    click.echo(f"Migrated {filled} wallets")
 
-    sales = Sale.query.filter_by(customer_id=customer.id).all()
-    history = [{"item_id": sale.inventory_id, "quantity": sale.quantity, "date": sale.sale_date} for sale in sales]
-    return jsonify(history), 200
+@app.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    """Deletes expired idempotency keys, one batch per transaction."""
+    total = 0
+    while True:
+        deleted = idempotency.purge()
+        total += deleted
+        if deleted < 1000:
+            break
+    click.echo(f"Purged {total} idempotency keys")
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5003)
@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_jwt_extended import create_access_token
+
+from sales.app import app, db, sale_writer, Customer, Inventory
+
+def reset_database(sales):
+    """
+    Recreates a customer and an item that can afford and stock ``sales`` single-unit sales.
+    """
+    db.drop_all()
+    db.create_all()
+    db.session.add(Customer(full_name="Bench", username="bench", password="x", opening_balance_cents=sales * 100))
+    db.session.add(Inventory(name="Pen", category="Office", price=1.0, description="", count=sales))
+    db.session.commit()
+
+def run_sales(sales, threads, headers):
+    """
+    Posts ``sales`` sales from ``threads`` request threads and returns sales/sec.
+    """
+    def buy(_):
+        return app.test_client().post('/sales', headers=headers, json={
+            "username": "bench", "item_id": 1, "quantity": 1
+        }).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        statuses = list(pool.map(buy, range(sales)))
+    elapsed = time.perf_counter() - start
+    assert statuses.count(200) == sales
+    return sales / elapsed
+
+def run_group_commit_benchmark(sales=2000, threads=32):
+    """
+    Compares one commit per sale against group commit on a file-backed SQLite database.
+    """
+    path = os.path.join(tempfile.mkdtemp(), "bench_sales.db")
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    print(f"Benchmarking {sales} sales from {threads} threads...")
+    with app.app_context():
+        headers = {"Authorization": f"Bearer {create_access_token(identity='bench')}"}
+        for enabled in (False, True):
+            reset_database(sales)
+            app.config['SALES_GROUP_COMMIT'] = enabled
+            rate = run_sales(sales, threads, headers)
+            print(f"{'group commit' if enabled else 'commit per sale':16} {rate:8.1f} sales/sec")
+        sale_writer.shutdown()
+        db.drop_all()
+    os.remove(path)
+
+if __name__ == "__main__":
+    run_group_commit_benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -1,5 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import threading
 import pytest
-from sales.app import app, db, Sale, Customer, Inventory
+from sqlalchemy import event
+from sales.app import (app, db, bump_version, catalog_responses, idempotency, in_stock,
+                       load_in_stock, sale_writer, CatalogVersion, Customer, IdempotencyKey, Inventory, Order,
+                       Reservation, Sale, SalesRollup)
 from flask_jwt_extended import create_access_token
 
 @pytest.fixture
@@ -13,6 +19,8 @@ def client():
 
     with app.app_context():
         db.create_all()
+        catalog_responses.clear()
+        in_stock.clear()
 
         user1 = Customer(
             full_name="Joseph Nadim",
@@ -99,6 +107,97 @@ def test_purchase_history(client, auth_header):
         assert response.status_code == 200
         assert b"1" in response.data
 
+def test_purchase_history_pages_with_item_details(client, auth_header):
+    """
+    Test paging the purchase history with names, unit prices and a date range.
+    """
+    with app.app_context():
+        db.session.add(Inventory(name="Pen", category="Office", price=0.5, description="", count=100))
+        Customer.query.filter_by(username="jodim").first().opening_balance_cents = 200000
+        db.session.commit()
+    for item_id in (2, 1, 2, 2):
+        client.post('/sales', headers=auth_header, json={"username": "jodim", "item_id": item_id, "quantity": 1})
+
+    seen, cursor = [], None
+    while True:
+        response = client.get('/sales/history/jodim?limit=3' + (f'&cursor={cursor}' if cursor else ''),
+                              headers=auth_header)
+        seen += response.get_json()
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert [sale["id"] for sale in seen] == [1, 2, 3, 4]
+    assert [(sale["name"], sale["unit_price"]) for sale in seen[:2]] == [("Pen", 0.5), ("Laptop", 1000.0)]
+
+    with app.app_context():
+        Sale.query.filter_by(id=1).update({"sale_date": datetime(2024, 1, 15)})
+        db.session.commit()
+    response = client.get('/sales/history/jodim?start=2024-01-01&end=2024-02-01', headers=auth_header)
+    assert [sale["id"] for sale in response.get_json()] == [1]
+    assert client.get('/sales/history/jodim?start=yesterday', headers=auth_header).status_code == 400
+
+    with app.app_context():
+        sql = ("EXPLAIN QUERY PLAN SELECT id FROM sale WHERE customer_id = 1 "
+               "AND (sale_date, id) > ('2024-01-01', 0) ORDER BY sale_date, id LIMIT 10")
+        plan = [row[3] for row in db.session.execute(db.text(sql))]
+        assert any("ix_sale_customer_id_sale_date_id" in step for step in plan) and \
+            not any("TEMP B-TREE" in step for step in plan)
+
+def test_purchase_history_keeps_price_paid(client, auth_header):
+    """
+    Test that history reports the price paid even after the item price changes.
+    """
+    client.post('/sales', headers=auth_header, json={"username": "jodim", "item_id": 1, "quantity": 1})
+    with app.app_context():
+        Inventory.query.get(1).price = 1200.0
+        db.session.commit()
+    sale = client.get('/sales/history/jodim', headers=auth_header).get_json()[0]
+    assert (sale["name"], sale["unit_price"], sale["total"]) == ("Laptop", 1000.0, 1000.0)
+
+def test_backfill_sale_prices(client):
+    """
+    Test filling the price snapshot of sales recorded before it existed.
+    """
+    with app.app_context():
+        db.session.add_all([Sale(customer_id=1, inventory_id=1, quantity=2) for _ in range(3)])
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=['backfill-sale-prices', '--batch-size', '2'])
+    assert "Backfilled 3 sales, normalized 0 sale dates, 0 could not be priced" in result.output
+    with app.app_context():
+        assert {(sale.item_name, sale.unit_price_cents, sale.total_cents) for sale in Sale.query} == \
+            {("Laptop", 100000, 200000)}
+
+def test_backfill_normalizes_legacy_sale_dates(client, auth_header):
+    """
+    Test that sales dated by CURRENT_TIMESTAMP are paged like new ones after the backfill.
+    """
+    with app.app_context():
+        for _ in range(3):
+            db.session.execute(db.text(
+                "INSERT INTO sale (customer_id, inventory_id, quantity, unit_price_cents, total_cents, sale_date) "
+                "VALUES (1, 1, 1, 100000, 100000, '2024-01-01 10:00:00')"))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=['backfill-sale-prices'])
+    assert "normalized 3 sale dates" in result.output
+
+    first = client.get('/sales/history/jodim?limit=1', headers=auth_header)
+    rest = client.get(f"/sales/history/jodim?limit=10&cursor={first.headers['X-Next-Cursor']}", headers=auth_header)
+    assert len(first.get_json()) + len(rest.get_json()) == 3
+
+def test_backfill_reports_sales_of_deleted_items(client, auth_header):
+    """
+    Test that sales whose item is gone are reported and still listed in the history.
+    """
+    with app.app_context():
+        db.session.add(Sale(customer_id=1, inventory_id=999, quantity=1))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=['backfill-sale-prices'])
+    assert "Backfilled 0 sales, normalized 0 sale dates, 1 could not be priced" in result.output
+
+    response = client.get('/sales/history/jodim', headers=auth_header)
+    assert response.status_code == 200
+    assert response.get_json()[0]['total'] is None
+
 def test_cache(client):
     """
     Test caching functionality.
@@ -110,3 +209,283 @@ def test_cache(client):
         assert response1.data == response2.data
         assert response2.status_code == 200
         assert b"Laptop" in response2.data
+
+def test_display_goods_etag_changes_after_sale(client, auth_header):
+    """
+    Test that goods are answered with 304 until a sale bumps the catalog version.
+    """
+    etag = client.get('/sales/goods').headers['ETag']
+    assert client.get('/sales/goods', headers={"If-None-Match": etag}).status_code == 304
+
+    client.post('/sales', headers=auth_header, json={"username": "jodim", "item_id": 1, "quantity": 1})
+    response = client.get('/sales/goods', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_json()[0]["count"] == 9
+
+def test_display_goods_served_from_memory(client, auth_header, monkeypatch):
+    """
+    Test that goods pages come from memory, sales update them in place and other changes reload them.
+    """
+    add_cart_items()
+    loads = []
+    monkeypatch.setattr(in_stock, 'loader', lambda: loads.append(1) or load_in_stock())
+
+    response = client.get('/sales/goods?limit=2')
+    assert [item["name"] for item in response.get_json()] == ["Laptop", "Mouse"]
+    response = client.get(f'/sales/goods?limit=2&cursor={response.headers["X-Next-Cursor"]}')
+    assert [item["name"] for item in response.get_json()] == ["Cable"]
+    assert 'X-Next-Cursor' not in response.headers
+
+    client.post('/sales', headers=auth_header, json={"username": "jodim", "item_id": 2, "quantity": 3})
+    client.post('/sales/orders', headers=auth_header, json={"username": "jodim", "items": [
+        {"item_id": 3, "quantity": 5}
+    ]})
+    goods = client.get('/sales/goods').get_json()
+    assert [(item["name"], item["count"]) for item in goods] == [("Laptop", 10), ("Cable", 95)]
+    assert len(loads) == 1
+
+    with app.app_context():
+        Inventory.query.get(2).count = 4  # Restocked by the inventory service
+        bump_version(db.session, CatalogVersion)
+        db.session.commit()
+    assert [item["name"] for item in client.get('/sales/goods').get_json()] == ["Laptop", "Mouse", "Cable"]
+    assert len(loads) == 2
+    assert client.get('/sales/goods?limit=zero').status_code == 400
+
+def test_process_sale_confirms_reservation(client, auth_header):
+    """
+    Test that a sale against a hold charges the customer without deducting stock twice.
+    """
+    with app.app_context():
+        db.session.add(Reservation(inventory_id=1, quantity=2, holder="jodim",
+                                   expires_at=datetime.utcnow() + timedelta(minutes=10)))
+        Inventory.query.get(1).count = 8  # The hold already took its units
+        db.session.commit()
+
+    response = client.post('/sales', headers=auth_header, json={"username": "jodim", "reservation_id": 1})
+    assert response.status_code == 400  # 2 laptops cost more than the wallet holds
+    with app.app_context():
+        assert Reservation.query.count() == 1
+        Customer.query.filter_by(username="jodim").first().opening_balance_cents = 300000
+        db.session.commit()
+
+    response = client.post('/sales', headers=auth_header, json={"username": "jodim", "reservation_id": 1})
+    assert response.status_code == 200
+    assert client.post('/sales', headers=auth_header, json={"username": "jodim", "reservation_id": 1}).status_code == 404
+    with app.app_context():
+        assert Inventory.query.get(1).count == 8
+        assert Sale.query.one().quantity == 2
+
+def test_process_sale_rejects_expired_reservation(client, auth_header):
+    """
+    Test that an expired hold cannot be confirmed by a sale.
+    """
+    with app.app_context():
+        db.session.add(Reservation(inventory_id=1, quantity=1, holder="jodim",
+                                   expires_at=datetime.utcnow() - timedelta(minutes=1)))
+        db.session.commit()
+
+    response = client.post('/sales', headers=auth_header, json={"username": "jodim", "reservation_id": 1})
+    assert response.status_code == 404
+    with app.app_context():
+        assert Sale.query.count() == 0
+
+def test_process_sale_idempotency_key(client, auth_header):
+    """
+    Test that retried sales are replayed, concurrent duplicates rejected and expired keys purged.
+    """
+    headers = {**auth_header, "Idempotency-Key": "sale-1"}
+    sale = {"username": "jodim", "item_id": 1, "quantity": 1}
+    first = client.post('/sales', headers=headers, json=sale)
+    retry = client.post('/sales', headers=headers, json=sale)
+    assert first.status_code == retry.status_code == 200
+    assert retry.data == first.data
+    with app.app_context():
+        assert Sale.query.count() == 1
+        assert Inventory.query.get(1).count == 9
+
+        # A request still holding its key makes duplicates wait for it
+        IdempotencyKey.query.update({"status": None, "expires_at": datetime.utcnow() + timedelta(minutes=1)})
+        db.session.commit()
+    assert client.post('/sales', headers=headers, json=sale).status_code == 409
+
+    with app.app_context():
+        IdempotencyKey.query.update({"expires_at": datetime.utcnow() - timedelta(minutes=1)})
+        db.session.commit()
+        assert idempotency.purge() == 1
+
+def test_group_commit_sale_failing_after_commit_is_not_retried(client, auth_header, monkeypatch):
+    """
+    Test that a sale written by the group-commit writer marks its Idempotency-Key with it.
+    """
+    monkeypatch.setitem(app.config, 'SALES_GROUP_COMMIT', True)
+    headers = {**auth_header, "Idempotency-Key": "sale-1"}
+    sale = {"username": "jodim", "item_id": 1, "quantity": 1}
+
+    def fail(*args):
+        raise RuntimeError("boom")
+
+    try:
+        with monkeypatch.context() as patch:
+            patch.setattr(in_stock, 'apply', fail)  # Runs after the sale committed
+            with pytest.raises(RuntimeError):
+                client.post('/sales', headers=headers, json=sale)
+        assert client.post('/sales', headers=headers, json=sale).status_code == 409
+    finally:
+        sale_writer.shutdown()
+    with app.app_context():
+        assert Sale.query.count() == 1
+
+def add_cart_items():
+    """
+    Adds a mouse ($25.50, 3 left) and a cable ($4.99, 100 left) next to the laptop.
+    """
+    with app.app_context():
+        db.session.add_all([
+            Inventory(name="Mouse", category="Electronics", price=25.5, description="", count=3),
+            Inventory(name="Cable", category="Electronics", price=4.99, description="", count=100),
+        ])
+        db.session.commit()
+
+def test_checkout_order(client, auth_header):
+    """
+    Test checking out a cart as one order with a header and one line per item.
+    """
+    add_cart_items()
+    response = client.post('/sales/orders', headers=auth_header, json={"username": "jodim", "items": [
+        {"item_id": 2, "quantity": 2},
+        {"item_id": 3, "quantity": 1},
+        {"item_id": 3, "quantity": 2},
+    ]})
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body["total"] == 65.97
+    assert body["remaining_balance"] == 934.03
+    with app.app_context():
+        order = Order.query.get(body["order_id"])
+        assert order.total_cents == 6597
+        assert sorted((line.inventory_id, line.quantity) for line in order.lines) == [(2, 2), (3, 3)]
+        assert [item.count for item in Inventory.query.order_by(Inventory.id)] == [10, 1, 97]
+
+def test_checkout_order_is_all_or_nothing(client, auth_header):
+    """
+    Test that a cart with one unfulfillable line changes neither stock nor wallet.
+    """
+    add_cart_items()
+    for items, status in [
+        ([{"item_id": 3, "quantity": 1}, {"item_id": 2, "quantity": 4}], 400),  # Not enough mice
+        ([{"item_id": 3, "quantity": 1}, {"item_id": 1, "quantity": 1}], 400),  # Laptop over budget
+        ([{"item_id": 3, "quantity": 1}, {"item_id": 99, "quantity": 1}], 404),
+        ([{"item_id": 3, "quantity": 0}], 400),
+    ]:
+        response = client.post('/sales/orders', headers=auth_header, json={"username": "jodim", "items": items})
+        assert response.status_code == status
+    with app.app_context():
+        assert [item.count for item in Inventory.query.order_by(Inventory.id)] == [10, 3, 100]
+        assert Sale.query.count() == 0 and Order.query.count() == 0
+        assert Customer.query.filter_by(username="jodim").first().wallet_balance == 1000.0
+
+def test_sales_stats_read_rollups(client, auth_header):
+    """
+    Test daily, top-item and category stats maintained by sales and orders.
+    """
+    add_cart_items()
+    with app.app_context():
+        Customer.query.filter_by(username="jodim").first().opening_balance_cents = 500000
+        db.session.commit()
+    client.post('/sales', headers=auth_header, json={"username": "jodim", "item_id": 1, "quantity": 2})
+    client.post('/sales/orders', headers=auth_header, json={"username": "jodim", "items": [
+        {"item_id": 2, "quantity": 3}, {"item_id": 3, "quantity": 10}
+    ]})
+    today = datetime.utcnow().date().isoformat()
+
+    daily = client.get('/sales/stats/daily', headers=auth_header).get_json()
+    assert daily == [{"day": today, "units": 15, "revenue": 2126.4}]
+    top = client.get('/sales/stats/top-items?by=units&limit=2', headers=auth_header).get_json()
+    assert [(item["name"], item["units"]) for item in top] == [("Cable", 10), ("Mouse", 3)]
+    categories = client.get('/sales/stats/categories', headers=auth_header).get_json()
+    assert categories == [{"category": "Electronics", "units": 15, "revenue": 2126.4}]
+    assert client.get(f'/sales/stats/daily?end={today}', headers=auth_header).get_json() == []
+    assert client.get('/sales/stats/daily?start=today', headers=auth_header).status_code == 400
+
+    with app.app_context():
+        SalesRollup.query.delete()
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=['rebuild-sales-rollups'])
+    assert "Rebuilt 3 rollups" in result.output
+    assert client.get('/sales/stats/daily', headers=auth_header).get_json() == daily
+
+def test_process_sale_concurrent_no_overdraft(client, auth_header):
+    """
+    Test that concurrent sales never overdraw the wallet.
+    """
+    with app.app_context():
+        db.session.add(Inventory(name="Pen", category="Office", price=0.3, description="", count=10000))
+        db.session.commit()
+
+    def buy_many():
+        thread_client = app.test_client()
+        return [thread_client.post('/sales', headers=auth_header, json={
+            "username": "jodim",
+            "item_id": 2,
+            "quantity": 100
+        }).status_code for _ in range(10)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = [status for future in [pool.submit(buy_many) for _ in range(8)] for status in future.result()]
+
+    # $1000 buys exactly 33 lots of 100 pens at $0.30
+    assert statuses.count(200) == 33
+    with app.app_context():
+        assert Customer.query.filter_by(username="jodim").first().wallet_balance == 1000 - 33 * 30
+
+def test_group_commit_batches_sales_and_isolates_failures(client, auth_header, monkeypatch):
+    """
+    Test that group-commit mode shares commits between sales and fails sales one by one.
+    """
+    with app.app_context():
+        db.session.add(Inventory(name="Pen", category="Office", price=0.3, description="", count=50))
+        db.session.commit()
+    batches, statements = [], []
+    run_batch = sale_writer._run_batch
+    monkeypatch.setattr(sale_writer, '_run_batch', lambda batch: batches.append(len(batch)) or run_batch(batch))
+
+    def trace(dbapi_connection, connection_record, connection_proxy):
+        if threading.current_thread().name == 'group-commit':
+            dbapi_connection.set_trace_callback(statements.append)
+
+    def untrace(dbapi_connection, connection_record):
+        dbapi_connection.set_trace_callback(None)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'checkout', trace)
+    event.listen(engine, 'checkin', untrace)
+    monkeypatch.setitem(app.config, 'SALES_GROUP_COMMIT', True)
+    monkeypatch.setattr(sale_writer, 'max_delay', 0.05)
+
+    def buy(item_id, quantity):
+        return app.test_client().post('/sales', headers=auth_header, json={
+            "username": "jodim", "item_id": item_id, "quantity": quantity
+        }).status_code
+
+    try:
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            pens = [pool.submit(buy, 2, 1) for _ in range(60)]
+            laptops = [pool.submit(buy, 1, 2)]  # Over budget: only this sale fails
+            statuses = [future.result() for future in pens + laptops]
+    finally:
+        sale_writer.shutdown()
+        event.remove(engine, 'checkout', trace)
+        event.remove(engine, 'checkin', untrace)
+
+    assert statuses.count(200) == 50 and statuses.count(400) == 11
+    assert max(batches) > 1 and sum(batches) == 61
+    # One transaction and one commit per batch, a savepoint per sale inside it
+    assert statements.count('BEGIN IMMEDIATE') == statements.count('COMMIT') == len(batches)
+    assert sum(statement.startswith('SAVEPOINT') for statement in statements) == 61
+    with app.app_context():
+        assert Sale.query.count() == 50
+        assert Inventory.query.get(2).count == 0
+        assert Inventory.query.get(1).count == 10
+        assert Customer.query.filter_by(username="jodim").first().wallet_balance == 1000 - 50 * 0.3